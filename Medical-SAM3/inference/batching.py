@@ -0,0 +1,155 @@
+"""
+Dynamic micro-batching for concurrent text-prompted segmentation requests.
+
+Requests that arrive within a short window are encoded together with
+``Sam3Processor.set_image_batch`` and grounded in a single batched pass.
+The blocking torch calls run in an executor so the event loop stays free.
+"""
+
+import asyncio
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+
+
+@dataclass
+class _Request:
+    model: object              # SAM3Model the request must run on
+    image: np.ndarray          # RGB image (H, W, 3)
+    prompt: str
+    future: asyncio.Future
+
+
+def predict_text_batch(model, images: List[np.ndarray], prompts: List[str]) -> List[Optional[np.ndarray]]:
+    """
+    Segment each image with its own text prompt.
+
+    A single image goes through ``encode_image`` so it can use the
+    embedding cache; larger batches share one backbone and grounding pass.
+    """
+    if len(images) == 1:
+        inference_state = model.encode_image(images[0])
+        return [model.predict_text(inference_state, prompts[0])]
+
+    batch_state = model.encode_images(images)
+    return model.predict_text_batch(batch_state, prompts)
+
+
+class BatchingWorker:
+    """Collects concurrent requests into micro-batches and runs them off the event loop."""
+
+    def __init__(
+        self,
+        max_batch_size: int = 4,
+        max_wait_ms: float = 10.0,
+        executor: Optional[Executor] = None,
+    ):
+        """
+        Initialize the worker.
+
+        Args:
+            max_batch_size: Maximum number of images per batch
+            max_wait_ms: How long to wait for more requests after the first one
+            executor: Executor running the blocking inference (default loop executor if None)
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.executor = executor
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.requests = 0
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, model, image: np.ndarray, prompt: str) -> Optional[np.ndarray]:
+        """
+        Queue a request and wait for its mask.
+
+        Args:
+            model: SAM3Model to run the request on
+            image: RGB image (H, W, 3)
+            prompt: Text prompt
+
+        Returns:
+            Binary prediction mask or None if no prediction
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(model, image, prompt, future))
+        return await future
+
+    async def stop(self):
+        """Cancel the background task."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _collect(self) -> List[_Request]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+
+            # Requests for different models (e.g. another checkpoint) cannot share a batch
+            groups = {}
+            for request in batch:
+                groups.setdefault(id(request.model), []).append(request)
+
+            for group in groups.values():
+                group = [r for r in group if not r.future.cancelled()]
+                if not group:
+                    continue
+                try:
+                    masks = await loop.run_in_executor(
+                        self.executor,
+                        predict_text_batch,
+                        group[0].model,
+                        [r.image for r in group],
+                        [r.prompt for r in group],
+                    )
+                except Exception as e:
+                    for request in group:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+
+                self.batches += 1
+                self.requests += len(group)
+                for request, mask in zip(group, masks):
+                    if not request.future.done():
+                        request.future.set_result(mask)
+
+    def stats(self) -> dict:
+        """Batch counters and current queue depth."""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+        }
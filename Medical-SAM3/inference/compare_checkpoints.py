@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Compare several checkpoints on the evaluation datasets in a single pass.
+
+Each sample is decoded once and run through all models. Checkpoints whose
+vision backbone weights are identical (e.g. fine-tunes with a frozen
+backbone, detected by hashing the weights) share one backbone module: the
+batch is encoded once per distinct backbone, and only the heads of each
+model run on the shared features.
+
+Writes side-by-side metrics with deltas against the first checkpoint, the
+per-sample deltas, and the throughput of each model to results/comparison/.
+
+Usage:
+    python compare_checkpoints.py --checkpoints sam3,/path/to/v1.pt,/path/to/v2.pt
+                                  [--names sam3,v1,v2] [--max-samples N]
+                                  [--datasets DATASET1,DATASET2] [--batch-size N]
+"""
+
+import argparse
+import gc
+import hashlib
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+# Add current directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from dataset_loaders import DATASET_LOADERS
+from eval_pipeline import PipelinedEvaluator, Prefetcher, _batch_rows, _micro_batches, dataset_result, predict_encoded
+from run_evaluation import OUTPUT_DIR
+from sam3_inference import SAM3Model, generate_bbox_from_mask
+
+# Metrics compared per prompt type, and deltas reported in percentage points
+COMPARED_METRICS = ('dice', 'iou', 'hd95', 'nsd')
+PERCENT_METRICS = ('dice', 'iou', 'nsd')
+
+
+def backbone_hash(sam3: SAM3Model) -> str:
+    """Hash of the vision backbone weights (and precision) of a loaded model."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(sam3.precision.encode())
+    for name, tensor in sam3.model.backbone.vision_backbone.state_dict().items():
+        digest.update(f"{name}|{tensor.dtype}|{tuple(tensor.shape)}".encode())
+        digest.update(tensor.detach().reshape(-1).contiguous().view(torch.uint8).cpu().numpy())
+    return digest.hexdigest()
+
+
+def share_backbones(models: Dict[str, SAM3Model]) -> List[List[str]]:
+    """
+    Load the models, making those with identical vision backbone weights use
+    the same backbone module (the duplicates are freed).
+
+    Returns:
+        Groups of model names sharing a backbone, the first one encodes
+    """
+    groups: Dict[str, List[str]] = {}
+    for name, sam3 in models.items():
+        sam3.load_model()
+        key = backbone_hash(sam3)
+        if key in groups:
+            leader = models[groups[key][0]]
+            sam3.model.backbone.vision_backbone = leader.model.backbone.vision_backbone
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            print(f"{name}: same vision backbone as {groups[key][0]}, encoding is shared")
+        groups.setdefault(key, []).append(name)
+    return list(groups.values())
+
+
+def _synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+class ComparisonEvaluator(PipelinedEvaluator):
+    """
+    Evaluate several models on the same decoded samples (see
+    ``PipelinedEvaluator`` for the loading and metrics pipeline).
+
+    Args:
+        models: Model per name, the first one is the baseline
+        **pipeline_kwargs: PipelinedEvaluator options (batch_size, prefetch...)
+    """
+
+    def __init__(self, models: Dict[str, SAM3Model], **pipeline_kwargs):
+        super().__init__(next(iter(models.values())), **pipeline_kwargs)
+        self.models = models
+        self.groups = share_backbones(models)
+        # Seconds spent per model: its part of the shared encoding, and its heads
+        self.timings = {name: {'backbone_s': 0.0, 'heads_s': 0.0, 'n_samples': 0} for name in models}
+
+    def _evaluate(self, dataset_name: str, samples: Prefetcher, metrics_pool: ThreadPoolExecutor) -> dict:
+        rows = {name: ([], []) for name in self.models}
+        pending: List[Tuple[str, Future]] = []
+
+        def _collect(name: str, future: Future):
+            box, text = future.result()
+            rows[name][0].extend(box)
+            rows[name][1].extend(text)
+
+        progress = tqdm(desc=dataset_name, unit="img")
+        for batch in _micro_batches(samples, self.batch_size):
+            # Samples without a foreground have no box prompt and are skipped
+            batch = [sample for sample in batch if generate_bbox_from_mask(sample.gt_mask) is not None]
+            if not batch:
+                continue
+            for name, (box_masks, text_masks) in self._predict_all(batch).items():
+                pending.append((name, metrics_pool.submit(_batch_rows, batch, box_masks, text_masks)))
+            while len(pending) > self.prefetch * len(self.models):
+                _collect(*pending.pop(0))
+            progress.update(len(batch))
+        for name, future in pending:
+            _collect(name, future)
+        progress.close()
+
+        return {
+            'dataset': dataset_name,
+            'models': {
+                name: dataset_result(dataset_name, box_rows, text_rows, label=f"{dataset_name} [{name}]")
+                for name, (box_rows, text_rows) in rows.items()
+            },
+        }
+
+    def _predict_all(self, batch) -> Dict[str, Tuple[List, List]]:
+        """Box and text prompt masks of every model, encoding once per backbone group."""
+        images = [sample.image for sample in batch]
+        predictions = {}
+        for group in self.groups:
+            start = time.perf_counter()
+            batch_state = self.models[group[0]].encode_images(images)
+            _synchronize()
+            backbone_s = (time.perf_counter() - start) / len(group)
+            for name in group:
+                start = time.perf_counter()
+                box, text = predict_encoded(self.models[name], batch, batch_state)
+                timing = self.timings[name]
+                timing['heads_s'] += time.perf_counter() - start
+                timing['backbone_s'] += backbone_s
+                timing['n_samples'] += len(batch)
+                predictions[name] = ([p[0] for p in box], [p[0] for p in text])
+        return predictions
+
+    def throughput(self) -> pd.DataFrame:
+        """Seconds per sample (backbone share and heads) and samples per second of each model."""
+        rows = []
+        for group in self.groups:
+            for name in group:
+                timing = self.timings[name]
+                n = max(timing['n_samples'], 1)
+                total = timing['backbone_s'] + timing['heads_s']
+                rows.append({
+                    'model': name,
+                    'backbone_group': group[0],
+                    'backbone_s_per_sample': timing['backbone_s'] / n,
+                    'heads_s_per_sample': timing['heads_s'] / n,
+                    'samples_per_s': timing['n_samples'] / total if total else float('nan'),
+                })
+        return pd.DataFrame(rows)
+
+
+def summary_table(results: List[dict], baseline: str) -> pd.DataFrame:
+    """One row per dataset and model, with deltas against the baseline model."""
+    rows = []
+    for result in results:
+        for name, model_result in result['models'].items():
+            row = {'dataset': result['dataset'], 'model': name,
+                   'n_samples': model_result['text_prompt_results'].get('n_samples', 0)}
+            for prompt, key in (('box', 'box_prompt'), ('text', 'text_prompt_results')):
+                for metric in COMPARED_METRICS:
+                    row[f'{prompt}_{metric}'] = model_result[key].get(metric, float('nan'))
+                # The HD95 mean leaves the misses out, so they are compared too
+                row[f'{prompt}_hd95_misses'] = model_result[key].get('hd95_misses', 0)
+            rows.append(row)
+    df = pd.DataFrame(rows)
+
+    base = df[df['model'] == baseline].set_index('dataset')
+    for prompt in ('box', 'text'):
+        for metric in COMPARED_METRICS:
+            column = f'{prompt}_{metric}'
+            scale = 100 if metric in PERCENT_METRICS else 1
+            df[f'{column}_delta'] = (df[column] - df['dataset'].map(base[column])) * scale
+    return df
+
+
+def sample_deltas(results: List[dict], baseline: str) -> pd.DataFrame:
+    """Per-sample Dice of each model side by side, with deltas against the baseline."""
+    rows = []
+    for result in results:
+        for name, model_result in result['models'].items():
+            for prompt, key in (('box', 'box_details'), ('text', 'text_details')):
+                for row in model_result[key]:
+                    rows.append({'dataset': result['dataset'], 'prompt': prompt, 'sample_id': row['sample_id'],
+                                 'model': name, 'dice': row['dice']})
+    if not rows:
+        return pd.DataFrame()
+    df = pd.DataFrame(rows).pivot_table(index=['dataset', 'prompt', 'sample_id'], columns='model',
+                                        values='dice', aggfunc='first')
+    models = [m for m in df.columns if m != baseline]
+    for name in models:
+        df[f'{name}_delta'] = (df[name] - df[baseline]) * 100
+    return df.reset_index()
+
+
+def write_report(summary: pd.DataFrame, samples: pd.DataFrame, throughput: pd.DataFrame,
+                 output_dir: Path, baseline: str):
+    """Save the comparison as CSV files and a markdown report."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    summary.to_csv(output_dir / "checkpoint_comparison_summary.csv", index=False)
+    samples.to_csv(output_dir / "checkpoint_comparison_samples.csv", index=False)
+    throughput.to_csv(output_dir / "checkpoint_comparison_throughput.csv", index=False)
+    print(f"\nSaved comparison tables to: {output_dir}")
+
+    report_path = output_dir / "checkpoint_comparison.md"
+    with open(report_path, 'w') as f:
+        f.write("# Checkpoint Comparison\n\n")
+        f.write(f"**Generated**: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+        f.write(f"Deltas against `{baseline}`: Dice, IoU and NSD in percentage points, HD95 in pixels. "
+                "HD95 is averaged over the samples where it is finite; misses (nothing predicted, or "
+                "a prediction on an empty ground truth) are counted separately.\n\n")
+
+        f.write("## Summary\n\n")
+        f.write("| Dataset | Model | Box Dice | Δ | Text Dice | Δ | Text IoU | Δ | Text HD95 | Δ | HD95 misses "
+                "| Text NSD | Δ |\n")
+        f.write("|---------|-------|----------|---|-----------|---|----------|---|-----------|---|-------------"
+                "|----------|---|\n")
+        for _, row in summary.iterrows():
+            f.write(f"| {row['dataset']} | {row['model']} | "
+                    f"{row['box_dice']:.1%} | {row['box_dice_delta']:+.2f} | "
+                    f"{row['text_dice']:.1%} | {row['text_dice_delta']:+.2f} | "
+                    f"{row['text_iou']:.1%} | {row['text_iou_delta']:+.2f} | "
+                    f"{row['text_hd95']:.1f} | {row['text_hd95_delta']:+.1f} | {row['text_hd95_misses']} | "
+                    f"{row['text_nsd']:.1%} | {row['text_nsd_delta']:+.2f} |\n")
+
+        f.write("\n## Throughput\n\n")
+        f.write("Models in the same backbone group encode each batch once, its time is split between them.\n\n")
+        f.write("| Model | Backbone group | Backbone s/sample | Heads s/sample | Samples/s |\n")
+        f.write("|-------|----------------|-------------------|----------------|-----------|\n")
+        for _, row in throughput.iterrows():
+            f.write(f"| {row['model']} | {row['backbone_group']} | {row['backbone_s_per_sample']:.3f} | "
+                    f"{row['heads_s_per_sample']:.3f} | {row['samples_per_s']:.2f} |\n")
+
+        for column in [c for c in samples.columns if str(c).endswith('_delta')]:
+            name = column[:-len('_delta')]
+            changed = samples.dropna(subset=[column]).sort_values(column)
+            f.write(f"\n## Largest per-sample Dice changes: {name} vs {baseline}\n\n")
+            f.write("| Dataset | Prompt | Sample | Baseline Dice | Dice | Δ |\n")
+            f.write("|---------|--------|--------|---------------|------|---|\n")
+            for _, row in pd.concat([changed.head(5), changed.tail(5)]).drop_duplicates().iterrows():
+                f.write(f"| {row['dataset']} | {row['prompt']} | {row['sample_id']} | "
+                        f"{row[baseline]:.1%} | {row[name]:.1%} | {row[column]:+.2f} |\n")
+    print(f"Saved report to: {report_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare SAM3/MedSAM3 checkpoints side by side")
+    parser.add_argument("--checkpoints", type=str, required=True,
+                        help="Comma-separated checkpoint files ('sam3' for SAM3 from HuggingFace), "
+                             "the first one is the baseline")
+    parser.add_argument("--names", type=str, default=None,
+                        help="Comma-separated model names for the report (default: file names)")
+    parser.add_argument("--max-samples", type=int, default=None,
+                        help="Maximum samples per dataset (for testing)")
+    parser.add_argument("--datasets", type=str, default=None,
+                        help="Comma-separated list of datasets to evaluate")
+    parser.add_argument("--batch-size", type=int, default=4,
+                        help="Images per backbone pass")
+    parser.add_argument("--prefetch", type=int, default=16,
+                        help="Decoded samples held ahead of the models per dataset")
+    parser.add_argument("--loader-workers", type=int, default=2,
+                        help="Datasets decoded concurrently")
+    parser.add_argument("--metric-workers", type=int, default=None,
+                        help="Threads computing metrics (default: CPU count)")
+    parser.add_argument("--output-dir", type=str, default=str(OUTPUT_DIR / "comparison"),
+                        help="Directory for the comparison report")
+    args = parser.parse_args()
+
+    checkpoints = [c.strip() for c in args.checkpoints.split(",") if c.strip()]
+    if args.names:
+        names = [n.strip() for n in args.names.split(",")]
+        if len(names) != len(checkpoints):
+            parser.error(f"{len(names)} names for {len(checkpoints)} checkpoints")
+    else:
+        names = [c if c == "sam3" else Path(c).stem for c in checkpoints]
+    if len(set(names)) != len(names):
+        parser.error(f"Model names must be unique, got {names} (use --names)")
+    if args.datasets:
+        datasets = [d.strip() for d in args.datasets.split(",") if d.strip() in DATASET_LOADERS]
+    else:
+        datasets = list(DATASET_LOADERS.keys())
+
+    models = {
+        name: SAM3Model(confidence_threshold=0.1, checkpoint_path=None if checkpoint == "sam3" else checkpoint)
+        for name, checkpoint in zip(names, checkpoints)
+    }
+    evaluator = ComparisonEvaluator(
+        models,
+        batch_size=args.batch_size,
+        prefetch=args.prefetch,
+        loader_workers=args.loader_workers,
+        metric_workers=args.metric_workers,
+    )
+    results = list(evaluator.run(datasets, args.max_samples))
+
+    baseline = names[0]
+    summary = summary_table(results, baseline)
+    throughput = evaluator.throughput()
+    write_report(summary, sample_deltas(results, baseline), throughput, Path(args.output_dir), baseline)
+
+    print("\n" + "=" * 60)
+    print("CHECKPOINT COMPARISON")
+    print("=" * 60)
+    print(summary[['dataset', 'model', 'box_dice_delta', 'text_dice_delta', 'text_hd95_delta']].to_string(index=False))
+    print()
+    print(throughput.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Compare CPU precision modes on the evaluation datasets.
+
+Runs the evaluation of run_evaluation.py once per precision mode (see
+``sam3_inference.PRECISIONS``) and reports the Dice/IoU delta and the speedup
+of each mode against the first one, so that a speed/quality point can be
+picked per deployment (MODEL_PRECISION on the server).
+
+Usage:
+    python compare_precision.py [--checkpoint checkpoint.pt] [--precisions fp32,bf16,int8]
+                                [--max-samples N] [--datasets DATASET1,DATASET2]
+"""
+
+import argparse
+import gc
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+# Add current directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from dataset_loaders import DATASET_LOADERS
+from run_evaluation import OUTPUT_DIR, evaluate_dataset
+from sam3_inference import PRECISIONS, SAM3Model
+
+
+def evaluate_precision(precision: str, datasets, checkpoint=None, max_samples=None) -> list:
+    """Evaluate one precision mode, returning one row per dataset."""
+    sam3 = SAM3Model(confidence_threshold=0.1, device="cpu", checkpoint_path=checkpoint, precision=precision)
+    sam3.load_model()
+
+    rows = []
+    for dataset_name in datasets:
+        start = time.perf_counter()
+        result = evaluate_dataset(sam3, dataset_name, max_samples)
+        elapsed = time.perf_counter() - start
+        n_samples = result['text_prompt_results'].get('n_samples', 0)
+        rows.append({
+            'precision': precision,
+            'dataset': dataset_name,
+            'box_dice': result['box_prompt'].get('dice', 0.0),
+            'box_iou': result['box_prompt'].get('iou', 0.0),
+            'text_dice': result['text_prompt_results'].get('dice', 0.0),
+            'text_iou': result['text_prompt_results'].get('iou', 0.0),
+            'n_samples': n_samples,
+            'sec_per_sample': elapsed / n_samples if n_samples else float('nan'),
+        })
+
+    del sam3
+    gc.collect()
+    return rows
+
+
+def add_deltas(df: pd.DataFrame, baseline: str) -> pd.DataFrame:
+    """Add metric deltas (percentage points) and speedups against the baseline precision."""
+    base = df[df['precision'] == baseline].set_index('dataset')
+    df = df.copy()
+    for metric in ('box_dice', 'box_iou', 'text_dice', 'text_iou'):
+        df[f'{metric}_delta'] = (df[metric] - df['dataset'].map(base[metric])) * 100
+    df['speedup'] = df['dataset'].map(base['sec_per_sample']) / df['sec_per_sample']
+    return df
+
+
+def write_report(df: pd.DataFrame, output_dir: Path, baseline: str):
+    """Save the comparison as CSV and markdown."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    csv_path = output_dir / "precision_comparison.csv"
+    df.to_csv(csv_path, index=False)
+    print(f"\nSaved comparison to: {csv_path}")
+
+    report_path = output_dir / "precision_comparison.md"
+    with open(report_path, 'w') as f:
+        f.write("# CPU Precision Comparison\n\n")
+        f.write(f"**Generated**: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+        f.write(f"Deltas are in percentage points against `{baseline}`.\n\n")
+        f.write("| Precision | Dataset | Box Dice | Δ | Text Dice | Δ | Text IoU | Δ | s/sample | Speedup |\n")
+        f.write("|-----------|---------|----------|---|-----------|---|----------|---|----------|---------|\n")
+        for _, row in df.iterrows():
+            f.write(f"| {row['precision']} | {row['dataset']} | "
+                    f"{row['box_dice']:.1%} | {row['box_dice_delta']:+.2f} | "
+                    f"{row['text_dice']:.1%} | {row['text_dice_delta']:+.2f} | "
+                    f"{row['text_iou']:.1%} | {row['text_iou_delta']:+.2f} | "
+                    f"{row['sec_per_sample']:.2f} | {row['speedup']:.2f}x |\n")
+
+        f.write("\n## Averages\n\n")
+        averages = df.groupby('precision', sort=False).mean(numeric_only=True)
+        for precision, row in averages.iterrows():
+            f.write(f"- **{precision}**: Box Dice Δ={row['box_dice_delta']:+.2f}, "
+                    f"Text Dice Δ={row['text_dice_delta']:+.2f}, speedup {row['speedup']:.2f}x\n")
+    print(f"Saved report to: {report_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare SAM3 CPU precision modes")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="Path to MedSAM3 checkpoint file (default: SAM3 from HuggingFace)")
+    parser.add_argument("--precisions", type=str, default=",".join(PRECISIONS),
+                        help="Comma-separated precision modes, the first one is the baseline")
+    parser.add_argument("--max-samples", type=int, default=None,
+                        help="Maximum samples per dataset (for testing)")
+    parser.add_argument("--datasets", type=str, default=None,
+                        help="Comma-separated list of datasets to evaluate")
+    parser.add_argument("--output-dir", type=str, default=str(OUTPUT_DIR / "precision"),
+                        help="Directory for the comparison report")
+    args = parser.parse_args()
+
+    precisions = [p.strip() for p in args.precisions.split(",") if p.strip()]
+    for precision in precisions:
+        if precision not in PRECISIONS:
+            parser.error(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+    if args.datasets:
+        datasets = [d.strip() for d in args.datasets.split(",") if d.strip() in DATASET_LOADERS]
+    else:
+        datasets = list(DATASET_LOADERS.keys())
+
+    rows = []
+    for precision in precisions:
+        print("\n" + "=" * 60)
+        print(f"Precision: {precision}")
+        print("=" * 60)
+        rows.extend(evaluate_precision(precision, datasets, args.checkpoint, args.max_samples))
+
+    df = add_deltas(pd.DataFrame(rows), baseline=precisions[0])
+    write_report(df, Path(args.output_dir), baseline=precisions[0])
+
+    print("\n" + "=" * 60)
+    print("PRECISION COMPARISON")
+    print("=" * 60)
+    print(df[['precision', 'dataset', 'box_dice_delta', 'text_dice_delta', 'text_iou_delta', 'speedup']].to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
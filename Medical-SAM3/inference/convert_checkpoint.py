@@ -0,0 +1,93 @@
+"""
+Convert a SAM3/MedSAM3 .pt checkpoint to a prefix-normalized .safetensors file.
+
+The converted file is loaded by memory-mapping it straight into the model
+parameters (see ``SAM3Model._load_custom_checkpoint``), which skips unpickling
+and the key rewrite on every start, and keeps peak memory during loading at
+about one copy of the weights.
+
+Usage:
+    python convert_checkpoint.py checkpoint.pt [-o checkpoint.safetensors]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+SAM3_ROOT = Path(__file__).resolve().parents[1] / "sam3"
+sys.path.insert(0, str(SAM3_ROOT))
+
+from sam3.model_builder import normalize_checkpoint_state_dict
+
+
+def _unshare(state_dict: dict) -> dict:
+    """Make tensors contiguous and give tensors sharing storage their own copy."""
+    seen = set()
+    result = {}
+    for key, value in state_dict.items():
+        value = value.contiguous()
+        ptr = value.untyped_storage().data_ptr()
+        if ptr in seen:
+            value = value.clone()
+        seen.add(ptr)
+        result[key] = value
+    return result
+
+
+def convert_checkpoint(src: str, dst: str, include_tracker: bool = True) -> int:
+    """
+    Convert ``src`` to a safetensors file at ``dst``.
+
+    Args:
+        src: Path to the .pt checkpoint
+        dst: Path of the .safetensors file to write
+        include_tracker: Keep the tracker weights (used by the instance
+            interactive predictor) of SAM3-format checkpoints
+
+    Returns:
+        Number of tensors written
+    """
+    try:
+        from safetensors.torch import save_file
+    except ImportError as e:
+        raise ImportError("Converting checkpoints requires the safetensors package (pip install safetensors)") from e
+
+    ckpt = torch.load(src, map_location="cpu", weights_only=False)
+    state_dict = normalize_checkpoint_state_dict(ckpt, include_tracker=include_tracker)
+    tensors = {k: v for k, v in state_dict.items() if isinstance(v, torch.Tensor)}
+    skipped = len(state_dict) - len(tensors)
+    if skipped:
+        print(f"  Skipping {skipped} non-tensor entries")
+
+    save_file(_unshare(tensors), dst, metadata={"format": "pt", "source": Path(src).name})
+    return len(tensors)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a SAM3/MedSAM3 checkpoint to memory-mappable safetensors."
+    )
+    parser.add_argument("checkpoint", help="Path to the .pt checkpoint")
+    parser.add_argument(
+        "-o", "--output",
+        default=None,
+        help="Output path (default: checkpoint path with a .safetensors suffix)",
+    )
+    parser.add_argument(
+        "--drop-tracker",
+        action="store_true",
+        help="Leave out the tracker weights (not used by the image model)",
+    )
+    args = parser.parse_args()
+
+    output = args.output or str(Path(args.checkpoint).with_suffix(".safetensors"))
+    start = time.perf_counter()
+    count = convert_checkpoint(args.checkpoint, output, include_tracker=not args.drop_tracker)
+    print(f"Wrote {count} tensors to {output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
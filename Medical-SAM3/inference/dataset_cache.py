@@ -0,0 +1,255 @@
+"""
+Compiled, memory-mapped store of the benchmark datasets.
+
+The loaders of ``dataset_loaders`` decode every JPEG/PNG/BMP/.mat file on each
+run (and DSB18 merges dozens of instance masks per sample). Compiling a
+dataset runs its loader once and writes the decoded RGB images and binarized
+masks, as raw uint8, to shard files next to a JSON index:
+
+    CACHE_ROOT/<dataset>/
+    ├── index.json     # source fingerprint, sample ids, shard, offset and shape of each array
+    ├── shard_00000.bin
+    └── ...
+
+Reading memory-maps the shards: samples are views into the page cache, no
+file is decoded or copied, and repeated sweeps of a dataset are served from
+memory. ``dataset_loaders.load_dataset`` reads from the store when the
+dataset has been compiled.
+
+The index records a fingerprint of the dataset files (path, size and
+modification time) and of its loader. A store whose fingerprint no longer
+matches is treated as not compiled, so changed data or a fixed loader is
+never hidden by a stale store.
+
+Usage:
+    python dataset_cache.py [--datasets DATASET1,DATASET2] [--force]
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+try:
+    from inference.dataset_loaders import DATA_ROOT, DATASET_LOADERS, DATASET_PROMPTS, LOADER_VERSION, Sample
+except ModuleNotFoundError:
+    from dataset_loaders import DATA_ROOT, DATASET_LOADERS, DATASET_PROMPTS, LOADER_VERSION, Sample
+
+
+CACHE_ROOT = DATA_ROOT / "compiled"
+
+# Shards are closed once they exceed this size
+SHARD_BYTES = 1 << 30
+
+INDEX_VERSION = 2
+
+
+def source_fingerprint(dataset_name: str, data_root: Path = DATA_ROOT) -> str:
+    """
+    Fingerprint of what a dataset is compiled from: the relative path, size
+    and modification time of every file under ``data_root/<dataset>``, the
+    loader's source code and LOADER_VERSION.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    loader = DATASET_LOADERS[dataset_name]
+    try:
+        loader_source = inspect.getsource(loader)
+    except OSError:
+        loader_source = loader.__qualname__
+    digest.update(f"{LOADER_VERSION}\n{loader_source}\n".encode())
+
+    source_dir = Path(data_root) / dataset_name
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = Path(root) / name
+            stat = path.stat()
+            digest.update(f"{path.relative_to(source_dir)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class _ShardWriter:
+    """Append uint8 arrays to shard files, recording where each one went."""
+
+    def __init__(self, directory: Path, shard_bytes: int = SHARD_BYTES):
+        self.directory = directory
+        self.shard_bytes = shard_bytes
+        self.shards: List[str] = []
+        self._file = None
+
+    def write(self, array: np.ndarray) -> dict:
+        if self._file is None or self._file.tell() >= self.shard_bytes:
+            self._open_shard()
+        array = np.ascontiguousarray(array, dtype=np.uint8)
+        entry = {"shard": len(self.shards) - 1, "offset": self._file.tell(), "shape": list(array.shape)}
+        self._file.write(array.data)
+        return entry
+
+    def _open_shard(self):
+        self.close()
+        name = f"shard_{len(self.shards):05d}.bin"
+        self.shards.append(name)
+        self._file = open(self.directory / name, "wb")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def compile_dataset(dataset_name: str, cache_root: Path = CACHE_ROOT, force: bool = False) -> Path:
+    """
+    Decode a dataset once with its loader and write it to the store.
+
+    The index is written last (atomically), so an interrupted compilation
+    leaves no usable store behind. A store built from other files or by
+    another loader version is recompiled.
+
+    Args:
+        dataset_name: Name in ``DATASET_LOADERS``
+        cache_root: Directory holding the compiled datasets
+        force: Recompile if the dataset is already compiled and up to date
+
+    Returns:
+        Directory of the compiled dataset
+    """
+    if dataset_name not in DATASET_LOADERS:
+        raise ValueError(f"Unknown dataset: {dataset_name}. "
+                         f"Available: {list(DATASET_LOADERS.keys())}")
+    directory = Path(cache_root) / dataset_name
+    index_path = directory / "index.json"
+    # Taken before decoding: files changed meanwhile make the store stale
+    fingerprint = source_fingerprint(dataset_name)
+    if not force and _read_index(directory, fingerprint) is not None:
+        return directory
+
+    directory.mkdir(parents=True, exist_ok=True)
+    if index_path.exists():
+        index_path.unlink()
+    for stale in directory.glob("shard_*.bin"):
+        stale.unlink()
+
+    writer = _ShardWriter(directory)
+    samples = []
+    try:
+        for sample in DATASET_LOADERS[dataset_name]():
+            samples.append({
+                "sample_id": sample.sample_id,
+                "image": writer.write(sample.image),
+                # Loaders already binarize to 0/1
+                "mask": writer.write(sample.gt_mask > 0),
+            })
+    finally:
+        writer.close()
+
+    index = {
+        "version": INDEX_VERSION,
+        "dataset": dataset_name,
+        "fingerprint": fingerprint,
+        "text_prompt": DATASET_PROMPTS[dataset_name],
+        "shards": writer.shards,
+        "samples": samples,
+    }
+    tmp_path = index_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    return directory
+
+
+def _read_index(directory: Path, fingerprint: str) -> Optional[dict]:
+    """Index of a compiled dataset, None if missing, of an older version or stale."""
+    try:
+        with open(directory / "index.json") as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    if index.get("version") != INDEX_VERSION or index.get("fingerprint") != fingerprint:
+        return None
+    return index
+
+
+class CompiledDataset:
+    """
+    Read-only view of a compiled dataset.
+
+    Samples are built on access from memory-mapped shards: images and masks
+    are read-only views, nothing is decoded or copied.
+    """
+
+    def __init__(self, directory: Path, index: dict):
+        self.directory = directory
+        self.name = index["dataset"]
+        self.text_prompt = index["text_prompt"]
+        self.shard_names = index["shards"]
+        self.entries = index["samples"]
+        self._shards: Dict[int, np.memmap] = {}
+
+    @classmethod
+    def open(cls, dataset_name: str, cache_root: Path = CACHE_ROOT) -> Optional["CompiledDataset"]:
+        """
+        Open a compiled dataset, None if it has not been compiled, or was
+        compiled by an older version or from other source files or loader.
+        """
+        directory = Path(cache_root) / dataset_name
+        index = _read_index(directory, source_fingerprint(dataset_name))
+        return cls(directory, index) if index is not None else None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _array(self, entry: dict) -> np.ndarray:
+        shard = self._shards.get(entry["shard"])
+        if shard is None:
+            path = self.directory / self.shard_names[entry["shard"]]
+            shard = self._shards[entry["shard"]] = np.memmap(path, dtype=np.uint8, mode="r")
+        size = int(np.prod(entry["shape"]))
+        return shard[entry["offset"]:entry["offset"] + size].reshape(entry["shape"])
+
+    def __getitem__(self, index: int) -> Sample:
+        entry = self.entries[index]
+        return Sample(
+            image=self._array(entry["image"]),
+            gt_mask=self._array(entry["mask"]),
+            dataset_name=self.name,
+            sample_id=entry["sample_id"],
+            text_prompt=self.text_prompt,
+        )
+
+    def samples(self, max_samples: Optional[int] = None) -> Iterator[Sample]:
+        """Iterate over the first max_samples samples (all if None)."""
+        count = len(self) if not max_samples else min(max_samples, len(self))
+        for index in range(count):
+            yield self[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile datasets into memory-mapped stores")
+    parser.add_argument("--datasets", type=str, default=None,
+                        help="Comma-separated list of datasets to compile (default: all)")
+    parser.add_argument("--cache-dir", type=str, default=str(CACHE_ROOT),
+                        help=f"Directory of the compiled datasets (default: {CACHE_ROOT})")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompile datasets that are already compiled and up to date")
+    args = parser.parse_args()
+
+    if args.datasets:
+        datasets = [d.strip() for d in args.datasets.split(",")]
+    else:
+        datasets = list(DATASET_LOADERS.keys())
+
+    for dataset_name in datasets:
+        print(f"Compiling {dataset_name}...")
+        directory = compile_dataset(dataset_name, Path(args.cache_dir), args.force)
+        compiled = CompiledDataset.open(dataset_name, Path(args.cache_dir))
+        size = sum((directory / name).stat().st_size for name in compiled.shard_names)
+        print(f"  {len(compiled)} samples, {size / 1024**2:.1f} MB in {directory}")
+
+
+if __name__ == "__main__":
+    main()
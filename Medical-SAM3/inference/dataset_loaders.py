@@ -15,6 +15,10 @@ from PIL import Image
 # Base data directory - update this path to your local data location
 DATA_ROOT = Path("../medsam_data")
 
+# Bump when a change outside the loader functions alters the samples they
+# produce: compiled datasets (see dataset_cache) are then rebuilt
+LOADER_VERSION = 1
+
 # Text prompts for each dataset
 DATASET_PROMPTS = {
     "CHASE_DB1": "Retinal Blood Vessel",
@@ -454,6 +458,8 @@ def load_consep(max_samples: Optional[int] = None) -> Iterator[Sample]:
     Note: Both Train and Test sets are used for evaluation as requested.
     Labels are .mat files containing 'inst_map' which we convert to binary mask.
     """
+    import scipy.io
+
     dataset_dir = DATA_ROOT / "CoNSeP"
     subsets = ["Test", "Train"]
     
@@ -604,11 +610,24 @@ DATASET_LOADERS = {
 }
 
 
-def load_dataset(dataset_name: str, max_samples: Optional[int] = None) -> Iterator[Sample]:
-    """Load a dataset by name."""
+def load_dataset(dataset_name: str, max_samples: Optional[int] = None, use_cache: bool = True) -> Iterator[Sample]:
+    """
+    Load a dataset by name.
+
+    Compiled datasets (see ``dataset_cache``) are streamed from their
+    memory-mapped store instead of being decoded, unless use_cache is False.
+    """
     if dataset_name not in DATASET_LOADERS:
         raise ValueError(f"Unknown dataset: {dataset_name}. "
                          f"Available: {list(DATASET_LOADERS.keys())}")
+    if use_cache:
+        try:
+            from inference.dataset_cache import CompiledDataset
+        except ModuleNotFoundError:
+            from dataset_cache import CompiledDataset
+        compiled = CompiledDataset.open(dataset_name)
+        if compiled is not None:
+            return compiled.samples(max_samples)
     return DATASET_LOADERS[dataset_name](max_samples)
 
 
@@ -0,0 +1,480 @@
+"""
+DICOM input for Medical-SAM3.
+
+Studies are read straight from the DICOM files, without rasterizing them to
+PNG first:
+
+- Headers are parsed up front, pixel data only when frames are requested.
+  Uncompressed pixel data is memory-mapped (or viewed in place when the file
+  was uploaded as bytes), so a frame read touches only that frame's bytes.
+  Compressed or deflated transfer syntaxes, and pixels with fewer stored
+  than allocated bits, fall back to pydicom's decoders.
+- Files are grouped into series and sorted along the slice normal; multi-frame
+  files (including enhanced multi-frame with per-frame functional groups)
+  contribute one entry per frame.
+- Rescale slope/intercept and window/level are applied to whole batches of
+  frames at once as tensor ops on the inference device, producing the uint8
+  RGB batches ``Sam3Processor.set_image_batch`` takes.
+- Pixel spacing and slice spacing are kept, so mask areas and volumes can be
+  reported in mm² and mL (see ``mask_stats``).
+
+Requires pydicom (pip install pydicom), plus pydicom's optional pixel data
+handlers for compressed files.
+"""
+
+import io
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+PIXEL_DATA_TAG = 0x7FE00010
+# Native (not encapsulated) pixel data that is still not stored as is: the
+# element offsets of a deflated dataset refer to the inflated stream
+UNMAPPABLE_TRANSFER_SYNTAXES = (
+    "1.2.840.10008.1.2.1.99",  # Deflated Explicit VR Little Endian
+    "1.2.840.10008.1.2.2",     # Explicit VR Big Endian
+)
+
+Source = Union[str, Path, bytes]
+
+
+def _pydicom():
+    try:
+        import pydicom
+    except ImportError as e:
+        raise ImportError("Reading DICOM files requires the pydicom package (pip install pydicom)") from e
+    return pydicom
+
+
+def is_dicom(content: bytes) -> bool:
+    """True if the bytes start with a DICOM Part 10 preamble."""
+    return len(content) >= 132 and content[128:132] == b"DICM"
+
+
+def _first(value, default=None):
+    """First value of a possibly multi-valued DICOM attribute."""
+    if value is None or value == "":
+        return default
+    if isinstance(value, (list, tuple)) or type(value).__name__ == "MultiValue":
+        return float(value[0]) if len(value) else default
+    return float(value)
+
+
+def _functional_group(ds, frame: int, sequence: str):
+    """
+    Item of a functional group sequence of an enhanced multi-frame dataset,
+    per-frame if present, shared otherwise (None for classic datasets).
+    """
+    for groups, index in (("PerFrameFunctionalGroupsSequence", frame), ("SharedFunctionalGroupsSequence", 0)):
+        items = getattr(ds, groups, None)
+        if items is not None and len(items) > index:
+            group = getattr(items[index], sequence, None)
+            if group:
+                return group[0]
+    return None
+
+
+def _attribute(ds, frame: int, sequence: str, name: str, default=None):
+    """Attribute from a functional group, falling back to the top-level dataset."""
+    group = _functional_group(ds, frame, sequence)
+    if group is not None and name in group:
+        return getattr(group, name)
+    return getattr(ds, name, default)
+
+
+class DicomFile:
+    """
+    One DICOM file, with its pixel data read lazily.
+
+    Args:
+        source: File path or the file content
+    """
+
+    def __init__(self, source: Source):
+        pydicom = _pydicom()
+        self.source = source
+        fp = io.BytesIO(source) if isinstance(source, bytes) else str(source)
+        # Defers the pixel data: only its offset is recorded
+        self.dataset = pydicom.dcmread(fp, defer_size=1024, force=True)
+        ds = self.dataset
+        self.num_frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
+        self.rows = int(ds.Rows)
+        self.columns = int(ds.Columns)
+        self.samples_per_pixel = int(getattr(ds, "SamplesPerPixel", 1))
+        self.photometric = str(getattr(ds, "PhotometricInterpretation", "MONOCHROME2"))
+        self._pixels = None
+
+    @property
+    def series_uid(self) -> str:
+        return str(getattr(self.dataset, "SeriesInstanceUID", ""))
+
+    def _stored_dtype(self) -> Optional[np.dtype]:
+        """Numpy dtype of the stored pixels, None if they cannot be mapped."""
+        ds = self.dataset
+        transfer_syntax = getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", None)
+        if transfer_syntax is not None:
+            encapsulated = getattr(transfer_syntax, "is_encapsulated", None)
+            if encapsulated is None:
+                encapsulated = getattr(transfer_syntax, "is_compressed", False)
+            if encapsulated or transfer_syntax in UNMAPPABLE_TRANSFER_SYNTAXES:
+                return None
+        bits = int(getattr(ds, "BitsAllocated", 0))
+        if bits not in (8, 16, 32):
+            return None
+        # Fewer stored bits need masking (and sign extension), left to pydicom
+        bits_stored = int(getattr(ds, "BitsStored", bits) or bits)
+        high_bit = int(getattr(ds, "HighBit", bits_stored - 1))
+        if bits_stored != bits or high_bit != bits - 1:
+            return None
+        signed = int(getattr(ds, "PixelRepresentation", 0)) == 1
+        return np.dtype(f"<{'i' if signed else 'u'}{bits // 8}")
+
+    def _map_pixels(self) -> Optional[np.ndarray]:
+        """(frames, rows, columns[, samples]) view on the stored pixels, without reading them."""
+        dtype = self._stored_dtype()
+        element = self.dataset.get_item(PIXEL_DATA_TAG)
+        offset = getattr(element, "value_tell", None)
+        if dtype is None or offset is None:
+            return None
+
+        samples = self.samples_per_pixel
+        planar = samples > 1 and int(getattr(self.dataset, "PlanarConfiguration", 0)) == 1
+        if samples == 1:
+            shape = (self.num_frames, self.rows, self.columns)
+        elif planar:
+            shape = (self.num_frames, samples, self.rows, self.columns)
+        else:
+            shape = (self.num_frames, self.rows, self.columns, samples)
+        count = int(np.prod(shape))
+
+        if isinstance(self.source, bytes):
+            pixels = np.frombuffer(self.source, dtype=dtype, count=count, offset=offset)
+        else:
+            pixels = np.memmap(self.source, dtype=dtype, mode="r", offset=offset, shape=(count,))
+        pixels = pixels.reshape(shape)
+        return pixels.transpose(0, 2, 3, 1) if planar else pixels
+
+    def _decode_frame(self, frame: int) -> np.ndarray:
+        """Decode a frame of compressed (or otherwise unmappable) pixel data."""
+        try:
+            from pydicom.pixels import pixel_array
+        except ImportError:
+            # pydicom < 3 decodes all frames at once
+            pixels = self.dataset.pixel_array
+            return pixels[frame] if self.num_frames > 1 else pixels
+
+        if isinstance(self.source, bytes):
+            return pixel_array(io.BytesIO(self.source), index=frame)
+        return pixel_array(str(self.source), index=frame)
+
+    def read_frames(self, frames: Sequence[int]) -> np.ndarray:
+        """
+        Stored pixel values of some frames.
+
+        Returns:
+            (n, rows, columns) array, (n, rows, columns, samples) for color images
+        """
+        if self._pixels is None:
+            mapped = self._map_pixels()
+            self._pixels = mapped if mapped is not None else False
+        if self._pixels is not False:
+            return np.asarray(self._pixels[list(frames)])
+        return np.stack([self._decode_frame(frame) for frame in frames])
+
+
+@dataclass
+class DicomFrame:
+    """One 2D frame of a series, with the values needed to display it."""
+
+    file: DicomFile
+    index: int
+    slope: float = 1.0
+    intercept: float = 0.0
+    window_center: Optional[float] = None
+    window_width: Optional[float] = None
+    position: Optional[Tuple[float, float, float]] = None
+    instance_number: int = 0
+
+    @classmethod
+    def from_file(cls, file: DicomFile, index: int) -> "DicomFrame":
+        ds = file.dataset
+        position = _attribute(ds, index, "PlanePositionSequence", "ImagePositionPatient")
+        return cls(
+            file=file,
+            index=index,
+            slope=_first(_attribute(ds, index, "PixelValueTransformationSequence", "RescaleSlope"), 1.0),
+            intercept=_first(_attribute(ds, index, "PixelValueTransformationSequence", "RescaleIntercept"), 0.0),
+            window_center=_first(_attribute(ds, index, "FrameVOILUTSequence", "WindowCenter")),
+            window_width=_first(_attribute(ds, index, "FrameVOILUTSequence", "WindowWidth")),
+            position=tuple(float(v) for v in position) if position else None,
+            instance_number=int(getattr(ds, "InstanceNumber", 0) or 0),
+        )
+
+
+def window_to_uint8(
+    pixels: torch.Tensor,
+    slope: torch.Tensor,
+    intercept: torch.Tensor,
+    center: torch.Tensor,
+    width: torch.Tensor,
+    invert: bool = False,
+) -> torch.Tensor:
+    """
+    Map stored values to 8-bit display values (DICOM linear VOI function).
+
+    Args:
+        pixels: (N, H, W) stored values
+        slope, intercept: (N,) modality rescale of each frame
+        center, width: (N,) window of each frame, NaN to use the frame's range
+        invert: MONOCHROME1 (low values are bright)
+
+    Returns:
+        (N, H, W) uint8 tensor on the device of ``pixels``
+    """
+    values = pixels.float().mul_(slope[:, None, None]).add_(intercept[:, None, None])
+
+    # Frames without a window use their own value range
+    missing = torch.isnan(center) | torch.isnan(width) | (width <= 0)
+    if missing.any():
+        flat = values.flatten(1)
+        low, high = flat.amin(dim=1), flat.amax(dim=1)
+        center = torch.where(missing, (low + high) / 2 + 0.5, center)
+        width = torch.where(missing, (high - low + 1).clamp_min(1), width)
+
+    scale = 1 / (width - 1).clamp_min(1)
+    values.sub_((center - 0.5)[:, None, None]).mul_(scale[:, None, None]).add_(0.5).clamp_(0, 1)
+    if invert:
+        values = 1 - values
+    return values.mul_(255).round_().to(torch.uint8)
+
+
+class DicomSeries:
+    """
+    The frames of one DICOM series in slice order.
+
+    Args:
+        frames: Frames in order
+        pixel_spacing: (row, column) spacing in mm, None if unknown
+        slice_spacing: Distance between consecutive frames in mm, None if unknown
+    """
+
+    def __init__(
+        self,
+        frames: List[DicomFrame],
+        pixel_spacing: Optional[Tuple[float, float]] = None,
+        slice_spacing: Optional[float] = None,
+    ):
+        if not frames:
+            raise ValueError("A DICOM series needs at least one frame")
+        self.frames = frames
+        self.pixel_spacing = pixel_spacing
+        self.slice_spacing = slice_spacing
+
+    @classmethod
+    def open(cls, source: Union[Source, Sequence[Source]], series_uid: Optional[str] = None) -> "DicomSeries":
+        """
+        Read the headers of a series.
+
+        Args:
+            source: DICOM file, file content, directory (searched recursively)
+                or list of files
+            series_uid: Series to keep when the files hold several; the one
+                with the most frames otherwise
+
+        Returns:
+            The series, its frames sorted along the slice normal (instance
+            number when positions are missing)
+        """
+        if isinstance(source, (str, Path)) and Path(source).is_dir():
+            sources = sorted(p for p in Path(source).rglob("*") if p.is_file())
+        elif isinstance(source, (str, Path, bytes)):
+            sources = [source]
+        else:
+            sources = list(source)
+
+        files = []
+        for item in sources:
+            if not isinstance(item, bytes):
+                with open(item, "rb") as f:
+                    if not is_dicom(f.read(132)):
+                        continue
+            files.append(DicomFile(item))
+        if not files:
+            raise ValueError("No DICOM files found")
+
+        by_series = {}
+        for file in files:
+            by_series.setdefault(file.series_uid, []).append(file)
+        if series_uid is not None:
+            if series_uid not in by_series:
+                raise ValueError(f"Series {series_uid} not found")
+            files = by_series[series_uid]
+        else:
+            files = max(by_series.values(), key=lambda group: sum(f.num_frames for f in group))
+
+        frames = [DicomFrame.from_file(file, index) for file in files for index in range(file.num_frames)]
+        normal = cls._slice_normal(files[0].dataset)
+        if normal is not None and all(frame.position is not None for frame in frames):
+            depths = [float(np.dot(normal, frame.position)) for frame in frames]
+            order = np.argsort(depths, kind="stable")
+            frames = [frames[i] for i in order]
+            gaps = np.diff(np.sort(depths))
+            slice_spacing = float(np.median(gaps)) if len(gaps) and np.median(gaps) > 0 else None
+        else:
+            frames.sort(key=lambda frame: (frame.instance_number, frame.index))
+            slice_spacing = None
+
+        ds = files[0].dataset
+        if slice_spacing is None:
+            slice_spacing = _first(
+                _attribute(ds, 0, "PixelMeasuresSequence", "SpacingBetweenSlices")
+            ) or _first(_attribute(ds, 0, "PixelMeasuresSequence", "SliceThickness"))
+        spacing = _attribute(ds, 0, "PixelMeasuresSequence", "PixelSpacing") or getattr(ds, "ImagerPixelSpacing", None)
+        pixel_spacing = (float(spacing[0]), float(spacing[1])) if spacing else None
+
+        return cls(frames, pixel_spacing, slice_spacing)
+
+    @staticmethod
+    def _slice_normal(ds) -> Optional[np.ndarray]:
+        orientation = _attribute(ds, 0, "PlaneOrientationSequence", "ImageOrientationPatient")
+        if not orientation or len(orientation) != 6:
+            return None
+        row, column = np.asarray(orientation[:3], dtype=float), np.asarray(orientation[3:], dtype=float)
+        return np.cross(row, column)
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """(frames, rows, columns)"""
+        first = self.frames[0].file
+        return len(self.frames), first.rows, first.columns
+
+    def read(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """Stored pixel values of frames [start, stop), read in as few file accesses as possible."""
+        frames = self.frames[start:stop]
+        chunks, run = [], []
+        for frame in frames:
+            if run and frame.file is not run[0].file:
+                chunks.append(run[0].file.read_frames([f.index for f in run]))
+                run = []
+            run.append(frame)
+        if run:
+            chunks.append(run[0].file.read_frames([f.index for f in run]))
+        return np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+
+    def display(
+        self,
+        start: int = 0,
+        stop: Optional[int] = None,
+        device: str = "cpu",
+        window: Optional[Tuple[float, float]] = None,
+    ) -> torch.Tensor:
+        """
+        Frames [start, stop) as 8-bit RGB, windowed on ``device``.
+
+        Args:
+            window: (center, width) overriding the windows stored in the files
+
+        Returns:
+            (n, 3, H, W) uint8 tensor (grayscale frames are expanded views)
+        """
+        frames = self.frames[start:stop]
+        pixels = self.read(start, stop)
+        if pixels.dtype == np.uint16:
+            # No unsigned 16-bit tensors in older torch releases
+            pixels = pixels.astype(np.int32)
+        elif pixels.dtype == np.uint32:
+            pixels = pixels.astype(np.int64)
+        pixels = torch.from_numpy(np.ascontiguousarray(pixels)).to(device, non_blocking=True)
+
+        if frames[0].file.samples_per_pixel > 1:
+            # Color images (ultrasound, endoscopy) are displayed as stored
+            return pixels.to(torch.uint8).permute(0, 3, 1, 2)
+
+        def column(values):
+            return torch.tensor(values, dtype=torch.float32, device=device)
+
+        centers = [window[0] if window else f.window_center for f in frames]
+        widths = [window[1] if window else f.window_width for f in frames]
+        display = window_to_uint8(
+            pixels,
+            column([f.slope for f in frames]),
+            column([f.intercept for f in frames]),
+            column([float("nan") if c is None else c for c in centers]),
+            column([float("nan") if w is None else w for w in widths]),
+            invert=frames[0].file.photometric == "MONOCHROME1",
+        )
+        return display[:, None].expand(-1, 3, -1, -1)
+
+    def batches(
+        self,
+        batch_size: int = 8,
+        device: str = "cpu",
+        window: Optional[Tuple[float, float]] = None,
+    ) -> Iterator[Tuple[int, torch.Tensor]]:
+        """Yield (start, display batch) over the series, see ``display``."""
+        for start in range(0, len(self), batch_size):
+            yield start, self.display(start, start + batch_size, device, window)
+
+    def image(self, index: int = 0, window: Optional[Tuple[float, float]] = None) -> np.ndarray:
+        """One frame as an (H, W, 3) uint8 array, e.g. for overlays."""
+        return self.display(index, index + 1, "cpu", window)[0].permute(1, 2, 0).numpy()
+
+
+def mask_stats(
+    masks: np.ndarray,
+    pixel_spacing: Optional[Tuple[float, float]],
+    slice_spacing: Optional[float] = None,
+) -> dict:
+    """
+    Physical size of predicted masks.
+
+    Args:
+        masks: (H, W) mask or (N, H, W) masks of consecutive frames, at the
+            resolution ``pixel_spacing`` refers to
+        pixel_spacing: (row, column) spacing in mm
+        slice_spacing: Distance between frames in mm, for the volume
+
+    Returns:
+        "pixel_spacing_mm", "area_mm2" (summed over frames) and "diameter_mm"
+        (largest in-plane bounding box side), plus "volume_ml" for several
+        frames with a known slice spacing. Empty without pixel spacing.
+    """
+    if pixel_spacing is None:
+        return {}
+    row_mm, col_mm = pixel_spacing
+    masks = masks > 0
+    stats = {
+        "pixel_spacing_mm": [round(row_mm, 4), round(col_mm, 4)],
+        "area_mm2": round(float(masks.sum()) * row_mm * col_mm, 2),
+    }
+
+    ys, xs = np.nonzero(masks.any(axis=0) if masks.ndim == 3 else masks)
+    if len(xs):
+        stats["diameter_mm"] = round(max((xs.max() - xs.min()) * col_mm, (ys.max() - ys.min()) * row_mm), 2)
+    else:
+        stats["diameter_mm"] = 0.0
+
+    if masks.ndim == 3 and slice_spacing:
+        stats["slice_spacing_mm"] = round(slice_spacing, 4)
+        stats["volume_ml"] = round(stats["area_mm2"] * slice_spacing / 1000, 3)
+    return stats
+
+
+def scaled_spacing(
+    pixel_spacing: Optional[Tuple[float, float]],
+    original_size: Tuple[int, int],
+    size: Tuple[int, int],
+) -> Optional[Tuple[float, float]]:
+    """Pixel spacing of an image resized from ``original_size`` to ``size`` (both (H, W))."""
+    if pixel_spacing is None:
+        return None
+    return (
+        pixel_spacing[0] * original_size[0] / size[0],
+        pixel_spacing[1] * original_size[1] / size[1],
+    )
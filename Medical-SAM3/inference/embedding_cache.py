@@ -0,0 +1,204 @@
+"""
+Content-addressed cache for SAM3 image embeddings.
+
+Stores the backbone outputs produced by ``Sam3Processor.set_image`` so that
+re-prompting the same image only pays for the grounding heads and not for
+the ViT backbone.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+def image_cache_key(image: np.ndarray, checkpoint_id: str, resolution: int) -> str:
+    """
+    Build a cache key from decoded pixels, checkpoint and model resolution.
+
+    Args:
+        image: Decoded image as numpy array (H, W, 3)
+        checkpoint_id: Identifier of the loaded weights
+        resolution: Input resolution of the model
+
+    Returns:
+        Hex digest identifying the embedding
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{image.shape}|{image.dtype}|{checkpoint_id}|{resolution}".encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+def _map_tensors(obj, fn, memo=None):
+    """Apply fn to every tensor in a nested dict/list/tuple, preserving aliasing."""
+    if memo is None:
+        memo = {}
+    if isinstance(obj, torch.Tensor):
+        if id(obj) not in memo:
+            memo[id(obj)] = fn(obj)
+        return memo[id(obj)]
+    if isinstance(obj, dict):
+        return {k: _map_tensors(v, fn, memo) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_map_tensors(v, fn, memo) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(_map_tensors(v, fn, memo) for v in obj)
+    return obj
+
+
+def tensor_keys(obj) -> set:
+    """(device, data pointer) of the distinct tensors of a nested structure."""
+    keys = set()
+    _map_tensors(obj, lambda t: keys.add((t.device, t.data_ptr())))
+    return keys
+
+
+def tensor_nbytes(obj, exclude: Optional[set] = None) -> int:
+    """
+    Total bytes held by the distinct tensors of a nested structure.
+
+    Args:
+        obj: Nested dict/list/tuple of tensors
+        exclude: ``tensor_keys`` of tensors owned elsewhere, not counted
+    """
+    seen = {}
+
+    def _count(t):
+        seen[(t.device, t.data_ptr())] = t.numel() * t.element_size()
+        return t
+
+    _map_tensors(obj, _count)
+    if exclude:
+        return sum(nbytes for key, nbytes in seen.items() if key not in exclude)
+    return sum(seen.values())
+
+
+class ImageEmbeddingCache:
+    """
+    LRU cache of image embeddings bounded by a byte budget.
+
+    Entries are kept on the inference device, or spilled to CPU memory when
+    ``offload_to_cpu`` is set and moved back on a hit.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        max_entries: Optional[int] = None,
+        offload_to_cpu: bool = False,
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            max_bytes: Memory budget for all cached embeddings
+            max_entries: Optional cap on the number of cached images
+            offload_to_cpu: Keep cached tensors in CPU memory instead of on device
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.offload_to_cpu = offload_to_cpu
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, device: Optional[str] = None) -> Optional[dict]:
+        """
+        Look up an embedding.
+
+        Args:
+            key: Key from ``image_cache_key``
+            device: Device to move offloaded tensors back to
+
+        Returns:
+            A fresh inference state, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            state, _ = entry
+
+        if self.offload_to_cpu and device is not None:
+            return _map_tensors(state, lambda t: t.to(device, non_blocking=True))
+        # Copy the containers so prompts added to the returned state do not
+        # leak back into the cached entry
+        return _map_tensors(state, lambda t: t)
+
+    def put(self, key: str, state: dict):
+        """
+        Store the image part of an inference state.
+
+        Args:
+            key: Key from ``image_cache_key``
+            state: State returned by ``Sam3Processor.set_image``
+        """
+        snapshot = {
+            "original_height": state["original_height"],
+            "original_width": state["original_width"],
+            "backbone_out": state["backbone_out"],
+        }
+        if self.offload_to_cpu:
+            snapshot = _map_tensors(snapshot, lambda t: t.to("cpu"))
+        else:
+            snapshot = _map_tensors(snapshot, lambda t: t)
+        nbytes = tensor_nbytes(snapshot)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (snapshot, nbytes)
+            self.current_bytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._entries and (
+            self.current_bytes > self.max_bytes
+            or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        ):
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+
+    def tensor_keys(self) -> set:
+        """``tensor_keys`` of every cached tensor, shared with states returned by ``get``."""
+        with self._lock:
+            snapshots = [state for state, _ in self._entries.values()]
+        return tensor_keys(snapshots)
+
+    def clear(self):
+        """Drop all cached embeddings."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        """Hit/miss counters and memory usage."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "offload_to_cpu": self.offload_to_cpu,
+            }
+
+    def __len__(self):
+        return len(self._entries)
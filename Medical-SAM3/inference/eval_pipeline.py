@@ -0,0 +1,360 @@
+"""
+Pipelined evaluation on the medical benchmark datasets.
+
+Three stages run concurrently, connected by bounded queues:
+
+1. Loading: dataset loaders run in background threads, decoding samples
+   ahead of the model. Up to ``loader_workers`` datasets are decoded at once
+   (the next datasets start while the current one is evaluated), and each
+   holds at most ``prefetch`` decoded samples.
+2. Inference: on the calling thread, samples are micro-batched into one
+   ``encode_images`` backbone pass. Box prompts run per image on views of the
+   batch features, and text prompts run in a single batched grounding pass.
+3. Metrics: mask resizing and metrics run in a thread pool, with at most
+   ``prefetch`` batches pending.
+
+Memory is therefore bounded by the queue depths, not by the dataset size.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+try:
+    from inference.dataset_loaders import DATASET_PROMPTS, Sample, load_dataset
+    from inference.metrics import compute_batch_metrics
+    from inference.prediction_store import PredictionStore, box_prompt, model_key, text_prompt
+    from inference.sam3_inference import generate_bbox_from_mask, resize_mask
+except ModuleNotFoundError:
+    from dataset_loaders import DATASET_PROMPTS, Sample, load_dataset
+    from metrics import compute_batch_metrics
+    from prediction_store import PredictionStore, box_prompt, model_key, text_prompt
+    from sam3_inference import generate_bbox_from_mask, resize_mask
+
+METRIC_NAMES = ("dice", "iou", "psnr", "ssim", "precision", "recall", "hd95", "nsd")
+
+# Metrics of samples without a prediction
+MISSING_PREDICTION = {name: 0.0 for name in METRIC_NAMES}
+MISSING_PREDICTION['hd95'] = float('inf')
+
+_DONE = object()
+
+
+class Prefetcher:
+    """
+    Iterate over a generator running in a background thread, at most
+    ``depth`` items ahead. Exceptions of the generator are re-raised on
+    iteration.
+    """
+
+    def __init__(self, iterable: Iterable, depth: int = 16):
+        self._queue = queue.Queue(maxsize=depth)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+            self._put(_DONE)
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item) -> bool:
+        # Poll so that close() can stop a producer blocked on a full queue
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self):
+        """Stop the producer, dropping the items not consumed yet."""
+        self._closed.set()
+
+
+def metric_rows(samples: List[Sample], pred_masks: List[Optional[np.ndarray]]) -> List[dict]:
+    """
+    Metrics of predictions resized to their ground truth, computed as one
+    batch per mask size. Samples without a prediction get MISSING_PREDICTION.
+    """
+    predicted = [i for i, mask in enumerate(pred_masks) if mask is not None]
+    preds = []
+    for i in predicted:
+        pred_mask, gt_mask = pred_masks[i], samples[i].gt_mask
+        preds.append(pred_mask if pred_mask.shape == gt_mask.shape else resize_mask(pred_mask, gt_mask.shape))
+    metrics = dict(zip(predicted, compute_batch_metrics(preds, [samples[i].gt_mask for i in predicted])))
+
+    rows = []
+    for i, sample in enumerate(samples):
+        if i in metrics:
+            values = {name: getattr(metrics[i], name) for name in METRIC_NAMES}
+        else:
+            values = MISSING_PREDICTION
+        rows.append({'sample_id': sample.sample_id, **values})
+    return rows
+
+
+def _batch_rows(samples: List[Sample], box_masks: List, text_masks: List) -> Tuple[List[dict], List[dict]]:
+    """Metric rows of a batch, run in the metrics pool. Samples without a box prediction have no box row."""
+    box_samples = [sample for sample, mask in zip(samples, box_masks) if mask is not None]
+    box_rows = metric_rows(box_samples, [mask for mask in box_masks if mask is not None])
+    return box_rows, metric_rows(samples, text_masks)
+
+
+def average_metrics(rows: List[dict]) -> dict:
+    """
+    Mean of each metric over the samples. Infinite PSNRs (perfect masks) are
+    ignored. HD95 is infinite when only one of the masks is empty (e.g. the
+    prompt found nothing): its mean is over the other samples, and these
+    misses are counted in ``hd95_misses`` so that they are not lost.
+    """
+    if not rows:
+        return {}
+    df = pd.DataFrame(rows)
+    return {
+        'dice': df['dice'].mean(),
+        'iou': df['iou'].mean(),
+        'psnr': df['psnr'].replace([np.inf, -np.inf], np.nan).mean(),
+        'ssim': df['ssim'].mean(),
+        'precision': df['precision'].mean(),
+        'recall': df['recall'].mean(),
+        'hd95': df['hd95'].replace([np.inf, -np.inf], np.nan).mean(),
+        'hd95_misses': int(np.isinf(df['hd95']).sum()),
+        'nsd': df['nsd'].mean(),
+        'n_samples': len(df),
+    }
+
+
+def dataset_result(dataset_name: str, box_rows: List[dict], text_rows: List[dict], label: Optional[str] = None) -> dict:
+    """Result of a dataset in the format of the evaluation reports, printing its summary (titled label)."""
+    results = {
+        'dataset': dataset_name,
+        'text_prompt': DATASET_PROMPTS[dataset_name],
+        'box_prompt': average_metrics(box_rows),
+        'text_prompt_results': average_metrics(text_rows),
+        'box_details': box_rows,
+        'text_details': text_rows,
+    }
+
+    print(f"\nResults for {label or dataset_name}:")
+    print(f"  Box Prompt:  Dice={results['box_prompt'].get('dice', 0):.2%}, "
+          f"IoU={results['box_prompt'].get('iou', 0):.2%}, "
+          f"SSIM={results['box_prompt'].get('ssim', 0):.4f}, "
+          f"HD95={results['box_prompt'].get('hd95', float('nan')):.1f} px "
+          f"({results['box_prompt'].get('hd95_misses', 0)} misses)")
+    print(f"  Text Prompt: Dice={results['text_prompt_results'].get('dice', 0):.2%}, "
+          f"IoU={results['text_prompt_results'].get('iou', 0):.2%}, "
+          f"SSIM={results['text_prompt_results'].get('ssim', 0):.4f}, "
+          f"HD95={results['text_prompt_results'].get('hd95', float('nan')):.1f} px "
+          f"({results['text_prompt_results'].get('hd95_misses', 0)} misses)")
+    return results
+
+
+def predict_encoded(sam3, batch: List[Sample], batch_state: dict) -> Tuple[List[Tuple], List[Tuple]]:
+    """
+    Box prompt (from the ground truth) and text prompt predictions of a batch
+    encoded by ``encode_images``, as (mask, score, box) per sample.
+
+    Every prompt starts by resetting the language features of the state, so
+    the same encoded batch can be prompted by several models sharing the
+    vision backbone.
+    """
+    box_predictions = [
+        sam3.best_prediction(sam3.ground_box(state, generate_bbox_from_mask(sample.gt_mask), sample.gt_mask.shape))
+        for sample, state in zip(batch, sam3.split_batch_state(batch_state))
+    ]
+    text_predictions = [
+        sam3.best_prediction(state)
+        for state in sam3.ground_text_batch(batch_state, [sample.text_prompt for sample in batch])
+    ]
+    return box_predictions, text_predictions
+
+
+def _micro_batches(samples: Iterable[Sample], batch_size: int) -> Iterator[List[Sample]]:
+    batch = []
+    for sample in samples:
+        batch.append(sample)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class PipelinedEvaluator:
+    """
+    Evaluate a model with box prompts (from the ground truth) and text
+    prompts, overlapping loading, inference and metrics.
+
+    With a prediction store, each prediction is persisted and samples whose
+    predictions are already stored are not run again (resuming interrupted
+    runs). Without a model (sam3=None), the metrics are recomputed from the
+    stored predictions of ``model`` alone, skipping samples without any.
+
+    Args:
+        sam3: SAM3Model to evaluate, None to rescore stored predictions
+        batch_size: Images per backbone pass
+        prefetch: Decoded samples held per dataset being loaded, and metric
+            batches pending
+        loader_workers: Datasets decoded concurrently
+        metric_workers: Threads computing metrics (default: CPU count)
+        store: PredictionStore to read and persist predictions
+        model: Model key of the predictions (default: ``model_key(sam3)``)
+    """
+
+    def __init__(
+        self,
+        sam3,
+        batch_size: int = 4,
+        prefetch: int = 16,
+        loader_workers: int = 2,
+        metric_workers: Optional[int] = None,
+        store: Optional[PredictionStore] = None,
+        model: Optional[str] = None,
+    ):
+        if sam3 is None and (store is None or model is None):
+            raise ValueError("Rescoring without a model needs a prediction store and a model key")
+        self.sam3 = sam3
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.loader_workers = max(1, loader_workers)
+        self.metric_workers = metric_workers or os.cpu_count() or 1
+        self.store = store
+        self.model = model or (model_key(sam3) if store is not None else None)
+
+    def run(self, dataset_names: List[str], max_samples: Optional[int] = None) -> Iterator[dict]:
+        """Evaluate each dataset in turn, yielding its result (see ``dataset_result``)."""
+        loaders = {}
+
+        def _start(index):
+            if index < len(dataset_names) and index not in loaders:
+                name = dataset_names[index]
+                loaders[index] = Prefetcher(load_dataset(name, max_samples), self.prefetch)
+
+        with ThreadPoolExecutor(self.metric_workers, thread_name_prefix="metrics") as metrics_pool:
+            try:
+                for index, dataset_name in enumerate(dataset_names):
+                    for ahead in range(index, index + self.loader_workers):
+                        _start(ahead)
+                    print(f"\n{'='*60}")
+                    print(f"Evaluating: {dataset_name}")
+                    print(f"Text Prompt: {DATASET_PROMPTS[dataset_name]}")
+                    print(f"{'='*60}")
+                    yield self._evaluate(dataset_name, loaders.pop(index), metrics_pool)
+            finally:
+                for loader in loaders.values():
+                    loader.close()
+
+    def _evaluate(self, dataset_name: str, samples: Prefetcher, metrics_pool: ThreadPoolExecutor) -> dict:
+        box_rows, text_rows = [], []
+        pending: List[Future] = []
+        counts = {"stored": 0, "missing": 0}
+
+        def _collect(future: Future):
+            box, text = future.result()
+            box_rows.extend(box)
+            text_rows.extend(text)
+
+        progress = tqdm(desc=dataset_name, unit="img")
+        for batch in _micro_batches(samples, self.batch_size):
+            # Samples without a foreground have no box prompt and are skipped
+            batch = [sample for sample in batch if generate_bbox_from_mask(sample.gt_mask) is not None]
+            if not batch:
+                continue
+            batch, box_masks, text_masks = self._predict(batch, counts)
+            if batch:
+                pending.append(metrics_pool.submit(_batch_rows, batch, box_masks, text_masks))
+            # Bound the predictions (and samples) held by pending metrics
+            while len(pending) > self.prefetch:
+                _collect(pending.pop(0))
+            progress.update(len(batch))
+        for future in pending:
+            _collect(future)
+        progress.close()
+
+        if counts["stored"]:
+            print(f"Reused the stored predictions of {counts['stored']} samples")
+        if counts["missing"]:
+            print(f"Skipped {counts['missing']} samples without stored predictions")
+        return dataset_result(dataset_name, box_rows, text_rows)
+
+    def _predict(self, batch: List[Sample], counts: dict) -> Tuple[List[Sample], List, List]:
+        """
+        Box and text prompt masks of a batch: stored ones are reused, the
+        others come from a single backbone pass (and are stored).
+        """
+        box_masks, text_masks = [None] * len(batch), [None] * len(batch)
+        todo = []
+        for i, sample in enumerate(batch):
+            records = self._stored(sample)
+            if records is None:
+                todo.append(i)
+            else:
+                box_masks[i], text_masks[i] = (PredictionStore.mask(record) for record in records)
+
+        counts["stored"] += len(batch) - len(todo)
+        if todo and self.sam3 is None:
+            counts["missing"] += len(todo)
+            kept = [i for i in range(len(batch)) if i not in todo]
+            return [batch[i] for i in kept], [box_masks[i] for i in kept], [text_masks[i] for i in kept]
+
+        if todo:
+            for i, (box, text) in zip(todo, self._run_model([batch[i] for i in todo])):
+                box_masks[i], text_masks[i] = box, text
+        return batch, box_masks, text_masks
+
+    def _stored(self, sample: Sample) -> Optional[Tuple[dict, dict]]:
+        """Stored box and text prompt records of a sample, None unless both are stored."""
+        if self.store is None:
+            return None
+        bbox = generate_bbox_from_mask(sample.gt_mask)
+        records = tuple(
+            self.store.get(sample.dataset_name, sample.sample_id, self.model, prompt)
+            for prompt in (box_prompt(bbox), text_prompt(sample.text_prompt))
+        )
+        return None if None in records else records
+
+    def _run_model(self, batch: List[Sample]) -> List[Tuple]:
+        """(box mask, text mask) of each sample of a batch, from a single backbone pass."""
+        start = time.perf_counter()
+        batch_state = self.sam3.encode_images([sample.image for sample in batch])
+        box_predictions, text_predictions = predict_encoded(self.sam3, batch, batch_state)
+
+        if self.store is not None:
+            # The backbone pass is shared: each sample is charged an equal part
+            time_s = (time.perf_counter() - start) / len(batch)
+            bboxes = [generate_bbox_from_mask(sample.gt_mask) for sample in batch]
+            for sample, bbox, box, text in zip(batch, bboxes, box_predictions, text_predictions):
+                for prompt, (mask, score, pred_box) in (
+                    (box_prompt(bbox), box),
+                    (text_prompt(sample.text_prompt), text),
+                ):
+                    self.store.add(sample.dataset_name, sample.sample_id, self.model, prompt,
+                                   mask, score, pred_box, time_s)
+        return [(box[0], text[0]) for box, text in zip(box_predictions, text_predictions)]
+
+
+def evaluate_dataset(sam3, dataset_name: str, max_samples: Optional[int] = None, **pipeline_kwargs) -> dict:
+    """Evaluate a single dataset, see ``PipelinedEvaluator``."""
+    return next(PipelinedEvaluator(sam3, **pipeline_kwargs).run([dataset_name], max_samples))
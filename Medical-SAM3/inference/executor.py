@@ -0,0 +1,113 @@
+"""
+Bounded executor for blocking inference work.
+
+Decoding, model calls and mask encoding run in a dedicated thread pool so
+the event loop keeps serving other requests (including /health). Admission
+is bounded: when too many requests are in flight, new ones are rejected
+right away with a retry hint instead of queueing without limit.
+"""
+
+import asyncio
+import functools
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class ExecutorOverloaded(Exception):
+    """Raised when the admission queue is full."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """Thread pool with bounded admission and queue metrics."""
+
+    def __init__(self, max_workers: int = 1, max_queue: int = 8):
+        """
+        Initialize the executor.
+
+        Args:
+            max_workers: Number of inference threads (one per device is a good default)
+            max_queue: Requests allowed to wait on top of the running ones
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self._latency_ema = None
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to free up, from the average request latency."""
+        latency = self._latency_ema or 1.0
+        waves = math.ceil(max(self.in_flight - self.max_workers + 1, 1) / self.max_workers)
+        return max(1, math.ceil(latency * waves))
+
+    @contextmanager
+    def admit(self):
+        """
+        Reserve a slot for one request for the duration of the block.
+
+        Raises:
+            ExecutorOverloaded: If all slots are taken
+        """
+        with self._lock:
+            if self.in_flight >= self.capacity:
+                self.rejected += 1
+                raise ExecutorOverloaded(self.retry_after())
+            self.in_flight += 1
+            self.admitted += 1
+
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.in_flight -= 1
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+                    self._latency_ema = (
+                        elapsed if self._latency_ema is None
+                        else 0.9 * self._latency_ema + 0.1 * elapsed
+                    )
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking function in the pool and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, functools.partial(fn, *args, **kwargs))
+
+    def stats(self) -> dict:
+        """Queue depth and request counters."""
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queue_depth": max(self.in_flight - self.max_workers, 0),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_latency_s": round(self._latency_ema, 3) if self._latency_ema is not None else None,
+            }
@@ -12,6 +12,7 @@ import numpy as np
 from PIL import Image
 import torch
 
+from dicom import DicomSeries, is_dicom, mask_stats
 from sam3_inference import SAM3Model, resize_mask
 
 
@@ -91,7 +92,11 @@ class InferenceGUI:
     def _browse_image(self):
         path = filedialog.askopenfilename(
             title="Select image",
-            filetypes=[("Images", "*.png;*.jpg;*.jpeg;*.bmp;*.tif;*.tiff")],
+            filetypes=[
+                ("Images", "*.png;*.jpg;*.jpeg;*.bmp;*.tif;*.tiff"),
+                ("DICOM", "*.dcm;*.dicom"),
+                ("All files", "*.*"),
+            ],
         )
         if path:
             self.image_path_var.set(path)
@@ -177,8 +182,16 @@ class InferenceGUI:
             device = "cpu"
 
         try:
-            image = Image.open(image_path).convert("RGB")
-            image_np = np.array(image)
+            pixel_spacing = None
+            with open(image_path, "rb") as f:
+                dicom = is_dicom(f.read(132))
+            if dicom:
+                series = DicomSeries.open(image_path)
+                image_np = series.image(len(series) // 2)
+                pixel_spacing = series.pixel_spacing
+            else:
+                image = Image.open(image_path).convert("RGB")
+                image_np = np.array(image)
 
             sam3 = self._get_or_create_model(checkpoint, device)
 
@@ -209,6 +222,9 @@ class InferenceGUI:
                 f"Saved overlay to:\n{overlay_path}\n\n"
                 f"Inference time: {infer_time:.3f}s"
             )
+            stats = mask_stats(pred_mask, pixel_spacing)
+            if stats:
+                msg += f"\nArea: {stats['area_mm2']} mm², diameter: {stats['diameter_mm']} mm"
             if load_time is not None:
                 msg += f"\nModel load time: {load_time:.3f}s (first run)"
             messagebox.showinfo("Done", msg)
@@ -0,0 +1,59 @@
+"""
+Decoding of uploaded images.
+
+An upload is decoded once into an RGB uint8 array, which is then handed to
+the model as is: ``Sam3Processor`` wraps the array without copying, moves it
+to the device and resizes it once to the model resolution (see
+``Sam3Processor.preprocess``). The array keeps the size masks are projected
+back to.
+
+JPEGs larger than the requested size are decoded at a reduced DCT scale
+(1/2, 1/4 or 1/8), which is much cheaper than decoding at full size and
+resizing afterwards.
+"""
+
+import io
+import math
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+
+class ImageTooLarge(ValueError):
+    """An upload has more pixels than the server accepts."""
+
+
+def decode_image(content: bytes, max_size: Optional[int] = 1024, max_pixels: Optional[int] = None) -> np.ndarray:
+    """
+    Decode an image to an RGB uint8 array, downscaling it if too large.
+
+    Args:
+        content: Encoded image bytes
+        max_size: Longest side of the result, None to keep the native resolution
+        max_pixels: Reject images with more pixels than this
+
+    Returns:
+        (H, W, 3) uint8 array
+
+    Raises:
+        ImageTooLarge: if the image exceeds max_pixels
+    """
+    image = Image.open(io.BytesIO(content))
+    width, height = image.size
+    if max_pixels is not None and width * height > max_pixels:
+        raise ImageTooLarge(f"Image of {width}x{height} exceeds {max_pixels} pixels")
+
+    if max_size is not None and max(width, height) > max_size:
+        ratio = max_size / max(width, height)
+        target = (int(width * ratio), int(height * ratio))
+        # Only JPEG supports it: decodes at the smallest DCT scale still >= target
+        image.draft("RGB", (math.ceil(width * ratio), math.ceil(height * ratio)))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if image.size != target:
+            image = image.resize(target, Image.Resampling.LANCZOS)
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    return np.asarray(image)
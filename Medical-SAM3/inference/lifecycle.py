@@ -0,0 +1,111 @@
+"""
+Model startup lifecycle.
+
+The model is built, loaded and warmed up in a background thread at startup,
+so that the server answers liveness probes right away and only reports
+itself ready once the first request will not pay for loading.
+"""
+
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+
+class ModelLifecycle:
+    """
+    Tracks the state, current stage and stage timings of the model startup.
+
+    The state goes from "not_started" to "loading", then "ready" or "failed".
+    """
+
+    def __init__(self):
+        self.state = "not_started"
+        self.stage: Optional[str] = None
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.timings = OrderedDict()
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @contextmanager
+    def stage_timer(self, name: str):
+        """Report ``name`` as the current stage and record how long it took."""
+        with self._lock:
+            self.stage = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.timings[f"{name}_s"] = round(time.perf_counter() - start, 3)
+
+    def record(self, timings: dict):
+        """Add timings measured elsewhere (e.g. by the model or a worker)."""
+        with self._lock:
+            self.timings.update(timings)
+
+    def mark_ready(self):
+        """Report ready without running a startup (lazy loading)."""
+        with self._lock:
+            self.state = "ready"
+        self._done.set()
+
+    def start(self, fn: Callable[["ModelLifecycle"], None]):
+        """
+        Run ``fn(self)`` in a background thread.
+
+        The lifecycle is ready when ``fn`` returns and failed if it raises.
+
+        Args:
+            fn: Builds, loads and warms up the model
+        """
+        with self._lock:
+            self.state = "loading"
+            self.started_at = time.time()
+        threading.Thread(target=self._run, args=(fn,), name="model-startup", daemon=True).start()
+
+    def _run(self, fn):
+        start = time.perf_counter()
+        try:
+            fn(self)
+        except Exception as e:
+            traceback.print_exc()
+            with self._lock:
+                self.state = "failed"
+                self.error = f"{type(e).__name__}: {e}"
+        else:
+            with self._lock:
+                self.state = "ready"
+                self.stage = None
+        finally:
+            with self._lock:
+                self.finished_at = time.time()
+                self.timings["total_s"] = round(time.perf_counter() - start, 3)
+            self._done.set()
+        print(f"Model startup {self.state} in {self.timings['total_s']}s: {dict(self.timings)}")
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until startup finished, returns whether the model is ready."""
+        self._done.wait(timeout)
+        return self.ready
+
+    def status(self) -> dict:
+        """State, current stage, elapsed time and per-stage timings."""
+        with self._lock:
+            end = self.finished_at or time.time()
+            return {
+                "state": self.state,
+                "ready": self.state == "ready",
+                "stage": self.stage,
+                "elapsed_s": round(end - self.started_at, 3) if self.started_at else None,
+                "timings": dict(self.timings),
+                "error": self.error,
+            }
@@ -0,0 +1,114 @@
+"""
+Compact encodings for predicted masks in API responses.
+
+PNG data URLs are what the frontend historically consumed; COCO RLE and
+bit-packed masks are much smaller for large images and leave overlay
+rendering to the client.
+"""
+
+import base64
+import io
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+MASK_FORMATS = ("png", "rle", "bits", "binary")
+
+
+def mask_to_png_data_url(mask: np.ndarray) -> str:
+    """Encode a binary mask as a single-channel PNG data URL."""
+    mask_img = Image.fromarray((mask > 0).astype(np.uint8) * 255)
+    buf = io.BytesIO()
+    mask_img.save(buf, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
+def _rle_counts(mask: np.ndarray) -> List[int]:
+    """Uncompressed COCO RLE counts (column-major, starting with a run of zeros)."""
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    if flat.size == 0:
+        return []
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate(([0], change, [flat.size]))
+    counts = np.diff(boundaries).tolist()
+    if flat[0]:
+        counts = [0] + counts
+    return counts
+
+
+def mask_to_rle(mask: np.ndarray) -> dict:
+    """
+    Encode a binary mask in COCO RLE format.
+
+    Uses the compressed encoder from ``sam3.agent.helpers.rle`` when torch and
+    pycocotools are available, and falls back to uncompressed counts otherwise.
+    Both forms are accepted by ``pycocotools.mask.frPyObjects``.
+
+    Args:
+        mask: Binary mask (H, W)
+
+    Returns:
+        Dict with "size" [H, W] and "counts"
+    """
+    try:
+        import torch
+        from sam3.agent.helpers.rle import robust_rle_encode
+    except ImportError:
+        return {"size": list(mask.shape[:2]), "counts": _rle_counts(mask)}
+
+    rle = robust_rle_encode(torch.from_numpy(np.ascontiguousarray(mask > 0))[None])[0]
+    return {"size": list(rle["size"]), "counts": rle["counts"]}
+
+
+def rle_to_mask(rle: dict) -> np.ndarray:
+    """
+    Decode a COCO RLE (compressed or uncompressed counts) made by ``mask_to_rle``.
+
+    Args:
+        rle: Dict with "size" [H, W] and "counts"
+
+    Returns:
+        Binary mask (H, W) as uint8
+    """
+    height, width = rle["size"]
+    counts = rle["counts"]
+    if isinstance(counts, list):
+        values = np.arange(len(counts)) % 2
+        flat = np.repeat(values.astype(np.uint8), counts)
+        return flat.reshape((height, width), order="F")
+
+    try:
+        from pycocotools import mask as mask_util
+    except ImportError as e:
+        raise ImportError("Decoding compressed RLE requires pycocotools (pip install pycocotools)") from e
+    return mask_util.decode({"size": [height, width], "counts": counts.encode("utf-8")})
+
+
+def mask_to_bits(mask: np.ndarray) -> bytes:
+    """Pack a binary mask row-major, 8 pixels per byte (most significant bit first)."""
+    return np.packbits((mask > 0).ravel()).tobytes()
+
+
+def encode_mask(mask: np.ndarray, mask_format: str = "png") -> Optional[dict]:
+    """
+    Encode a mask for a JSON response.
+
+    Args:
+        mask: Binary mask (H, W)
+        mask_format: One of "png", "rle" or "bits"
+
+    Returns:
+        Dict with the format, mask size and encoded data
+    """
+    height, width = mask.shape[:2]
+    if mask_format == "png":
+        data = mask_to_png_data_url(mask)
+    elif mask_format == "rle":
+        data = mask_to_rle(mask)["counts"]
+    elif mask_format == "bits":
+        data = base64.b64encode(mask_to_bits(mask)).decode("utf-8")
+    else:
+        raise ValueError(f"Unsupported mask format for JSON responses: {mask_format}")
+
+    return {"format": mask_format, "size": [int(height), int(width)], "data": data}
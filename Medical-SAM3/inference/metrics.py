@@ -1,13 +1,33 @@
 """
 Evaluation metrics for medical image segmentation.
-Includes: Dice, IoU, PSNR, SSIM
+Includes: Dice, IoU, precision, recall, PSNR, SSIM, HD95, NSD
+
+Metrics are computed for a whole batch of masks at once, given as NumPy
+arrays or torch tensors (on CPU or GPU):
+- Dice, IoU, precision, recall and PSNR derive from one set of per-mask
+  confusion counts
+- SSIM is the windowed SSIM of Wang et al. (Gaussian window, separable
+  filtering)
+- HD95 and NSD use one distance transform for the batch (the Triton EDT of
+  ``sam3.model.edt`` for CUDA tensors, OpenCV otherwise)
 """
 
+import sys
 import numpy as np
-from typing import Tuple
+from typing import List, Sequence, Tuple
 from dataclasses import dataclass
 
 
+# SSIM: Gaussian window of Wang et al. (2004), constants for a data range of 1
+SSIM_WINDOW = 11
+SSIM_SIGMA = 1.5
+SSIM_C1 = 0.01 ** 2
+SSIM_C2 = 0.03 ** 2
+
+# NSD: distance (pixels) within which boundary pixels count as matched
+NSD_TOLERANCE = 2.0
+
+
 @dataclass
 class SegmentationMetrics:
     """Container for segmentation metrics."""
@@ -17,6 +37,263 @@ class SegmentationMetrics:
     ssim: float
     precision: float
     recall: float
+    hd95: float = float('nan')  # Pixels, inf if only one of the masks is empty
+    nsd: float = float('nan')
+
+
+def _is_tensor(masks) -> bool:
+    torch = sys.modules.get("torch")
+    return torch is not None and isinstance(masks, torch.Tensor)
+
+
+def _as_batch(masks):
+    """Boolean (B, H, W) batch of masks given as (H, W), (B, H, W) or (B, 1, H, W)."""
+    if _is_tensor(masks):
+        import torch
+        is_bool = masks.dtype == torch.bool
+    else:
+        masks = np.asarray(masks)
+        is_bool = masks.dtype == bool
+    if masks.ndim == 2:
+        masks = masks[None]
+    elif masks.ndim == 4:
+        masks = masks[:, 0]
+    return masks if is_bool else masks != 0
+
+
+def _single(mask):
+    """Batch of one mask, ignoring singleton dimensions."""
+    return _as_batch(mask.squeeze() if _is_tensor(mask) else np.squeeze(mask))
+
+
+def _to_numpy(values) -> np.ndarray:
+    return values.detach().cpu().numpy() if _is_tensor(values) else np.asarray(values)
+
+
+def confusion_counts(pred, gt) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute per-mask confusion counts of a batch.
+
+    Args:
+        pred: Prediction masks (B, H, W), nonzero is foreground
+        gt: Ground truth masks (B, H, W)
+
+    Returns:
+        (tp, fp, fn, tn) int64 arrays of shape (B,)
+    """
+    pred, gt = _as_batch(pred), _as_batch(gt)
+    if _is_tensor(pred):
+        import torch
+        counts = _to_numpy(torch.stack([(pred & gt).sum((1, 2)), pred.sum((1, 2)), gt.sum((1, 2))]))
+    else:
+        counts = np.stack([
+            np.count_nonzero(pred & gt, axis=(1, 2)),
+            np.count_nonzero(pred, axis=(1, 2)),
+            np.count_nonzero(gt, axis=(1, 2)),
+        ])
+    tp, pred_sum, gt_sum = counts.astype(np.int64)
+    fp = pred_sum - tp
+    fn = gt_sum - tp
+    tn = pred.shape[1] * pred.shape[2] - tp - fp - fn
+    return tp, fp, fn, tn
+
+
+def _overlap_metrics(tp, fp, fn, tn) -> dict:
+    """Dice, IoU, precision, recall and PSNR arrays from confusion counts."""
+    tp, fp, fn, tn = (np.asarray(c, dtype=np.float64) for c in (tp, fp, fn, tn))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Both masks empty: Dice and IoU are 1, precision and recall 0
+        dice = np.where(tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 1.0)
+        iou = np.where(tp + fp + fn > 0, tp / (tp + fp + fn), 1.0)
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        # For binary masks (max value 1) the MSE is the fraction of mismatched pixels
+        mse = (fp + fn) / (tp + fp + fn + tn)
+        psnr = np.where(mse > 0, -10 * np.log10(mse), np.inf)
+    return {'dice': dice, 'iou': iou, 'precision': precision, 'recall': recall, 'psnr': psnr}
+
+
+def _gaussian_window(size: int, sigma: float = SSIM_SIGMA) -> np.ndarray:
+    x = np.arange(size) - (size - 1) / 2
+    window = np.exp(-x ** 2 / (2 * sigma ** 2))
+    return window / window.sum()
+
+
+def _filter_valid(maps, window: np.ndarray):
+    """Separable 'valid' filtering of (B, C, H, W) maps with a 1D window, along W then H."""
+    if _is_tensor(maps):
+        import torch
+        import torch.nn.functional as F
+
+        channels = maps.shape[1]
+        kernel = torch.as_tensor(window, dtype=maps.dtype, device=maps.device)
+        maps = F.conv2d(maps, kernel.view(1, 1, 1, -1).repeat(channels, 1, 1, 1), groups=channels)
+        return F.conv2d(maps, kernel.view(1, 1, -1, 1).repeat(channels, 1, 1, 1), groups=channels)
+
+    # One shifted multiply-add per tap: no (H, W, k) intermediate
+    window = window.astype(maps.dtype)
+    width = maps.shape[-1] - len(window) + 1
+    maps = sum(weight * maps[..., i:i + width] for i, weight in enumerate(window))
+    height = maps.shape[-2] - len(window) + 1
+    return sum(weight * maps[..., i:i + height, :] for i, weight in enumerate(window))
+
+
+def _ssim(pred, gt, window_size: int = SSIM_WINDOW) -> np.ndarray:
+    """Mean windowed SSIM of each pair of a boolean (B, H, W) batch."""
+    window = _gaussian_window(min(window_size, pred.shape[1], pred.shape[2]))
+    if _is_tensor(pred):
+        import torch
+        x, y = pred.float(), gt.float()
+        maps = torch.stack([x, y, x * y], dim=1)
+    else:
+        x, y = pred.astype(np.float32), gt.astype(np.float32)
+        maps = np.stack([x, y, x * y], axis=1)
+
+    # Binary masks: E[x^2] = E[x], so three filtered maps give all the moments
+    filtered = _filter_valid(maps, window)
+    mu_x, mu_y, e_xy = filtered[:, 0], filtered[:, 1], filtered[:, 2]
+    sigma_x = mu_x - mu_x * mu_x
+    sigma_y = mu_y - mu_y * mu_y
+    sigma_xy = e_xy - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + SSIM_C1) * (2 * sigma_xy + SSIM_C2)) / (
+        (mu_x * mu_x + mu_y * mu_y + SSIM_C1) * (sigma_x + sigma_y + SSIM_C2)
+    )
+    return _to_numpy(ssim_map.mean((1, 2))).astype(np.float64)
+
+
+def _boundaries(masks):
+    """Boundary pixels of a boolean (B, H, W) batch: foreground with a background 4-neighbour."""
+    if _is_tensor(masks):
+        import torch
+        import torch.nn.functional as F
+        padded = F.pad(masks.to(torch.uint8), (1, 1, 1, 1)).bool()
+    else:
+        padded = np.pad(masks, ((0, 0), (1, 1), (1, 1)))
+    interior = padded[:, :-2, 1:-1] & padded[:, 2:, 1:-1] & padded[:, 1:-1, :-2] & padded[:, 1:-1, 2:]
+    return masks & ~interior
+
+
+def _distance_to(boundaries):
+    """Euclidean distance of every pixel to the nearest boundary pixel of its mask."""
+    if _is_tensor(boundaries) and boundaries.is_cuda:
+        from sam3.model.edt import edt_triton
+        return edt_triton(~boundaries)
+
+    try:
+        import cv2
+    except ImportError as e:
+        raise ImportError("Boundary metrics require OpenCV (pip install opencv-python)") from e
+    return np.stack([
+        cv2.distanceTransform((~b).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+        for b in _to_numpy(boundaries)
+    ])
+
+
+def _boundary_metrics(pred, gt, tolerance: float = NSD_TOLERANCE) -> Tuple[np.ndarray, np.ndarray]:
+    """HD95 and NSD of each pair of a boolean (B, H, W) batch."""
+    if _is_tensor(pred) and not pred.is_cuda:
+        # The CPU distance transform is OpenCV's
+        pred, gt = _to_numpy(pred), _to_numpy(gt)
+    pred_border, gt_border = _boundaries(pred), _boundaries(gt)
+    borders = [pred_border, gt_border]
+    if _is_tensor(pred):
+        import torch
+        distances = _distance_to(torch.cat(borders))
+    else:
+        distances = _distance_to(np.concatenate(borders))
+    to_pred, to_gt = distances[:len(pred)], distances[len(pred):]
+
+    # Only the distances at boundary pixels leave the device
+    pred_to_gt = _to_numpy(to_gt[pred_border])
+    gt_to_pred = _to_numpy(to_pred[gt_border])
+    n_pred = _to_numpy(pred_border.sum((1, 2)))
+    n_gt = _to_numpy(gt_border.sum((1, 2)))
+    pred_to_gt = np.split(pred_to_gt, np.cumsum(n_pred)[:-1])
+    gt_to_pred = np.split(gt_to_pred, np.cumsum(n_gt)[:-1])
+
+    hd95 = np.empty(len(pred))
+    nsd = np.empty(len(pred))
+    for i, (d_pred, d_gt) in enumerate(zip(pred_to_gt, gt_to_pred)):
+        if len(d_pred) == 0 or len(d_gt) == 0:
+            # Both empty is a perfect match, one empty has no finite distance
+            empty = len(d_pred) == len(d_gt)
+            hd95[i] = 0.0 if empty else np.inf
+            nsd[i] = 1.0 if empty else 0.0
+            continue
+        hd95[i] = max(np.percentile(d_pred, 95), np.percentile(d_gt, 95))
+        nsd[i] = ((d_pred <= tolerance).sum() + (d_gt <= tolerance).sum()) / (len(d_pred) + len(d_gt))
+    return hd95, nsd
+
+
+def compute_batch_metrics(
+    preds,
+    gts,
+    boundary: bool = True,
+    tolerance: float = NSD_TOLERANCE,
+    window_size: int = SSIM_WINDOW
+) -> List[SegmentationMetrics]:
+    """
+    Compute all segmentation metrics for a batch of masks.
+
+    Args:
+        preds: Prediction masks, as a (B, H, W) array/tensor or a sequence of
+            (H, W) masks (grouped by size into batches)
+        gts: Ground truth masks, same layout as preds
+        boundary: Also compute HD95 and NSD
+        tolerance: NSD tolerance in pixels
+        window_size: SSIM window size
+
+    Returns:
+        SegmentationMetrics of each pair
+    """
+    if isinstance(preds, (list, tuple)):
+        return _compute_grouped(preds, gts, boundary, tolerance, window_size)
+
+    pred, gt = _as_batch(preds), _as_batch(gts)
+    if tuple(pred.shape) != tuple(gt.shape):
+        raise ValueError(f"Prediction shape {tuple(pred.shape)} does not match ground truth {tuple(gt.shape)}")
+    overlap = _overlap_metrics(*confusion_counts(pred, gt))
+    ssim = _ssim(pred, gt, window_size)
+    if boundary:
+        hd95, nsd = _boundary_metrics(pred, gt, tolerance)
+    else:
+        hd95 = nsd = np.full(len(pred), np.nan)
+
+    return [
+        SegmentationMetrics(
+            dice=float(overlap['dice'][i]),
+            iou=float(overlap['iou'][i]),
+            psnr=float(overlap['psnr'][i]),
+            ssim=float(ssim[i]),
+            precision=float(overlap['precision'][i]),
+            recall=float(overlap['recall'][i]),
+            hd95=float(hd95[i]),
+            nsd=float(nsd[i]),
+        )
+        for i in range(len(pred))
+    ]
+
+
+def _compute_grouped(preds: Sequence, gts: Sequence, *args) -> List[SegmentationMetrics]:
+    """compute_batch_metrics of masks of different sizes, one batch per size."""
+    if len(preds) != len(gts):
+        raise ValueError(f"{len(preds)} predictions for {len(gts)} ground truth masks")
+    groups = {}
+    for i, gt in enumerate(gts):
+        groups.setdefault(tuple(_single(gt).shape), []).append(i)
+
+    results = [None] * len(preds)
+    for indices in groups.values():
+        if _is_tensor(preds[indices[0]]):
+            import torch
+            pred = torch.cat([_single(preds[i]) for i in indices])
+            gt = torch.cat([_single(gts[i]) for i in indices])
+        else:
+            pred = np.concatenate([_single(preds[i]) for i in indices])
+            gt = np.concatenate([_single(gts[i]) for i in indices])
+        for i, metrics in zip(indices, compute_batch_metrics(pred, gt, *args)):
+            results[i] = metrics
+    return results
 
 
 def compute_dice(pred: np.ndarray, gt: np.ndarray) -> float:
@@ -30,16 +307,7 @@ def compute_dice(pred: np.ndarray, gt: np.ndarray) -> float:
     Returns:
         Dice score in [0, 1]
     """
-    pred = np.squeeze(pred).astype(bool)
-    gt = np.squeeze(gt).astype(bool)
-
-    intersection = np.logical_and(pred, gt).sum()
-    total = pred.sum() + gt.sum()
-
-    if total == 0:
-        return 1.0  # Both masks are empty
-
-    return 2 * intersection / total
+    return float(_overlap_metrics(*confusion_counts(_single(pred), _single(gt)))['dice'][0])
 
 
 def compute_iou(pred: np.ndarray, gt: np.ndarray) -> float:
@@ -53,16 +321,7 @@ def compute_iou(pred: np.ndarray, gt: np.ndarray) -> float:
     Returns:
         IoU score in [0, 1]
     """
-    pred = np.squeeze(pred).astype(bool)
-    gt = np.squeeze(gt).astype(bool)
-
-    intersection = np.logical_and(pred, gt).sum()
-    union = np.logical_or(pred, gt).sum()
-
-    if union == 0:
-        return 1.0  # Both masks are empty
-
-    return intersection / union
+    return float(_overlap_metrics(*confusion_counts(_single(pred), _single(gt)))['iou'][0])
 
 
 def compute_precision_recall(pred: np.ndarray, gt: np.ndarray) -> Tuple[float, float]:
@@ -76,17 +335,8 @@ def compute_precision_recall(pred: np.ndarray, gt: np.ndarray) -> Tuple[float, f
     Returns:
         (precision, recall) tuple
     """
-    pred = np.squeeze(pred).astype(bool)
-    gt = np.squeeze(gt).astype(bool)
-
-    tp = np.logical_and(pred, gt).sum()
-    fp = np.logical_and(pred, ~gt).sum()
-    fn = np.logical_and(~pred, gt).sum()
-
-    precision = tp / (tp + fp) if (tp + fp) > 0 else 0.0
-    recall = tp / (tp + fn) if (tp + fn) > 0 else 0.0
-
-    return precision, recall
+    overlap = _overlap_metrics(*confusion_counts(_single(pred), _single(gt)))
+    return float(overlap['precision'][0]), float(overlap['recall'][0])
 
 
 def compute_psnr(pred: np.ndarray, gt: np.ndarray) -> float:
@@ -102,26 +352,15 @@ def compute_psnr(pred: np.ndarray, gt: np.ndarray) -> float:
     Returns:
         PSNR in dB (higher is better)
     """
-    pred = np.squeeze(pred).astype(np.float64)
-    gt = np.squeeze(gt).astype(np.float64)
-
-    mse = np.mean((pred - gt) ** 2)
-
-    if mse == 0:
-        return float('inf')  # Perfect match
-
-    # For binary images, max value is 1
-    max_val = 1.0
-    psnr = 10 * np.log10(max_val ** 2 / mse)
+    return float(_overlap_metrics(*confusion_counts(_single(pred), _single(gt)))['psnr'][0])
 
-    return psnr
 
-
-def compute_ssim(pred: np.ndarray, gt: np.ndarray, window_size: int = 11) -> float:
+def compute_ssim(pred: np.ndarray, gt: np.ndarray, window_size: int = SSIM_WINDOW) -> float:
     """
     Compute Structural Similarity Index (SSIM) for binary masks.
 
-    Uses a simplified SSIM computation suitable for binary masks.
+    Local statistics are computed in a Gaussian window (sigma 1.5) over the
+    valid region of the masks, and the SSIM map is averaged.
 
     Args:
         pred: Binary prediction mask
@@ -131,29 +370,36 @@ def compute_ssim(pred: np.ndarray, gt: np.ndarray, window_size: int = 11) -> flo
     Returns:
         SSIM in [-1, 1] (1 is perfect)
     """
-    pred = np.squeeze(pred).astype(np.float64)
-    gt = np.squeeze(gt).astype(np.float64)
+    return float(_ssim(_single(pred), _single(gt), window_size)[0])
 
-    # Constants for stability
-    C1 = 0.01 ** 2
-    C2 = 0.03 ** 2
 
-    # Global statistics (simplified SSIM)
-    mu_pred = np.mean(pred)
-    mu_gt = np.mean(gt)
+def compute_hd95(pred: np.ndarray, gt: np.ndarray) -> float:
+    """
+    Compute the 95th percentile Hausdorff distance between mask boundaries.
 
-    sigma_pred = np.std(pred)
-    sigma_gt = np.std(gt)
+    Args:
+        pred: Binary prediction mask
+        gt: Binary ground truth mask
 
-    sigma_pred_gt = np.mean((pred - mu_pred) * (gt - mu_gt))
+    Returns:
+        HD95 in pixels (0 if both masks are empty, inf if only one is)
+    """
+    return float(_boundary_metrics(_single(pred), _single(gt))[0][0])
 
-    # SSIM formula
-    numerator = (2 * mu_pred * mu_gt + C1) * (2 * sigma_pred_gt + C2)
-    denominator = (mu_pred ** 2 + mu_gt ** 2 + C1) * (sigma_pred ** 2 + sigma_gt ** 2 + C2)
 
-    ssim = numerator / denominator
+def compute_nsd(pred: np.ndarray, gt: np.ndarray, tolerance: float = NSD_TOLERANCE) -> float:
+    """
+    Compute the normalized surface distance (surface Dice).
 
-    return ssim
+    Args:
+        pred: Binary prediction mask
+        gt: Binary ground truth mask
+        tolerance: Distance in pixels within which boundary pixels match
+
+    Returns:
+        Fraction of boundary pixels of either mask within tolerance of the other, in [0, 1]
+    """
+    return float(_boundary_metrics(_single(pred), _single(gt), tolerance)[1][0])
 
 
 def compute_all_metrics(pred: np.ndarray, gt: np.ndarray) -> SegmentationMetrics:
@@ -167,20 +413,7 @@ def compute_all_metrics(pred: np.ndarray, gt: np.ndarray) -> SegmentationMetrics
     Returns:
         SegmentationMetrics object
     """
-    dice = compute_dice(pred, gt)
-    iou = compute_iou(pred, gt)
-    psnr = compute_psnr(pred, gt)
-    ssim = compute_ssim(pred, gt)
-    precision, recall = compute_precision_recall(pred, gt)
-
-    return SegmentationMetrics(
-        dice=dice,
-        iou=iou,
-        psnr=psnr,
-        ssim=ssim,
-        precision=precision,
-        recall=recall
-    )
+    return compute_batch_metrics(_single(pred), _single(gt))[0]
 
 
 if __name__ == "__main__":
@@ -202,6 +435,8 @@ if __name__ == "__main__":
     print(f"  SSIM: {metrics.ssim:.4f}")
     print(f"  Precision: {metrics.precision:.4f}")
     print(f"  Recall: {metrics.recall:.4f}")
+    print(f"  HD95: {metrics.hd95:.2f} px")
+    print(f"  NSD: {metrics.nsd:.4f}")
 
     # Partial overlap
     pred_partial = np.zeros((100, 100), dtype=np.uint8)
@@ -214,6 +449,8 @@ if __name__ == "__main__":
     print(f"  SSIM: {metrics.ssim:.4f}")
     print(f"  Precision: {metrics.precision:.4f}")
     print(f"  Recall: {metrics.recall:.4f}")
+    print(f"  HD95: {metrics.hd95:.2f} px")
+    print(f"  NSD: {metrics.nsd:.4f}")
 
     # No overlap
     pred_none = np.zeros((100, 100), dtype=np.uint8)
@@ -226,6 +463,12 @@ if __name__ == "__main__":
     print(f"  SSIM: {metrics.ssim:.4f}")
     print(f"  Precision: {metrics.precision:.4f}")
     print(f"  Recall: {metrics.recall:.4f}")
+    print(f"  HD95: {metrics.hd95:.2f} px")
+    print(f"  NSD: {metrics.nsd:.4f}")
+
+    # Batch of the three predictions in one call
+    batch = compute_batch_metrics(np.stack([pred_perfect, pred_partial, pred_none]), np.stack([gt] * 3))
+    print(f"\nBatched Dice: {[round(m.dice, 4) for m in batch]}")
 
     print("\n" + "=" * 60)
     print("Metrics test complete!")
@@ -0,0 +1,172 @@
+"""
+Persisted per-sample predictions of evaluation runs.
+
+Each prediction is one JSON line (RLE mask, score, box, timing) keyed by
+(dataset, sample id, model, prompt), where the model key identifies the
+checkpoint by a hash of its content. Evaluation runs skip the keys already
+in the store, so an interrupted run resumes where it stopped, and metrics can
+be recomputed from the stored masks without running the model
+(``run_medsam3_evaluation.py --rescore``).
+
+The store is a directory of append-only segment files, one per open store:
+runs evaluating different datasets (or on different machines sharing the
+directory) never write to the same file. A line cut short by a
+crash is ignored when reading.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    from inference.mask_codec import mask_to_rle, rle_to_mask
+except ModuleNotFoundError:
+    from mask_codec import mask_to_rle, rle_to_mask
+
+
+def checkpoint_hash(checkpoint_path: str, chunk_size: int = 8 << 20) -> str:
+    """Hash of a checkpoint file's content (renaming or copying it keeps the key)."""
+    digest = hashlib.blake2b(digest_size=8)
+    with open(checkpoint_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_key(sam3) -> str:
+    """
+    Key of the predictions of a SAM3Model: checkpoint content hash, plus the
+    settings that change its outputs (precision and confidence threshold).
+    """
+    weights = checkpoint_hash(sam3.checkpoint_path) if sam3.checkpoint_path else "hf:facebook/sam3"
+    if sam3.precision != "fp32":
+        weights += f"@{sam3.precision}"
+    return f"{weights}#conf={sam3.confidence_threshold:g}"
+
+
+def box_prompt(bbox: Tuple[int, int, int, int]) -> str:
+    """Prompt key of a box prompt."""
+    return "box:" + ",".join(str(int(v)) for v in bbox)
+
+
+def text_prompt(prompt: str) -> str:
+    """Prompt key of a text prompt."""
+    return "text:" + prompt
+
+
+class PredictionStore:
+    """
+    Append-only store of predictions, indexed in memory on open.
+
+    Args:
+        directory: Store directory, created if needed
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._records: Dict[Tuple[str, str, str, str], dict] = {}
+        self._lock = threading.Lock()
+        self._segment = None
+        for path in sorted(self.directory.glob("*.jsonl")):
+            self._read_segment(path)
+
+    def _read_segment(self, path: Path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Torn write of a crashed run
+                self._records[self._key(record)] = record
+
+    @staticmethod
+    def _key(record: dict) -> Tuple[str, str, str, str]:
+        return record["dataset"], record["sample_id"], record["model"], record["prompt"]
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, key: Tuple[str, str, str, str]) -> bool:
+        return key in self._records
+
+    def get(self, dataset: str, sample_id: str, model: str, prompt: str) -> Optional[dict]:
+        """Stored record of a prediction, None if it has not been made."""
+        return self._records.get((dataset, sample_id, model, prompt))
+
+    def add(
+        self,
+        dataset: str,
+        sample_id: str,
+        model: str,
+        prompt: str,
+        mask: Optional[np.ndarray],
+        score: float = 0.0,
+        box: Optional[List[float]] = None,
+        time_s: Optional[float] = None
+    ) -> dict:
+        """
+        Append a prediction to this store's segment.
+
+        Args:
+            dataset: Dataset name
+            sample_id: Sample id in the dataset
+            model: Model key (see ``model_key``)
+            prompt: Prompt key (see ``box_prompt``, ``text_prompt``)
+            mask: Predicted binary mask, None if nothing was predicted
+            score: Score of the prediction
+            box: Predicted box (x_min, y_min, x_max, y_max) in pixels
+            time_s: Inference time of the sample
+
+        Returns:
+            The stored record
+        """
+        record = {
+            "dataset": dataset,
+            "sample_id": sample_id,
+            "model": model,
+            "prompt": prompt,
+            "mask": mask_to_rle(np.squeeze(mask)) if mask is not None else None,
+            "score": round(float(score), 6),
+            "box": [round(float(v), 2) for v in box] if box is not None else None,
+            "time_s": round(time_s, 6) if time_s is not None else None,
+        }
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._segment is None:
+                # Unique even for stores opened by one process in the same second
+                name = f"{socket.gethostname()}-{os.getpid()}-{int(time.time())}-{uuid.uuid4().hex[:8]}.jsonl"
+                self._segment = open(self.directory / name, "a")
+            self._segment.write(line)
+            self._segment.flush()
+            self._records[self._key(record)] = record
+        return record
+
+    def records(self, model: Optional[str] = None, dataset: Optional[str] = None) -> Iterator[dict]:
+        """Stored records, optionally of one model and/or dataset."""
+        for record in self._records.values():
+            if (model is None or record["model"] == model) and (dataset is None or record["dataset"] == dataset):
+                yield record
+
+    def models(self) -> List[str]:
+        """Model keys with stored predictions."""
+        return sorted({record["model"] for record in self._records.values()})
+
+    @staticmethod
+    def mask(record: dict) -> Optional[np.ndarray]:
+        """Decoded mask of a record, None if nothing was predicted."""
+        return rle_to_mask(record["mask"]) if record["mask"] is not None else None
+
+    def close(self):
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
@@ -20,19 +20,19 @@ import argparse
 import json
 from pathlib import Path
 from datetime import datetime
-from collections import defaultdict
 from typing import List, Optional
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
 # Add current directory to path
 sys.path.insert(0, str(Path(__file__).parent))
 
-from dataset_loaders import load_dataset, DATASET_LOADERS, DATASET_PROMPTS
-from sam3_inference import SAM3Model, generate_bbox_from_mask, resize_mask
-from metrics import compute_all_metrics, SegmentationMetrics
+import eval_pipeline
+from dataset_loaders import DATASET_LOADERS
+from eval_pipeline import PipelinedEvaluator
+from prediction_store import PredictionStore, model_key
+from sam3_inference import SAM3Model
 
 
 # Output directory
@@ -42,119 +42,15 @@ OUTPUT_DIR = Path(__file__).parent / "results"
 def evaluate_dataset(
     sam3: SAM3Model,
     dataset_name: str,
-    max_samples: Optional[int] = None
+    max_samples: Optional[int] = None,
+    **pipeline_kwargs
 ) -> dict:
     """
     Evaluate SAM3 on a single dataset.
 
     Returns dict with metrics for box and text prompts.
     """
-    print(f"\n{'='*60}")
-    print(f"Evaluating: {dataset_name}")
-    print(f"Text Prompt: {DATASET_PROMPTS[dataset_name]}")
-    print(f"{'='*60}")
-
-    # Metrics storage
-    box_metrics = []
-    text_metrics = []
-
-    # Load samples
-    samples = list(load_dataset(dataset_name, max_samples))
-    print(f"Loaded {len(samples)} samples")
-
-    for sample in tqdm(samples, desc=dataset_name):
-        img_size = sample.gt_mask.shape
-
-        # Encode image
-        inference_state = sam3.encode_image(sample.image)
-
-        # Generate bbox from GT
-        bbox = generate_bbox_from_mask(sample.gt_mask)
-        if bbox is None:
-            continue
-
-        # Box prompt inference
-        pred_mask_box = sam3.predict_box(inference_state, bbox, img_size)
-
-        if pred_mask_box is not None:
-            # Resize if needed
-            if pred_mask_box.shape != img_size:
-                pred_mask_box = resize_mask(pred_mask_box, img_size)
-
-            metrics_box = compute_all_metrics(pred_mask_box, sample.gt_mask)
-            box_metrics.append({
-                'sample_id': sample.sample_id,
-                'dice': metrics_box.dice,
-                'iou': metrics_box.iou,
-                'psnr': metrics_box.psnr,
-                'ssim': metrics_box.ssim,
-                'precision': metrics_box.precision,
-                'recall': metrics_box.recall,
-            })
-
-        # Text prompt inference
-        pred_mask_text = sam3.predict_text(inference_state, sample.text_prompt)
-
-        if pred_mask_text is not None:
-            if pred_mask_text.shape != img_size:
-                pred_mask_text = resize_mask(pred_mask_text, img_size)
-
-            metrics_text = compute_all_metrics(pred_mask_text, sample.gt_mask)
-            text_metrics.append({
-                'sample_id': sample.sample_id,
-                'dice': metrics_text.dice,
-                'iou': metrics_text.iou,
-                'psnr': metrics_text.psnr,
-                'ssim': metrics_text.ssim,
-                'precision': metrics_text.precision,
-                'recall': metrics_text.recall,
-            })
-        else:
-            # No text prediction
-            text_metrics.append({
-                'sample_id': sample.sample_id,
-                'dice': 0.0,
-                'iou': 0.0,
-                'psnr': 0.0,
-                'ssim': 0.0,
-                'precision': 0.0,
-                'recall': 0.0,
-            })
-
-    # Compute averages
-    def avg_metrics(metrics_list):
-        if not metrics_list:
-            return {}
-        df = pd.DataFrame(metrics_list)
-        return {
-            'dice': df['dice'].mean(),
-            'iou': df['iou'].mean(),
-            'psnr': df['psnr'].replace([np.inf, -np.inf], np.nan).mean(),
-            'ssim': df['ssim'].mean(),
-            'precision': df['precision'].mean(),
-            'recall': df['recall'].mean(),
-            'n_samples': len(df),
-        }
-
-    results = {
-        'dataset': dataset_name,
-        'text_prompt': DATASET_PROMPTS[dataset_name],
-        'box_prompt': avg_metrics(box_metrics),
-        'text_prompt_results': avg_metrics(text_metrics),
-        'box_details': box_metrics,
-        'text_details': text_metrics,
-    }
-
-    # Print summary
-    print(f"\nResults for {dataset_name}:")
-    print(f"  Box Prompt:  Dice={results['box_prompt'].get('dice', 0):.2%}, "
-          f"IoU={results['box_prompt'].get('iou', 0):.2%}, "
-          f"SSIM={results['box_prompt'].get('ssim', 0):.4f}")
-    print(f"  Text Prompt: Dice={results['text_prompt_results'].get('dice', 0):.2%}, "
-          f"IoU={results['text_prompt_results'].get('iou', 0):.2%}, "
-          f"SSIM={results['text_prompt_results'].get('ssim', 0):.4f}")
-
-    return results
+    return eval_pipeline.evaluate_dataset(sam3, dataset_name, max_samples, **pipeline_kwargs)
 
 
 def generate_report(all_results: List[dict], output_dir: Path):
@@ -242,7 +138,21 @@ def main():
                         help="Maximum samples per dataset (for testing)")
     parser.add_argument("--datasets", type=str, default=None,
                         help="Comma-separated list of datasets to evaluate")
+    parser.add_argument("--batch-size", type=int, default=4,
+                        help="Images per backbone pass")
+    parser.add_argument("--prefetch", type=int, default=16,
+                        help="Decoded samples held ahead of the model per dataset")
+    parser.add_argument("--loader-workers", type=int, default=2,
+                        help="Datasets decoded concurrently")
+    parser.add_argument("--metric-workers", type=int, default=None,
+                        help="Threads computing metrics (default: CPU count)")
+    parser.add_argument("--store", type=str, default=None,
+                        help="Prediction store directory: predictions are persisted and reruns resume")
+    parser.add_argument("--rescore", action="store_true",
+                        help="Recompute metrics from the stored predictions without running the model")
     args = parser.parse_args()
+    if args.rescore and not args.store:
+        parser.error("--rescore needs --store")
 
     print("=" * 60)
     print("SAM3 Zero-Shot Medical Image Segmentation Evaluation")
@@ -260,15 +170,23 @@ def main():
     # Initialize SAM3
     sam3 = SAM3Model(confidence_threshold=0.1)
 
-    # Evaluate each dataset
-    all_results = []
-    for dataset_name in datasets:
-        if dataset_name not in DATASET_LOADERS:
-            print(f"Unknown dataset: {dataset_name}, skipping...")
-            continue
-
-        result = evaluate_dataset(sam3, dataset_name, args.max_samples)
-        all_results.append(result)
+    unknown = [d for d in datasets if d not in DATASET_LOADERS]
+    if unknown:
+        print(f"Unknown datasets: {', '.join(unknown)}, skipping...")
+        datasets = [d for d in datasets if d in DATASET_LOADERS]
+
+    # The model is only loaded when a sample has to be run
+    store = PredictionStore(Path(args.store)) if args.store else None
+    evaluator = PipelinedEvaluator(
+        None if args.rescore else sam3,
+        batch_size=args.batch_size,
+        prefetch=args.prefetch,
+        loader_workers=args.loader_workers,
+        metric_workers=args.metric_workers,
+        store=store,
+        model=model_key(sam3) if store is not None else None,
+    )
+    all_results = list(evaluator.run(datasets, args.max_samples))
 
     # Generate report
     print("\n" + "=" * 60)
@@ -1,6 +1,12 @@
 """
 Run Medical-SAM3/SAM3 inference on a single image.
 Supports text prompt or box prompt input.
+
+DICOM files are read directly. A DICOM directory (or multi-frame file with
+--all-frames) is segmented frame by frame with a text prompt, and the masks
+are saved as a (frames, H, W) .npy stack. With --propagate, the text prompt
+is only run on a key slice and propagated through the series with the video
+predictor (see volume.py, needs CUDA).
 """
 
 import argparse
@@ -10,6 +16,7 @@ import numpy as np
 from PIL import Image
 import torch
 
+from dicom import DicomSeries, is_dicom, mask_stats
 from sam3_inference import SAM3Model, resize_mask
 
 
@@ -45,7 +52,7 @@ def main():
     parser = argparse.ArgumentParser(
         description="Run Medical-SAM3/SAM3 inference on a single image."
     )
-    parser.add_argument("--image", required=True, help="Path to input image")
+    parser.add_argument("--image", required=True, help="Path to input image, DICOM file or DICOM directory")
     parser.add_argument(
         "--checkpoint",
         default=None,
@@ -84,6 +91,34 @@ def main():
         help="Confidence threshold",
     )
 
+    parser.add_argument(
+        "--frame",
+        type=int,
+        default=None,
+        help="Frame of a DICOM series to segment (default: the middle one)",
+    )
+    parser.add_argument(
+        "--all-frames",
+        action="store_true",
+        help="Segment every frame of a DICOM series into a .npy mask stack",
+    )
+    parser.add_argument(
+        "--window",
+        default=None,
+        help="DICOM window as 'center,width' (default: the window stored in the files)",
+    )
+    parser.add_argument(
+        "--propagate",
+        action="store_true",
+        help="Segment a DICOM series by propagating from a key slice (--frame, default: the middle one)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=8,
+        help="DICOM frames per batch with --all-frames",
+    )
+
     args = parser.parse_args()
 
     if args.text is None and args.box is None:
@@ -96,8 +131,28 @@ def main():
     image_path = Path(args.image)
     output_path = Path(args.output)
 
-    image = Image.open(image_path).convert("RGB")
-    image_np = np.array(image)
+    window = tuple(float(v) for v in args.window.split(",")) if args.window else None
+
+    series = None
+    if image_path.is_dir():
+        series = DicomSeries.open(image_path)
+    else:
+        with open(image_path, "rb") as f:
+            if is_dicom(f.read(132)):
+                series = DicomSeries.open(image_path)
+
+    if series is not None and args.propagate:
+        if not args.text:
+            raise SystemExit("Propagating through a DICOM series needs --text.")
+        from volume import VolumeSegmenter
+
+        result = VolumeSegmenter(args.checkpoint).segment(series, args.text, key_slice=args.frame, window=window)
+        labels_path = output_path.with_suffix(".npy")
+        np.save(labels_path, result.labels)
+        print(f"Saved {len(result.labels)} slice labels to: {labels_path}")
+        for obj_id, stats in result.objects.items():
+            print(f"Object {obj_id}: {stats}")
+        return
 
     sam3 = SAM3Model(
         confidence_threshold=args.confidence,
@@ -105,6 +160,25 @@ def main():
         checkpoint_path=args.checkpoint,
     )
 
+    if series is not None and (args.all_frames or image_path.is_dir()):
+        if not args.text:
+            raise SystemExit("Segmenting a DICOM series needs --text.")
+        masks = sam3.segment_dicom(series, args.text, batch_size=args.batch_size, window=window)
+        masks_path = output_path.with_suffix(".npy")
+        np.save(masks_path, masks)
+        print(f"Saved {len(masks)} frame masks to: {masks_path}")
+        print(mask_stats(masks, series.pixel_spacing, series.slice_spacing))
+        return
+
+    pixel_spacing = None
+    if series is not None:
+        index = len(series) // 2 if args.frame is None else args.frame
+        image_np = series.image(index, window)
+        pixel_spacing = series.pixel_spacing
+    else:
+        image = Image.open(image_path).convert("RGB")
+        image_np = np.array(image)
+
     inference_state = sam3.encode_image(image_np)
 
     pred_mask = None
@@ -127,6 +201,8 @@ def main():
     save_overlay(image_np, pred_mask, overlay_path)
     print(f"Saved mask to: {output_path}")
     print(f"Saved overlay to: {overlay_path}")
+    if pixel_spacing is not None:
+        print(mask_stats(pred_mask, pixel_spacing))
 
 
 if __name__ == "__main__":
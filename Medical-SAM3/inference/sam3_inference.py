@@ -3,9 +3,13 @@ SAM3 inference module for medical image segmentation.
 Supports both box prompt and text prompt inference.
 """
 
+import functools
 import sys
+import threading
+import time
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Sequence, Tuple
 
 import numpy as np
 import torch
@@ -16,8 +20,27 @@ SAM3_ROOT = Path(__file__).resolve().parents[1] / "sam3"
 sys.path.insert(0, str(SAM3_ROOT))
 
 from sam3 import build_sam3_image_model
+from sam3.model_builder import (
+    load_safetensors_state_dict,
+    load_state_dict_into_model,
+    normalize_checkpoint_state_dict,
+    precompute_image_resolution,
+)
 from sam3.model.sam3_image_processor import Sam3Processor
 from sam3.model.box_ops import box_xywh_to_cxcywh
+from sam3.model.text_embedding_cache import TextEmbeddingCache
+from sam3.perflib.compile import compile_image_model, save_compile_artifacts
+
+try:
+    from inference.embedding_cache import ImageEmbeddingCache, _map_tensors, image_cache_key
+    from inference.tiling import TiledSegmenter
+    from inference.dicom import DicomSeries
+except ModuleNotFoundError:
+    from embedding_cache import ImageEmbeddingCache, _map_tensors, image_cache_key
+    from tiling import TiledSegmenter
+    from dicom import DicomSeries
+
+
 def normalize_bbox(bbox_xywh, img_w, img_h):
     # Assumes bbox_xywh is in XYWH format
     if isinstance(bbox_xywh, list):
@@ -44,6 +67,55 @@ def normalize_bbox(bbox_xywh, img_w, img_h):
     return normalized_bbox
 
 
+# Precision modes for CPU inference:
+# - "fp32": full precision
+# - "bf16": bfloat16 autocast (fast on CPUs with AVX512-BF16/AMX)
+# - "int8": dynamically quantized int8 Linear layers in the ViT blocks and the
+#   text transformer, activations stay in fp32
+# CUDA always runs with bfloat16 autocast.
+PRECISIONS = ("fp32", "bf16", "int8")
+
+# Predictions scoring below this are not kept for rescore(): lower thresholds
+# would only add noise, and each kept prediction holds a low-resolution mask
+RAW_SCORE_FLOOR = 0.05
+
+# Input resolution tiers. The weights are trained at 1008 px; the backbone cost
+# falls roughly quadratically with the side. 672 px is a whole number of 24x24
+# attention windows (as 1008 is), smaller sides in between pay for padded windows.
+RESOLUTION_TIERS = {"preview": 672, "full": 1008}
+
+
+def quantize_encoders(model: torch.nn.Module) -> int:
+    """
+    Replace the Linear layers of the ViT blocks and of the text transformer
+    with dynamically quantized int8 versions (CPU only).
+
+    Returns:
+        Number of quantized Linear layers
+    """
+    from torch.ao.quantization import quantize_dynamic
+
+    targets = [
+        model.backbone.vision_backbone.trunk.blocks,
+        # Only the residual blocks: the text projection is checked with isinstance(nn.Linear)
+        model.backbone.language_backbone.encoder.transformer,
+    ]
+    count = 0
+    for target in targets:
+        count += sum(type(m) is torch.nn.Linear for m in target.modules())
+        quantize_dynamic(target, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return count
+
+
+def _with_precision(method):
+    """Run a SAM3Model method under the autocast mode of its precision."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._autocast():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class SAM3Model:
     """Wrapper for SAM3 model inference."""
 
@@ -51,7 +123,14 @@ class SAM3Model:
         self,
         confidence_threshold: float = 0.1,
         device: str = "cuda",
-        checkpoint_path: Optional[str] = None
+        checkpoint_path: Optional[str] = None,
+        embedding_cache: Optional[ImageEmbeddingCache] = None,
+        text_cache: Optional[TextEmbeddingCache] = None,
+        precision: str = "fp32",
+        compile_mode: Optional[str] = None,
+        compile_cache_dir: Optional[str] = None,
+        resolutions: Sequence[int] = (),
+        interactive: bool = False
     ):
         """
         Initialize SAM3 model.
@@ -61,18 +140,77 @@ class SAM3Model:
             device: Device to run on ('cuda' or 'cpu')
             checkpoint_path: Path to custom checkpoint file (optional).
                             If None, loads default SAM3 from HuggingFace.
+            embedding_cache: Optional cache of image embeddings, so that
+                            re-prompting the same image skips the backbone.
+            text_cache: Optional cache of text encoder outputs, so that
+                            repeated prompts skip the text transformer.
+                            Must not be shared between checkpoints.
+            precision: CPU precision mode, one of PRECISIONS. Applied when the
+                            model is built, ignored on CUDA.
+            compile_mode: torch.compile mode for the image backbone and the
+                            grounding head (e.g. "max-autotune-no-cudagraphs"),
+                            None to run eagerly.
+            compile_cache_dir: Directory where compiled artifacts are kept
+                            across restarts, keyed by model, torch version
+                            and device.
+            resolutions: Reduced input resolutions (e.g. RESOLUTION_TIERS values)
+                            whose position caches are precomputed at load
+                            and that are warmed up with the full resolution.
+            interactive: Build the SAM1-style interactive predictor, needed
+                            by refine(). Encoding an image then also computes
+                            the features it uses.
         """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+        if precision != "fp32" and device != "cpu":
+            print(f"Precision '{precision}' only applies to CPU inference, ignored on {device}")
+            precision = "fp32"
         self.device = device
+        self.precision = precision
+        self.compile_mode = compile_mode
+        self.compile_cache_dir = compile_cache_dir
+        self.resolutions = sorted(set(resolutions) - {1008})
+        self.interactive = interactive
+        self._compile_artifacts_path = None
         self.confidence_threshold = confidence_threshold
         self.checkpoint_path = checkpoint_path
+        self.embedding_cache = embedding_cache
+        self.text_cache = text_cache
         self.model = None
         self.processor = None
+        # Seconds spent in each loading step, filled by load_model and warmup
+        self.load_timings = {}
+        self._load_lock = threading.Lock()
+        # The interactive predictor holds the features of the image being refined
+        self._refine_lock = threading.Lock()
+
+    @property
+    def checkpoint_id(self) -> str:
+        """Identifier of the loaded weights, used to key cached embeddings."""
+        checkpoint_id = self.checkpoint_path or "hf:facebook/sam3"
+        # Reduced precision changes the embeddings, so they must not be mixed
+        if self.precision != "fp32":
+            checkpoint_id += f"@{self.precision}"
+        return checkpoint_id
+
+    def _autocast(self):
+        # Autocast is thread-local: entered per call, it covers every thread
+        # running inference (inference pool, batcher)
+        if str(self.device).startswith("cuda"):
+            return torch.autocast("cuda", dtype=torch.bfloat16)
+        if self.precision == "bf16":
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return nullcontext()
 
     def load_model(self):
-        """Load SAM3 model (lazy loading)."""
-        if self.model is not None:
+        """Load SAM3 model (lazy loading, safe to call from several threads)."""
+        if self.processor is not None:
             return
+        with self._load_lock:
+            if self.processor is None:
+                self._load_model()
 
+    def _load_model(self):
         if self.checkpoint_path:
             print(f"Loading SAM3 model from checkpoint: {self.checkpoint_path}")
         else:
@@ -82,12 +220,11 @@ class SAM3Model:
         if torch.cuda.is_available():
             torch.backends.cuda.matmul.allow_tf32 = True
             torch.backends.cudnn.allow_tf32 = True
-            # Use bfloat16 for inference on CUDA
-            torch.autocast("cuda", dtype=torch.bfloat16).__enter__()
 
         # Load model
         bpe_path = SAM3_ROOT / "assets" / "bpe_simple_vocab_16e6.txt.gz"
 
+        start = time.perf_counter()
         if self.checkpoint_path:
             # For custom checkpoints (e.g., MedSAM3), we need to handle
             # different checkpoint formats. First build the model without
@@ -95,89 +232,256 @@ class SAM3Model:
             self.model = build_sam3_image_model(
                 bpe_path=str(bpe_path),
                 checkpoint_path=None,  # Don't load checkpoint here
-                load_from_HF=False     # Don't load from HF
+                load_from_HF=False,    # Don't load from HF
+                enable_inst_interactivity=self.interactive
             )
+            self.load_timings["build_s"] = round(time.perf_counter() - start, 3)
             # Load custom checkpoint with flexible format handling
+            start = time.perf_counter()
             self._load_custom_checkpoint(self.checkpoint_path)
+            self.load_timings["checkpoint_s"] = round(time.perf_counter() - start, 3)
         else:
             # Use default HuggingFace loading
             self.model = build_sam3_image_model(
                 bpe_path=str(bpe_path),
                 checkpoint_path=None,
-                load_from_HF=True
+                load_from_HF=True,
+                enable_inst_interactivity=self.interactive
+            )
+            self.load_timings["build_s"] = round(time.perf_counter() - start, 3)
+
+        if self.precision == "int8":
+            start = time.perf_counter()
+            count = quantize_encoders(self.model)
+            self.load_timings["quantize_s"] = round(time.perf_counter() - start, 3)
+            print(f"Quantized {count} Linear layers to int8")
+
+        if self.compile_mode:
+            # Compilation itself happens on the first call (see warmup)
+            self._compile_artifacts_path = compile_image_model(
+                self.model,
+                self.device,
+                mode=self.compile_mode,
+                cache_dir=self.compile_cache_dir,
+                cache_extra=self.precision,
             )
 
+        for resolution in self.resolutions:
+            precompute_image_resolution(self.model, resolution)
+
+        if self.text_cache is not None:
+            self.model.backbone.set_text_cache(self.text_cache)
+
         self.processor = Sam3Processor(
             self.model,
             device=self.device,
-            confidence_threshold=self.confidence_threshold
+            confidence_threshold=self.confidence_threshold,
+            # Only the returned mask is upsampled to the image size
+            lazy_masks=True,
+            # Unfiltered predictions kept for rescore, minus the hopeless ones
+            raw_score_floor=min(RAW_SCORE_FLOOR, self.confidence_threshold)
         )
 
         print("SAM3 model loaded successfully!")
 
+    @_with_precision
+    def warmup_text(self, text_prompts: List[str]):
+        """
+        Preload the text cache with a list of prompts.
+
+        Args:
+            text_prompts: Prompts expected at inference time
+        """
+        if self.text_cache is None:
+            return
+        self.load_model()
+
+        prompts = list(dict.fromkeys(text_prompts))
+        if prompts:
+            with torch.inference_mode():
+                self.model.backbone.forward_text(prompts, device=self.device)
+
+    @_with_precision
+    def warmup(self, text_prompts: List[str] = (), image_size: int = 1008) -> dict:
+        """
+        Run a dummy inference so that the first real request does not pay for
+        lazy initialization and kernel selection.
+
+        Args:
+            text_prompts: Prompts expected at inference time; the first one is run
+                on the dummy image and all of them are added to the text cache
+            image_size: Side of the blank dummy image (0 skips the image pass)
+
+        Returns:
+            Seconds spent per warm-up step
+        """
+        self.load_model()
+
+        prompts = list(dict.fromkeys(text_prompts))
+        if image_size > 0:
+            start = time.perf_counter()
+            # Bypasses the embedding cache, a blank image is not worth keeping
+            blank = np.zeros((image_size, image_size, 3), dtype=np.uint8)
+            for resolution in [None] + self.resolutions:
+                state = self.processor.set_image(blank, resolution=resolution)
+                self.predict_text(state, prompts[0] if prompts else "object")
+            self.load_timings["warmup_image_s"] = round(time.perf_counter() - start, 3)
+        if prompts:
+            start = time.perf_counter()
+            self.warmup_text(prompts)
+            self.load_timings["warmup_text_s"] = round(time.perf_counter() - start, 3)
+
+        # Warm-up compiled the model: persist the artifacts for other processes
+        if self._compile_artifacts_path and save_compile_artifacts(self._compile_artifacts_path):
+            print(f"Saved compile artifacts to {self._compile_artifacts_path}")
+
+        return dict(self.load_timings)
+
+    def save_text_cache(self, path: str):
+        """Persist the text cache so that a restarted server starts warm."""
+        if self.text_cache is not None:
+            self.text_cache.save(path, tag=self.checkpoint_id)
+
+    def load_text_cache(self, path: str) -> int:
+        """
+        Load a text cache saved with ``save_text_cache`` for the same checkpoint.
+
+        Returns:
+            Number of loaded prompts (0 if the file belongs to another checkpoint)
+        """
+        if self.text_cache is None:
+            return 0
+        return self.text_cache.load(path, device=self.device, tag=self.checkpoint_id)
+
     def _load_custom_checkpoint(self, checkpoint_path: str):
         """
         Load custom checkpoint with flexible format handling.
 
-        Handles both:
+        Handles:
         - SAM3 format: keys with 'detector.' prefix
         - MedSAM3 format: keys without 'detector.' prefix
+        - .safetensors files written by convert_checkpoint.py: keys already
+          normalized, memory-mapped straight into the model parameters
         """
         print(f"Loading custom checkpoint: {checkpoint_path}")
 
-        ckpt = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
-
-        # Extract model state dict
-        if "model" in ckpt and isinstance(ckpt["model"], dict):
-            state_dict = ckpt["model"]
-        else:
-            state_dict = ckpt
-
-        # Check if keys have 'detector.' prefix
-        sample_key = list(state_dict.keys())[0] if state_dict else ""
-        has_detector_prefix = "detector." in sample_key
-
-        if has_detector_prefix:
-            # SAM3 format: strip 'detector.' prefix
-            clean_state_dict = {
-                k.replace("detector.", ""): v
-                for k, v in state_dict.items()
-                if "detector" in k
-            }
+        if checkpoint_path.endswith(".safetensors"):
+            state_dict = load_safetensors_state_dict(checkpoint_path)
+            missing_keys, unexpected_keys = load_state_dict_into_model(
+                self.model, state_dict, assign=True
+            )
         else:
-            # MedSAM3 format: keys already match model structure
-            clean_state_dict = state_dict
+            ckpt = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+            # Strips the 'detector.' prefix (SAM3 format) if present
+            clean_state_dict = normalize_checkpoint_state_dict(ckpt, include_tracker=self.interactive)
 
-        # Load state dict
-        missing_keys, unexpected_keys = self.model.load_state_dict(
-            clean_state_dict, strict=False
-        )
+            missing_keys, unexpected_keys = self.model.load_state_dict(
+                clean_state_dict, strict=False
+            )
 
         if missing_keys:
             print(f"  Missing keys: {len(missing_keys)}")
         if unexpected_keys:
             print(f"  Unexpected keys: {len(unexpected_keys)}")
 
-    def encode_image(self, image: np.ndarray) -> dict:
+    def resolve_resolution(self, resolution=None) -> Optional[int]:
+        """
+        Model input size of a tier name or pixel size, None for the full resolution.
+
+        Raises:
+            ValueError: for an unknown tier or a size that is not a multiple of 14
+        """
+        if resolution is None:
+            return None
+        if isinstance(resolution, str):
+            if resolution not in RESOLUTION_TIERS:
+                raise ValueError(f"Unknown resolution tier '{resolution}', expected one of {list(RESOLUTION_TIERS)}")
+            resolution = RESOLUTION_TIERS[resolution]
+        if resolution % 14 != 0 or not 0 < resolution <= 1008:
+            raise ValueError(f"Resolution must be a multiple of 14 up to 1008, got {resolution}")
+        return None if resolution == 1008 else resolution
+
+    @_with_precision
+    def encode_image(self, image: np.ndarray, resolution=None) -> dict:
         """
         Encode an image for inference.
 
         Args:
             image: RGB image as numpy array (H, W, 3)
+            resolution: Model input size or RESOLUTION_TIERS name, full
+                resolution if None
 
         Returns:
             Inference state dictionary
         """
         self.load_model()
+        resolution = self.resolve_resolution(resolution)
 
-        # Convert to PIL Image
-        pil_image = Image.fromarray(image)
+        cache_key = None
+        if self.embedding_cache is not None:
+            cache_key = image_cache_key(
+                image, self.checkpoint_id, resolution or self.processor.resolution
+            )
+            cached_state = self.embedding_cache.get(cache_key, device=self.device)
+            if cached_state is not None:
+                return cached_state
 
-        # Encode image
-        inference_state = self.processor.set_image(pil_image)
+        # The processor takes the array as is, without an intermediate copy
+        inference_state = self.processor.set_image(image, resolution=resolution)
+
+        if cache_key is not None:
+            self.embedding_cache.put(cache_key, inference_state)
 
         return inference_state
 
+    @_with_precision
+    def encode_images(self, images: List[np.ndarray], resolution=None) -> dict:
+        """
+        Encode a batch of images in a single backbone pass.
+
+        Args:
+            images: RGB images as numpy arrays (H, W, 3), sizes may differ
+            resolution: Model input size or RESOLUTION_TIERS name, full
+                resolution if None
+
+        Returns:
+            Batched inference state dictionary
+        """
+        self.load_model()
+
+        return self.processor.set_image_batch(
+            list(images),
+            resolution=self.resolve_resolution(resolution)
+        )
+
+    @staticmethod
+    def split_batch_state(batch_state: dict) -> List[dict]:
+        """
+        Split a batch encoded by ``encode_images`` into one state per image, for
+        the single-image prompts (``predict_box``, ``predict_text``...).
+
+        The image features are views into the batch features, nothing is
+        copied. Split before prompting the batch: text features are batched
+        per prompt, not per image.
+        """
+        num_images = len(batch_state["original_heights"])
+
+        def _image(index):
+            return lambda t: t[index:index + 1] if t.dim() > 0 and t.shape[0] == num_images else t
+
+        return [
+            {
+                "original_height": height,
+                "original_width": width,
+                "resolution": batch_state["resolution"],
+                "backbone_out": _map_tensors(batch_state["backbone_out"], _image(index)),
+            }
+            for index, (height, width) in enumerate(
+                zip(batch_state["original_heights"], batch_state["original_widths"])
+            )
+        ]
+
+    @_with_precision
     def predict_box(
         self,
         inference_state: dict,
@@ -195,6 +499,19 @@ class SAM3Model:
         Returns:
             Binary prediction mask or None if no prediction
         """
+        return self._best_mask(self.ground_box(inference_state, bbox, img_size))
+
+    @_with_precision
+    def ground_box(
+        self,
+        inference_state: dict,
+        bbox: Tuple[int, int, int, int],
+        img_size: Tuple[int, int]
+    ) -> dict:
+        """
+        Like ``predict_box``, but return the prediction state ("boxes",
+        "scores" and the not yet upsampled "lazy_masks").
+        """
         self.processor.reset_all_prompts(inference_state)
 
         x_min, y_min, x_max, y_max = bbox
@@ -212,19 +529,46 @@ class SAM3Model:
         norm_box = normalize_bbox(box_cxcywh, img_w, img_h).flatten().tolist()
 
         # Run inference
-        box_state = self.processor.add_geometric_prompt(
+        return self.processor.add_geometric_prompt(
             state=inference_state,
             box=norm_box,
             label=True  # Positive prompt
         )
 
-        if box_state["masks"] is not None and len(box_state["masks"]) > 0:
-            best_idx = torch.argmax(box_state["scores"]).item()
-            pred_mask = box_state["masks"][best_idx].cpu().numpy() > 0
-            return pred_mask.astype(np.uint8)
+    @_with_precision
+    def predict_points(
+        self,
+        inference_state: dict,
+        points: List[Tuple[int, int]],
+        labels: List[bool],
+        img_size: Tuple[int, int]
+    ) -> Optional[np.ndarray]:
+        """
+        Run inference with point prompts.
 
-        return None
+        Args:
+            inference_state: Image encoding state
+            points: Points as (x, y) in pixels
+            labels: True for positive points, False for negative points
+            img_size: Image size as (height, width)
+
+        Returns:
+            Binary prediction mask or None if no prediction
+        """
+        self.processor.reset_all_prompts(inference_state)
 
+        img_h, img_w = img_size
+        norm_points = [[x / img_w, y / img_h] for x, y in points]
+
+        point_state = self.processor.add_point_prompt(
+            state=inference_state,
+            points=norm_points,
+            labels=labels
+        )
+
+        return self._best_mask(point_state)
+
+    @_with_precision
     def predict_text(
         self,
         inference_state: dict,
@@ -248,12 +592,265 @@ class SAM3Model:
             prompt=text_prompt
         )
 
-        if text_state["masks"] is not None and len(text_state["masks"]) > 0:
-            best_idx = torch.argmax(text_state["scores"]).item()
-            pred_mask = text_state["masks"][best_idx].cpu().numpy() > 0
-            return pred_mask.astype(np.uint8)
+        return self._best_mask(text_state)
 
-        return None
+    @_with_precision
+    def predict_texts(
+        self,
+        inference_state: dict,
+        text_prompts: List[str]
+    ) -> List[Optional[np.ndarray]]:
+        """
+        Run several text prompts on one image in a single grounding pass.
+
+        Args:
+            inference_state: Image encoding state
+            text_prompts: Natural language descriptions
+
+        Returns:
+            One binary prediction mask (or None) per prompt
+        """
+        self.processor.reset_all_prompts(inference_state)
+
+        text_states = self.processor.set_text_prompts(
+            state=inference_state,
+            prompts=text_prompts
+        )
+
+        return [self._best_mask(text_state) for text_state in text_states]
+
+    @_with_precision
+    def predict_text_batch(
+        self,
+        batch_state: dict,
+        text_prompts: List[str]
+    ) -> List[Optional[np.ndarray]]:
+        """
+        Run text-prompted inference on a batch of images in a single grounding pass.
+
+        Args:
+            batch_state: State returned by ``encode_images``
+            text_prompts: One prompt per image of the batch
+
+        Returns:
+            One binary prediction mask (or None) per image
+        """
+        return [self._best_mask(text_state) for text_state in self.ground_text_batch(batch_state, text_prompts)]
+
+    @_with_precision
+    def ground_text_batch(
+        self,
+        batch_state: dict,
+        text_prompts: List[str]
+    ) -> List[dict]:
+        """
+        Like ``predict_text_batch``, but return the prediction state of each
+        image ("boxes", "scores" and the not yet upsampled "lazy_masks").
+        """
+        self.processor.reset_all_prompts(batch_state)
+
+        return self.processor.set_text_prompt_batch(
+            state=batch_state,
+            prompts=text_prompts
+        )
+
+    def segment_text(
+        self,
+        image: np.ndarray,
+        text_prompt: str,
+        resolution=None,
+        escalate_below: Optional[float] = None
+    ) -> Tuple[Optional[np.ndarray], int]:
+        """
+        Encode and segment an image with a text prompt at a resolution tier.
+
+        Args:
+            image: RGB image (H, W, 3)
+            text_prompt: Text description of the target
+            resolution: Model input size or RESOLUTION_TIERS name, full
+                resolution if None
+            escalate_below: Re-run at full resolution when the reduced
+                resolution finds nothing or its best score is below this
+
+        Returns:
+            Binary mask (or None) and the resolution that produced it
+        """
+        resolution = self.resolve_resolution(resolution)
+        state = self.encode_image(image, resolution)
+        mask = self.predict_text(state, text_prompt)
+        if resolution is not None and escalate_below is not None:
+            if mask is None or self.get_confidence(state) < escalate_below:
+                resolution = None
+                state = self.encode_image(image)
+                mask = self.predict_text(state, text_prompt)
+        return mask, resolution or self.processor.resolution
+
+    def segment_tiled(self, image: np.ndarray, text_prompt: str, **tiling_kwargs) -> np.ndarray:
+        """
+        Segment an image larger than the model input at native resolution,
+        with overlapping tiles (see ``tiling.TiledSegmenter``).
+
+        Args:
+            image: RGB image (H, W, 3), may be a np.memmap
+            text_prompt: Text description of the target
+            **tiling_kwargs: TiledSegmenter options (tile_size, overlap, max_memory_mb, ...)
+
+        Returns:
+            Binary mask (H, W)
+        """
+        return TiledSegmenter(self, **tiling_kwargs).segment_text(image, text_prompt).mask
+
+    def segment_dicom(
+        self,
+        series: DicomSeries,
+        text_prompt: str,
+        batch_size: int = 8,
+        window: Optional[Tuple[float, float]] = None,
+        resolution=None
+    ) -> np.ndarray:
+        """
+        Segment every frame of a DICOM series, in batches of frames windowed
+        on the model device.
+
+        Args:
+            series: Series from ``DicomSeries.open``
+            text_prompt: Text description of the target
+            batch_size: Frames per backbone pass
+            window: (center, width) overriding the windows stored in the files
+            resolution: Model input size or RESOLUTION_TIERS name, full
+                resolution if None
+
+        Returns:
+            (frames, H, W) boolean masks, see ``dicom.mask_stats`` for their
+            physical size
+        """
+        self.load_model()
+        masks = np.zeros(series.shape, dtype=bool)
+        for start, frames in series.batches(batch_size, self.device, window):
+            state = self.encode_images(list(frames), resolution)
+            for offset, mask in enumerate(self.predict_text_batch(state, [text_prompt] * len(frames))):
+                if mask is not None:
+                    # Already at frame size: the frames are the original images
+                    masks[start + offset] = np.squeeze(mask) > 0
+        return masks
+
+    @_with_precision
+    def refine(
+        self,
+        inference_state: dict,
+        points: List[Tuple[float, float]] = (),
+        labels: List[bool] = (),
+        box: Optional[Tuple[int, int, int, int]] = None,
+        mask_input: Optional[np.ndarray] = None,
+        reset: bool = False
+    ) -> Optional[np.ndarray]:
+        """
+        Refine a mask with clicks, running only the prompt encoder and the
+        mask decoder of the interactive predictor on the encoded image.
+
+        The low-resolution logits of the result are kept in the state and fed
+        back as mask input to the next call, so that clicks accumulate.
+
+        Args:
+            inference_state: Image encoding state (full resolution)
+            points: Click coordinates as (x, y) in pixels
+            labels: True for positive and False for negative clicks
+            box: Optional box as (x_min, y_min, x_max, y_max) in pixels
+            mask_input: Low-resolution mask logits (1, 256, 256) to start from,
+                instead of the result of the previous call
+            reset: Start from scratch instead of the previous result
+
+        Returns:
+            Binary refined mask
+        """
+        if not self.interactive:
+            raise RuntimeError("Refinement needs the model built with interactive=True")
+        if "sam2_backbone_out" not in inference_state["backbone_out"]:
+            raise ValueError("The image was encoded without the interactive features")
+        if inference_state.get("resolution", 1008) != 1008:
+            raise ValueError("Refinement needs an image encoded at full resolution")
+
+        if reset:
+            inference_state.pop("refine_logits", None)
+        if mask_input is None:
+            mask_input = inference_state.get("refine_logits")
+
+        point_coords, point_labels = None, None
+        if len(points) > 0:
+            point_coords = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+            point_labels = np.asarray(labels, dtype=np.int32)
+        box_array = np.asarray(box, dtype=np.float32) if box is not None else None
+        # A single click is ambiguous: pick the best of the three candidates
+        multimask = mask_input is None and box is None and len(points) == 1
+
+        with self._refine_lock, torch.inference_mode():
+            masks, scores, low_res_logits = self.model.predict_inst(
+                inference_state,
+                point_coords=point_coords,
+                point_labels=point_labels,
+                box=box_array,
+                mask_input=mask_input,
+                multimask_output=multimask,
+            )
+
+        best = int(np.argmax(scores))
+        inference_state["refine_logits"] = low_res_logits[best:best + 1]
+        return masks[best].astype(np.uint8)
+
+    @_with_precision
+    def rescore(
+        self,
+        inference_state: dict,
+        threshold: Optional[float] = None,
+        topk: int = 1,
+        nms_iou_threshold: Optional[float] = None
+    ) -> Optional[np.ndarray]:
+        """
+        Filter the predictions of the last prompt again without running the model,
+        e.g. for a confidence slider.
+
+        Args:
+            inference_state: Image encoding state a prompt was run on
+            threshold: Score threshold (default: confidence_threshold)
+            topk: Number of highest scoring predictions merged into the mask
+            nms_iou_threshold: Drop predictions overlapping a better one by more than this IoU
+
+        Returns:
+            Union of the kept masks, or None if nothing passes the threshold
+        """
+        state = self.processor.rescore(
+            inference_state,
+            threshold=threshold,
+            topk=topk,
+            nms_iou_threshold=nms_iou_threshold
+        )
+        lazy_masks = state["lazy_masks"]
+        if len(lazy_masks) == 0:
+            return None
+        masks = lazy_masks.upsample() > 0.5
+        return masks.any(dim=0)[0].cpu().numpy().astype(np.uint8)
+
+    def _best_mask(self, state: dict) -> Optional[np.ndarray]:
+        """Highest scoring mask of a prediction state, or None if nothing was kept."""
+        # Upsamples only the best of the kept low-resolution masks
+        best = state["lazy_masks"].best()
+        if best is None:
+            return None
+        return (best > 0.5).cpu().numpy().astype(np.uint8)
+
+    def best_prediction(self, state: dict) -> Tuple[Optional[np.ndarray], float, Optional[List[float]]]:
+        """
+        Highest scoring prediction of a prediction state.
+
+        Returns:
+            Binary mask (None if nothing was kept), its score and its box as
+            (x_min, y_min, x_max, y_max) in pixels
+        """
+        mask = self._best_mask(state)
+        if mask is None:
+            return None, 0.0, None
+        best_idx = int(torch.argmax(state["scores"]))
+        return mask, float(state["scores"][best_idx]), state["boxes"][best_idx].tolist()
 
     def get_confidence(self, state: dict) -> float:
         """Get confidence score from state."""
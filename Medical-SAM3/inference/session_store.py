@@ -0,0 +1,229 @@
+"""
+Image sessions for interactive segmentation.
+
+An image is uploaded, decoded and encoded once; later prompts run against
+the stored inference state. Sessions expire after a TTL of inactivity and
+the least recently used ones are dropped when the memory budget is exceeded.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import numpy as np
+
+
+def _state_nbytes(inference_state: Optional[dict], exclude: Optional[set] = None) -> int:
+    # Imported lazily so the store works without torch in demo mode
+    if inference_state is None:
+        return 0
+    try:
+        from inference.embedding_cache import tensor_nbytes
+    except ModuleNotFoundError:
+        from embedding_cache import tensor_nbytes
+    return tensor_nbytes(inference_state, exclude)
+
+
+@dataclass
+class ImageSession:
+    """A decoded image and its encoded inference state."""
+    image_id: str
+    image: np.ndarray                  # RGB image (H, W, 3)
+    inference_state: Optional[dict]    # None in demo mode
+    nbytes: int
+    created_at: float
+    last_access: float
+    checkpoint_path: Optional[str] = None
+    device: Optional[str] = None
+    worker: Optional[int] = None       # Model worker holding the state (multi-process serving)
+    # Prompts mutate the inference state, so requests on one session are serialized
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+class SessionStore:
+    """In-memory store of image sessions bounded by TTL and memory budget."""
+
+    def __init__(
+        self,
+        ttl_seconds: float = 900.0,
+        max_bytes: int = 2 * 1024 ** 3,
+        max_sessions: Optional[int] = None,
+        max_sessions_per_worker: Optional[int] = None,
+        on_remove: Optional[Callable[[ImageSession], None]] = None,
+        shared_tensors: Optional[Callable[[], set]] = None,
+    ):
+        """
+        Initialize the store.
+
+        Args:
+            ttl_seconds: Idle time after which a session expires
+            max_bytes: Memory budget for images and inference states
+            max_sessions: Optional cap on the number of live sessions
+            max_sessions_per_worker: Optional cap on the live sessions held by one
+                model worker, matching the number of states each worker keeps
+            on_remove: Called with each session that is deleted, expires or is evicted
+            shared_tensors: Returns the ``tensor_keys`` of tensors owned elsewhere
+                (e.g. ``ImageEmbeddingCache.tensor_keys``), not charged to sessions
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.max_sessions_per_worker = max_sessions_per_worker
+        self.on_remove = on_remove
+        self.shared_tensors = shared_tensors
+
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def create(
+        self,
+        image: np.ndarray,
+        inference_state: Optional[dict],
+        checkpoint_path: Optional[str] = None,
+        device: Optional[str] = None,
+        worker: Optional[int] = None,
+    ) -> ImageSession:
+        """
+        Register a new session.
+
+        Args:
+            image: Decoded RGB image
+            inference_state: State returned by ``SAM3Model.encode_image``
+            checkpoint_path: Checkpoint the state was encoded with
+            device: Device the state lives on
+            worker: Model worker holding the state, if it lives in another process
+
+        Returns:
+            The created session
+        """
+        now = time.monotonic()
+        session = ImageSession(
+            image_id=uuid.uuid4().hex,
+            image=image,
+            inference_state=inference_state,
+            nbytes=self._measure(image, inference_state),
+            created_at=now,
+            last_access=now,
+            checkpoint_path=checkpoint_path,
+            device=device,
+            worker=worker,
+        )
+        with self._lock:
+            removed = self._expire(now)
+            self._sessions[session.image_id] = session
+            self.current_bytes += session.nbytes
+            removed += self._evict()
+            if worker is not None:
+                removed += self._evict_worker(worker)
+        self._notify(removed)
+        return session
+
+    def get(self, image_id: str) -> Optional[ImageSession]:
+        """Return a live session and refresh its TTL, or None if unknown or expired."""
+        now = time.monotonic()
+        with self._lock:
+            removed = self._expire(now)
+            session = self._sessions.get(image_id)
+            if session is not None:
+                session.last_access = now
+                self._sessions.move_to_end(image_id)
+        self._notify(removed)
+        return session
+
+    def remeasure(self, session: ImageSession):
+        """
+        Update the size of a session after a prompt added to its state (raw
+        outputs, language features, refinement logits), evicting others if
+        the budget is now exceeded.
+
+        Call with ``session.lock`` held, so that the state is not changing.
+        """
+        nbytes = self._measure(session.image, session.inference_state)
+        with self._lock:
+            if self._sessions.get(session.image_id) is not session:
+                return
+            self.current_bytes += nbytes - session.nbytes
+            session.nbytes = nbytes
+            # The session was just used, so it is the last one evicted
+            removed = self._evict()
+        self._notify(removed)
+
+    def _measure(self, image: np.ndarray, inference_state: Optional[dict]) -> int:
+        exclude = self.shared_tensors() if self.shared_tensors is not None and inference_state is not None else None
+        return image.nbytes + _state_nbytes(inference_state, exclude)
+
+    def delete(self, image_id: str) -> bool:
+        """Drop a session. Returns False if it did not exist."""
+        with self._lock:
+            session = self._sessions.pop(image_id, None)
+            if session is None:
+                return False
+            self.current_bytes -= session.nbytes
+        self._notify([session])
+        return True
+
+    def _expire(self, now: float) -> list:
+        # Sessions are ordered by last access, so expired ones are at the front
+        removed = []
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_access <= self.ttl_seconds:
+                break
+            self._sessions.popitem(last=False)
+            self.current_bytes -= session.nbytes
+            self.expired += 1
+            removed.append(session)
+        return removed
+
+    def _evict(self) -> list:
+        # Never evict the session that was just created
+        removed = []
+        while len(self._sessions) > 1 and (
+            self.current_bytes > self.max_bytes
+            or (self.max_sessions is not None and len(self._sessions) > self.max_sessions)
+        ):
+            _, session = self._sessions.popitem(last=False)
+            self.current_bytes -= session.nbytes
+            self.evicted += 1
+            removed.append(session)
+        return removed
+
+    def _evict_worker(self, worker: int) -> list:
+        # Least recently used sessions of the worker first; the one just created is last
+        if self.max_sessions_per_worker is None:
+            return []
+        held = [image_id for image_id, session in self._sessions.items() if session.worker == worker]
+        removed = []
+        for image_id in held[:max(0, len(held) - max(self.max_sessions_per_worker, 1))]:
+            session = self._sessions.pop(image_id)
+            self.current_bytes -= session.nbytes
+            self.evicted += 1
+            removed.append(session)
+        return removed
+
+    def _notify(self, removed: list):
+        # Called outside the store lock
+        if self.on_remove is not None:
+            for session in removed:
+                self.on_remove(session)
+
+    def stats(self) -> dict:
+        """Live session count and memory usage."""
+        with self._lock:
+            removed = self._expire(time.monotonic())
+            stats = {
+                "sessions": len(self._sessions),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+        self._notify(removed)
+        return stats
@@ -0,0 +1 @@
+# Tests of the inference modules, run from Medical-SAM3 with: python -m pytest inference/tests
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from inference.embedding_cache import ImageEmbeddingCache, image_cache_key, tensor_keys, tensor_nbytes
+
+# One float32 feature map of 1 KiB per entry
+ENTRY_BYTES = 1024
+
+
+def _state(value=0.0):
+    features = torch.full((16, 16), value)
+    return {
+        "original_height": 32,
+        "original_width": 48,
+        # The same tensor twice, as in the real backbone outputs
+        "backbone_out": {"vision_features": features, "backbone_fpn": [features]},
+    }
+
+
+class TestImageCacheKey:
+    def test_key_depends_on_pixels_checkpoint_and_resolution(self):
+        image = np.zeros((8, 8, 3), dtype=np.uint8)
+        key = image_cache_key(image, "ckpt", 1008)
+        assert image_cache_key(image.copy(), "ckpt", 1008) == key
+        assert image_cache_key(image, "other", 1008) != key
+        assert image_cache_key(image, "ckpt", 644) != key
+        changed = image.copy()
+        changed[0, 0, 0] = 1
+        assert image_cache_key(changed, "ckpt", 1008) != key
+
+
+class TestImageEmbeddingCache:
+    def test_get_returns_cached_tensors_in_fresh_containers(self):
+        cache = ImageEmbeddingCache(max_bytes=10 * ENTRY_BYTES)
+        cache.put("a", _state(1.0))
+
+        state = cache.get("a")
+        assert state["original_height"] == 32
+        assert torch.equal(state["backbone_out"]["vision_features"], torch.full((16, 16), 1.0))
+        # Prompts add keys to the returned state, which must not reach the cache
+        state["backbone_out"]["language_features"] = torch.zeros(4)
+        assert "language_features" not in cache.get("a")["backbone_out"]
+        assert cache.get("missing") is None
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    def test_aliased_tensors_are_counted_once(self):
+        cache = ImageEmbeddingCache(max_bytes=10 * ENTRY_BYTES)
+        cache.put("a", _state())
+        assert cache.current_bytes == ENTRY_BYTES
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ImageEmbeddingCache(max_bytes=2 * ENTRY_BYTES)
+        cache.put("a", _state())
+        cache.put("b", _state())
+        cache.get("a")
+        cache.put("c", _state())
+        assert cache.get("b") is None
+        assert cache.get("a") is not None and cache.get("c") is not None
+        assert cache.evictions == 1
+        assert cache.current_bytes == 2 * ENTRY_BYTES
+
+    def test_max_entries(self):
+        cache = ImageEmbeddingCache(max_bytes=10 * ENTRY_BYTES, max_entries=1)
+        cache.put("a", _state())
+        cache.put("b", _state())
+        assert len(cache) == 1
+        assert cache.get("a") is None
+
+    def test_entry_larger_than_budget_is_not_stored(self):
+        cache = ImageEmbeddingCache(max_bytes=ENTRY_BYTES // 2)
+        cache.put("a", _state())
+        assert len(cache) == 0
+        assert cache.current_bytes == 0
+
+    def test_replacing_an_entry_keeps_the_byte_count(self):
+        cache = ImageEmbeddingCache(max_bytes=10 * ENTRY_BYTES)
+        cache.put("a", _state())
+        cache.put("a", _state(2.0))
+        assert len(cache) == 1
+        assert cache.current_bytes == ENTRY_BYTES
+
+    def test_tensor_keys_cover_the_states_returned_by_get(self):
+        cache = ImageEmbeddingCache(max_bytes=10 * ENTRY_BYTES)
+        cache.put("a", _state())
+        state = cache.get("a")
+        state["text_features"] = torch.zeros(64)
+        assert tensor_keys(state["backbone_out"]) <= cache.tensor_keys()
+        assert tensor_nbytes(state, exclude=cache.tensor_keys()) == 64 * 4
+
+    def test_offloaded_entries_are_moved_back(self):
+        cache = ImageEmbeddingCache(max_bytes=10 * ENTRY_BYTES, offload_to_cpu=True)
+        cache.put("a", _state(3.0))
+        state = cache.get("a", device="cpu")
+        assert state["backbone_out"]["vision_features"].device.type == "cpu"
+        assert torch.equal(state["backbone_out"]["backbone_fpn"][0], torch.full((16, 16), 3.0))
@@ -0,0 +1,73 @@
+import numpy as np
+
+from inference import eval_pipeline
+from inference.dataset_loaders import DATASET_PROMPTS, Sample
+from inference.eval_pipeline import PipelinedEvaluator
+from inference.prediction_store import PredictionStore, box_prompt, text_prompt
+from inference.sam3_inference import generate_bbox_from_mask
+
+DATASET = "DDTI"
+MODEL = "test-model"
+
+
+class GroundTruthModel:
+    """Stands in for SAM3Model: predicts the foreground of each image, counting the images it encodes."""
+
+    def __init__(self):
+        self.encoded = 0
+
+    def encode_images(self, images):
+        self.encoded += len(images)
+        return {"masks": [image[..., 0] > 0 for image in images]}
+
+    def split_batch_state(self, batch_state):
+        return [{"mask": mask} for mask in batch_state["masks"]]
+
+    def ground_box(self, state, bbox, img_size):
+        return state
+
+    def ground_text_batch(self, batch_state, prompts):
+        return self.split_batch_state(batch_state)
+
+    def best_prediction(self, state):
+        return state["mask"].astype(np.uint8), 1.0, [0.0, 0.0, 1.0, 1.0]
+
+
+def _samples(count=3):
+    samples = []
+    for i in range(count):
+        gt = np.zeros((24, 32), dtype=np.uint8)
+        gt[4 + i:14 + i, 6:20 + i] = 1
+        samples.append(Sample(
+            image=np.repeat(gt[..., None] * 255, 3, axis=-1),
+            gt_mask=gt,
+            dataset_name=DATASET,
+            sample_id=f"s{i}",
+            text_prompt=DATASET_PROMPTS[DATASET],
+        ))
+    return samples
+
+
+class TestPipelinedEvaluator:
+    def test_stored_predictions_are_not_run_again(self, tmp_path, monkeypatch):
+        samples = _samples()
+        monkeypatch.setattr(eval_pipeline, "load_dataset", lambda name, max_samples=None: iter(samples))
+
+        # Predictions of the first sample, left by an interrupted run
+        store = PredictionStore(tmp_path)
+        first = samples[0]
+        for prompt in (box_prompt(generate_bbox_from_mask(first.gt_mask)), text_prompt(first.text_prompt)):
+            store.add(DATASET, first.sample_id, MODEL, prompt, first.gt_mask, 1.0)
+
+        model = GroundTruthModel()
+        [result] = PipelinedEvaluator(model, batch_size=2, store=store, model=MODEL, metric_workers=1).run([DATASET])
+        assert model.encoded == 2
+        assert sorted(row["sample_id"] for row in result["text_details"]) == ["s0", "s1", "s2"]
+        assert all(row["dice"] == 1.0 for row in result["text_details"] + result["box_details"])
+
+        # Everything is stored now: a rerun does not touch the model
+        model = GroundTruthModel()
+        [result] = PipelinedEvaluator(model, batch_size=2, store=store, model=MODEL, metric_workers=1).run([DATASET])
+        assert model.encoded == 0
+        assert len(result["text_details"]) == 3
+        store.close()
@@ -0,0 +1,47 @@
+import asyncio
+import threading
+
+import pytest
+
+from inference.executor import ExecutorOverloaded, InferenceExecutor
+
+
+class TestInferenceExecutor:
+    def test_admission_is_bounded_by_workers_and_queue(self):
+        executor = InferenceExecutor(max_workers=1, max_queue=1)
+        with executor.admit(), executor.admit():
+            with pytest.raises(ExecutorOverloaded) as overloaded:
+                with executor.admit():
+                    pass
+            assert overloaded.value.retry_after >= 1
+            assert executor.stats()["queue_depth"] == 1
+        # Slots are released when the blocks exit
+        with executor.admit():
+            pass
+        stats = executor.stats()
+        assert (stats["admitted"], stats["rejected"], stats["completed"]) == (3, 1, 3)
+        assert stats["in_flight"] == 0
+
+    def test_failures_release_their_slot(self):
+        executor = InferenceExecutor(max_workers=1, max_queue=0)
+        with pytest.raises(ValueError):
+            with executor.admit():
+                raise ValueError("inference failed")
+        with executor.admit():
+            pass
+        assert (executor.failed, executor.completed) == (1, 1)
+
+    def test_retry_after_grows_with_latency_and_queue(self):
+        executor = InferenceExecutor(max_workers=2, max_queue=4)
+        executor._latency_ema = 1.5
+        assert executor.retry_after() == 2
+        # 6 in flight on 2 workers: the next request waits for 3 waves
+        executor.in_flight = 6
+        assert executor.retry_after() == 5
+
+    def test_run_uses_the_inference_threads(self):
+        executor = InferenceExecutor(max_workers=2)
+        name = asyncio.run(executor.run(lambda: threading.current_thread().name))
+        assert name.startswith("inference")
+        assert asyncio.run(executor.run(divmod, 7, 2)) == (3, 1)
+        executor.pool.shutdown()
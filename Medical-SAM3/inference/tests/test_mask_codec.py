@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from inference.mask_codec import _rle_counts, mask_to_rle, rle_to_mask
+
+SHAPES = [(7, 13), (1, 1), (64, 33)]
+
+
+def _masks(shape):
+    """Empty, full and random masks of a shape."""
+    rng = np.random.default_rng(0)
+    return [
+        np.zeros(shape, dtype=np.uint8),
+        np.ones(shape, dtype=np.uint8),
+        (rng.random(shape) < 0.5).astype(np.uint8),
+    ]
+
+
+class TestRLE:
+    @pytest.mark.parametrize("shape", SHAPES)
+    def test_uncompressed_round_trip(self, shape):
+        for mask in _masks(shape):
+            rle = {"size": list(mask.shape), "counts": _rle_counts(mask)}
+            np.testing.assert_array_equal(rle_to_mask(rle), mask)
+
+    @pytest.mark.parametrize("shape", SHAPES)
+    def test_compressed_round_trip(self, shape):
+        pytest.importorskip("torch")
+        pytest.importorskip("pycocotools")
+        for mask in _masks(shape):
+            rle = mask_to_rle(mask)
+            if not isinstance(rle["counts"], str):
+                pytest.skip("The compressed encoder of sam3 is not available")
+            np.testing.assert_array_equal(rle_to_mask(rle), mask)
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from inference.metrics import (
+    compute_batch_metrics,
+    compute_dice,
+    compute_hd95,
+    compute_iou,
+    compute_nsd,
+    compute_precision_recall,
+    compute_psnr,
+    compute_ssim,
+)
+
+FIELDS = ("dice", "iou", "psnr", "ssim", "precision", "recall", "hd95", "nsd")
+
+
+def _masks(batch=6, height=37, width=53, seed=0):
+    """Random rectangle masks of an odd size, with an empty prediction and an empty pair."""
+    rng = np.random.default_rng(seed)
+    masks = np.zeros((2, batch, height, width), dtype=np.uint8)
+    for mask in masks.reshape(-1, height, width):
+        for _ in range(3):
+            top, left = rng.integers(0, height - 5), rng.integers(0, width - 5)
+            mask[top:top + rng.integers(3, 20), left:left + rng.integers(3, 25)] = 1
+    preds, gts = masks
+    preds[0] = 0
+    preds[1] = gts[1] = 0
+    return preds, gts
+
+
+def _square(top, left, size=20, shape=(64, 64)):
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[top:top + size, left:left + size] = 1
+    return mask
+
+
+class TestBatchMetrics:
+    def test_batch_matches_per_mask_functions(self):
+        preds, gts = _masks()
+        batch = compute_batch_metrics(preds, gts)
+
+        for metrics, pred, gt in zip(batch, preds, gts):
+            precision, recall = compute_precision_recall(pred, gt)
+            expected = {
+                "dice": compute_dice(pred, gt),
+                "iou": compute_iou(pred, gt),
+                "psnr": compute_psnr(pred, gt),
+                "ssim": compute_ssim(pred, gt),
+                "precision": precision,
+                "recall": recall,
+                "hd95": compute_hd95(pred, gt),
+                "nsd": compute_nsd(pred, gt),
+            }
+            for name, value in expected.items():
+                np.testing.assert_allclose(getattr(metrics, name), value, rtol=1e-6, err_msg=name)
+
+    def test_mask_lists_are_grouped_by_size(self):
+        preds, gts = _masks()
+        small_preds, small_gts = _masks(batch=3, height=24, width=19, seed=1)
+        mixed = compute_batch_metrics(
+            [preds[0], small_preds[0], preds[2], small_preds[2]],
+            [gts[0], small_gts[0], gts[2], small_gts[2]],
+        )
+        expected = [
+            compute_batch_metrics(preds, gts)[0],
+            compute_batch_metrics(small_preds, small_gts)[0],
+            compute_batch_metrics(preds, gts)[2],
+            compute_batch_metrics(small_preds, small_gts)[2],
+        ]
+        for metrics, reference in zip(mixed, expected):
+            for name in FIELDS:
+                np.testing.assert_allclose(getattr(metrics, name), getattr(reference, name), err_msg=name)
+
+    def test_torch_cpu_matches_numpy(self):
+        torch = pytest.importorskip("torch")
+        preds, gts = _masks()
+        expected = compute_batch_metrics(preds, gts)
+        batch = compute_batch_metrics(torch.from_numpy(preds), torch.from_numpy(gts))
+
+        for metrics, reference in zip(batch, expected):
+            for name in FIELDS:
+                # SSIM filters in float32, by convolution instead of shifted sums
+                np.testing.assert_allclose(
+                    getattr(metrics, name), getattr(reference, name), rtol=1e-5, atol=1e-6, err_msg=name
+                )
+
+
+class TestBoundaryMetrics:
+    def test_both_empty(self):
+        empty = np.zeros((32, 32), dtype=np.uint8)
+        assert compute_hd95(empty, empty) == 0.0
+        assert compute_nsd(empty, empty) == 1.0
+
+    def test_one_empty(self):
+        empty = np.zeros((32, 32), dtype=np.uint8)
+        mask = _square(8, 8, size=10, shape=(32, 32))
+        for pred, gt in ((empty, mask), (mask, empty)):
+            assert compute_hd95(pred, gt) == np.inf
+            assert compute_nsd(pred, gt) == 0.0
+
+    def test_offset_squares(self):
+        # Two 20x20 squares 5 px apart horizontally: each border has 76 pixels.
+        # Distances to the other border (the same in both directions): 0 for
+        # the 30 pixels on the shared top and bottom rows, 1 to 4 for 16 pixels
+        # near the corners, and 5 for the 30 others, so the 95th percentile is 5.
+        gt = _square(20, 20)
+        pred = _square(20, 25)
+        assert compute_hd95(pred, gt) == pytest.approx(5.0)
+        # 38 of the 76 distances are within 2 px (2.5 keeps exact 2s in)
+        assert compute_nsd(pred, gt, tolerance=2.5) == pytest.approx(0.5)
+
+
+class TestSSIM:
+    def test_identical_masks(self):
+        preds, _ = _masks()
+        for mask in preds:
+            assert compute_ssim(mask, mask) == pytest.approx(1.0)
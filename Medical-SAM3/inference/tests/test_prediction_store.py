@@ -0,0 +1,54 @@
+import numpy as np
+
+from inference.prediction_store import PredictionStore
+
+MODEL = "test-model"
+PROMPT = "text:thyroid nodule"
+
+
+def _mask(seed):
+    return (np.random.default_rng(seed).random((9, 11)) < 0.5).astype(np.uint8)
+
+
+class TestPredictionStore:
+    def test_two_writers_reload(self, tmp_path):
+        first, second = PredictionStore(tmp_path), PredictionStore(tmp_path)
+        first.add("DDTI", "s1", MODEL, PROMPT, _mask(1), score=0.9, box=[1, 2, 8, 7], time_s=0.5)
+        second.add("DDTI", "s2", MODEL, PROMPT, _mask(2), score=0.8)
+        first.close()
+        second.close()
+        assert len(list(tmp_path.glob("*.jsonl"))) == 2
+
+        reloaded = PredictionStore(tmp_path)
+        assert len(reloaded) == 2
+        record = reloaded.get("DDTI", "s1", MODEL, PROMPT)
+        assert record["score"] == 0.9
+        assert record["box"] == [1, 2, 8, 7]
+        np.testing.assert_array_equal(PredictionStore.mask(record), _mask(1))
+        np.testing.assert_array_equal(PredictionStore.mask(reloaded.get("DDTI", "s2", MODEL, PROMPT)), _mask(2))
+
+    def test_missing_prediction(self, tmp_path):
+        store = PredictionStore(tmp_path)
+        store.add("DDTI", "s1", MODEL, PROMPT, None)
+        store.close()
+        assert PredictionStore.mask(PredictionStore(tmp_path).get("DDTI", "s1", MODEL, PROMPT)) is None
+
+    def test_truncated_last_line_is_skipped(self, tmp_path):
+        store = PredictionStore(tmp_path)
+        store.add("DDTI", "s1", MODEL, PROMPT, _mask(1))
+        store.add("DDTI", "s2", MODEL, PROMPT, _mask(2))
+        store.close()
+
+        # Cut the last record short, as a crash in the middle of a write would
+        segment = next(tmp_path.glob("*.jsonl"))
+        first, last = segment.read_text().splitlines(keepends=True)
+        segment.write_text(first + last[:len(last) // 2])
+
+        reloaded = PredictionStore(tmp_path)
+        assert len(reloaded) == 1
+        assert reloaded.get("DDTI", "s2", MODEL, PROMPT) is None
+
+        # The resumed run stores the lost prediction again
+        reloaded.add("DDTI", "s2", MODEL, PROMPT, _mask(2))
+        reloaded.close()
+        assert len(PredictionStore(tmp_path)) == 2
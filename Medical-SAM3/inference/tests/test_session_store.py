@@ -0,0 +1,117 @@
+import types
+
+import numpy as np
+import pytest
+
+from inference import session_store
+from inference.session_store import SessionStore
+
+# Every test image is 1000 bytes
+IMAGE_BYTES = 1000
+
+
+def _image():
+    return np.zeros((10, 100), dtype=np.uint8)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace the store's monotonic clock with one advanced by hand."""
+    fake = types.SimpleNamespace(now=0.0)
+    monkeypatch.setattr(session_store, "time", types.SimpleNamespace(monotonic=lambda: fake.now))
+    return fake
+
+
+class TestSessionStore:
+    def test_sessions_expire_after_ttl_of_inactivity(self, clock):
+        removed = []
+        store = SessionStore(ttl_seconds=10, on_remove=removed.append)
+        first = store.create(_image(), None)
+        second = store.create(_image(), None)
+
+        clock.now = 8
+        assert store.get(first.image_id) is first
+        clock.now = 15
+        # The second session was idle for 15s, the first only for 7s
+        assert store.get(second.image_id) is None
+        assert store.get(first.image_id) is first
+        assert removed == [second]
+        assert store.expired == 1
+        assert store.current_bytes == IMAGE_BYTES
+
+    def test_least_recently_used_sessions_are_evicted_over_budget(self, clock):
+        removed = []
+        store = SessionStore(max_bytes=2 * IMAGE_BYTES, on_remove=removed.append)
+        first = store.create(_image(), None)
+        second = store.create(_image(), None)
+        store.get(first.image_id)
+        third = store.create(_image(), None)
+
+        assert removed == [second]
+        assert store.get(first.image_id) is first and store.get(third.image_id) is third
+        assert store.current_bytes == 2 * IMAGE_BYTES
+        assert store.evicted == 1
+
+    def test_new_session_is_kept_even_over_budget(self, clock):
+        store = SessionStore(max_bytes=IMAGE_BYTES // 2)
+        first = store.create(_image(), None)
+        second = store.create(_image(), None)
+        assert store.get(first.image_id) is None
+        assert store.get(second.image_id) is second
+
+    def test_max_sessions_per_worker(self, clock):
+        removed = []
+        store = SessionStore(max_sessions_per_worker=2, on_remove=removed.append)
+        held = [store.create(_image(), None, worker=0) for _ in range(3)]
+        other = store.create(_image(), None, worker=1)
+
+        assert removed == [held[0]]
+        assert store.stats()["sessions"] == 3
+        assert store.get(other.image_id) is other
+
+    def test_delete(self, clock):
+        removed = []
+        store = SessionStore(on_remove=removed.append)
+        session = store.create(_image(), None)
+        assert store.delete(session.image_id)
+        assert not store.delete(session.image_id)
+        assert removed == [session]
+        assert store.current_bytes == 0
+
+    def test_remeasure_counts_prompt_outputs_but_not_shared_tensors(self, clock):
+        torch = pytest.importorskip("torch")
+        from inference.embedding_cache import tensor_keys
+
+        # 4000 bytes of image features, owned by the embedding cache
+        features = torch.zeros(1000)
+        removed = []
+        store = SessionStore(
+            max_bytes=5 * IMAGE_BYTES,
+            on_remove=removed.append,
+            shared_tensors=lambda: tensor_keys(features),
+        )
+        idle = store.create(_image(), None)
+        session = store.create(_image(), {"backbone_out": {"vision_features": features}})
+        assert session.nbytes == IMAGE_BYTES
+
+        # A prompt adds 2000 bytes of predictions to the state
+        session.inference_state["raw_outputs"] = torch.zeros(500)
+        store.remeasure(session)
+        assert session.nbytes == 3 * IMAGE_BYTES
+        assert store.current_bytes == 4 * IMAGE_BYTES
+        assert not removed
+
+        # Another 2000 bytes go over the budget: the idle session is evicted
+        session.inference_state["refine_logits"] = torch.zeros(500)
+        store.remeasure(session)
+        assert removed == [idle]
+        assert store.current_bytes == 5 * IMAGE_BYTES
+
+    def test_remeasure_ignores_removed_sessions(self, clock):
+        torch = pytest.importorskip("torch")
+        store = SessionStore()
+        session = store.create(_image(), {"raw_outputs": torch.zeros(10)})
+        store.delete(session.image_id)
+        session.inference_state["raw_outputs"] = torch.zeros(1000)
+        store.remeasure(session)
+        assert store.current_bytes == 0
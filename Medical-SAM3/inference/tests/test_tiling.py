@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from inference.tiling import TiledSegmenter, _BlendBand, tile_grid, tile_weights
+
+
+class ObjectLazyMasks:
+    """Stands in for LazyMasks: one exact instance per object value of a tile."""
+
+    def __init__(self, objects: np.ndarray):
+        self.values = [v for v in np.unique(objects) if v]
+        self.objects = objects
+        self.scores = torch.tensor([v / 255 for v in self.values], dtype=torch.float32)
+
+    def roi(self, index, padding=0):
+        mask = self.objects == self.values[index]
+        ys, xs = np.nonzero(mask)
+        x0, y0, x1, y1 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+        return (x0, y0, x1, y1), torch.from_numpy(mask[y0:y1, x0:x1].astype(np.float32))
+
+
+class ObjectModel:
+    """Stands in for SAM3Model: segments the objects drawn in the first channel."""
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode_images(self, images):
+        self.encoded.append(len(images))
+        return {"backbone_out": {"features": torch.zeros(len(images), 256)}, "images": images}
+
+    def ground_text_batch(self, batch_state, prompts):
+        return [{"lazy_masks": ObjectLazyMasks(image[..., 0])} for image in batch_state["images"]]
+
+
+def _image(height, width, objects):
+    """RGB image with a rectangle of value v for each (v, y0, x0, y1, x1) object."""
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    for value, y0, x0, y1, x1 in objects:
+        image[y0:y1, x0:x1] = value
+    return image
+
+
+class TestTileGrid:
+    @pytest.mark.parametrize("height,width", [(224, 224), (300, 517), (128, 128), (50, 700)])
+    def test_tiles_cover_the_image_with_overlap(self, height, width):
+        tile_size, overlap = 128, 32
+        tiles = tile_grid(height, width, tile_size, overlap)
+        covered = np.zeros((height, width), dtype=int)
+        for tile in tiles:
+            assert 0 < tile.height <= tile_size and 0 < tile.width <= tile_size
+            covered[tile.y0:tile.y1, tile.x0:tile.x1] += 1
+        assert covered.min() >= 1
+        # Row-major, and neighbours overlap by at least ``overlap``
+        assert [t.index for t in tiles] == list(range(len(tiles)))
+        assert [(t.row, t.col) for t in tiles] == sorted((t.row, t.col) for t in tiles)
+        for a, b in zip(tiles, tiles[1:]):
+            if a.row == b.row:
+                assert a.x1 - b.x0 >= overlap
+
+    def test_small_image_is_one_tile(self):
+        [tile] = tile_grid(100, 80, 128, 32)
+        assert (tile.x0, tile.y0, tile.x1, tile.y1) == (0, 0, 80, 100)
+
+    def test_overlap_must_be_below_half_a_tile(self):
+        with pytest.raises(ValueError):
+            tile_grid(500, 500, 128, 64)
+
+    def test_weights_are_positive_everywhere(self):
+        height, width, overlap = 300, 517, 32
+        total = np.zeros((height, width), dtype=np.float32)
+        for tile in tile_grid(height, width, 128, overlap):
+            weights = tile_weights(tile, height, width, overlap)
+            assert weights.shape == (tile.height, tile.width)
+            total[tile.y0:tile.y1, tile.x0:tile.x1] += weights
+        assert total.min() > 0
+
+
+class TestBlendBand:
+    def test_consistent_tiles_stitch_exactly(self):
+        height, width, overlap = 300, 517, 32
+        # Away from 0.5, so that rounding in the blend cannot flip a pixel
+        probs = np.random.default_rng(0).choice([0.1, 0.3, 0.7, 0.9], (height, width)).astype(np.float32)
+        out = np.full((height, width), 7, dtype=np.uint8)
+        band = _BlendBand(out)
+        for tile in tile_grid(height, width, 128, overlap):
+            band.add(tile, probs[tile.y0:tile.y1, tile.x0:tile.x1], tile_weights(tile, height, width, overlap))
+            # Only the rows still covered by upcoming tiles are buffered
+            assert band.y1 - band.y0 <= 128
+        band.close()
+        np.testing.assert_array_equal(out, probs > 0.5)
+
+
+class TestTiledSegmenter:
+    def test_mask_and_cross_tile_nms(self):
+        pytest.importorskip("sam3.perflib.nms")
+        # 2x2 tiles of 128 px starting at 0 and 96: the first object lies in
+        # the window all four tiles share, the second in the first tile only
+        image = _image(224, 224, [(200, 100, 100, 120, 120), (100, 10, 10, 40, 40)])
+        model = ObjectModel()
+        result = TiledSegmenter(model, tile_size=128, overlap=32, batch_size=2).segment_text(image, "object")
+
+        np.testing.assert_array_equal(result.mask, image[..., 0] > 0)
+        assert result.num_tiles == 4
+        assert sum(model.encoded) == 4 and model.encoded[0] == 1
+        # The shared object is detected by every tile and kept once
+        assert result.num_suppressed == 3
+        assert sorted(inst.box for inst in result.instances) == [(10, 10, 40, 40), (100, 100, 120, 120)]
+
+    def test_instance_masks_are_released_unless_kept(self):
+        pytest.importorskip("sam3.perflib.nms")
+        image = _image(224, 224, [(200, 100, 100, 120, 120)])
+        released = TiledSegmenter(ObjectModel(), tile_size=128, overlap=32).segment_text(image, "object")
+        assert all(inst.mask is None for inst in released.instances)
+
+        kept = TiledSegmenter(ObjectModel(), tile_size=128, overlap=32, keep_instance_masks=True).segment_text(
+            image, "object"
+        )
+        [instance] = kept.instances
+        assert instance.mask.all() and instance.mask.shape == (20, 20)
+
+    def test_out_of_budget_mask_is_memory_mapped(self):
+        pytest.importorskip("sam3.perflib.nms")
+        image = _image(224, 224, [(100, 10, 10, 40, 40)])
+        # An in-memory mask may take a quarter of the budget, 0.01 MiB is too little
+        result = TiledSegmenter(ObjectModel(), tile_size=128, overlap=32, max_memory_mb=0.01).segment_text(
+            image, "object"
+        )
+        assert isinstance(result.mask, np.memmap)
+        np.testing.assert_array_equal(result.mask, image[..., 0] > 0)
+        assert result.batch_size == 1
@@ -0,0 +1,384 @@
+"""
+Tiled sliding-window segmentation for images much larger than the model input.
+
+Downscaling a large fundus or histology image to the 1008 px model input
+erases thin structures such as vessels and nuclei boundaries. Here the image
+is cut into overlapping tiles at native resolution. Tiles are encoded in
+batches, each tile is grounded with the text prompt, and the per-tile
+results are stitched back:
+
+- the mask blends the tile probabilities with weights that ramp down across
+  the overlaps, so tile borders do not show;
+- instances detected in two tiles are deduplicated with a cross-tile NMS
+  (``perflib.nms.nms_masks``) restricted to the window the tiles share.
+
+Tiles are read from the source array one batch at a time and the mask is
+written band by band, so the input can be a ``np.memmap`` of an image that
+does not fit in memory. Nothing is ever resized to the model resolution
+beyond one batch of tiles.
+"""
+
+import math
+import tempfile
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+try:
+    from inference.embedding_cache import tensor_nbytes
+except ModuleNotFoundError:
+    from embedding_cache import tensor_nbytes
+
+
+@dataclass(frozen=True)
+class Tile:
+    """A tile of the source image, in pixel coordinates (end exclusive)."""
+    index: int
+    row: int
+    col: int
+    x0: int
+    y0: int
+    x1: int
+    y1: int
+
+    @property
+    def height(self) -> int:
+        return self.y1 - self.y0
+
+    @property
+    def width(self) -> int:
+        return self.x1 - self.x0
+
+    def intersection(self, other: "Tile") -> Optional[Tuple[int, int, int, int]]:
+        """Shared window (x0, y0, x1, y1) with another tile, or None."""
+        x0, y0 = max(self.x0, other.x0), max(self.y0, other.y0)
+        x1, y1 = min(self.x1, other.x1), min(self.y1, other.y1)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+
+@dataclass
+class TileInstance:
+    """One detection of a tile, in image coordinates."""
+    tile: int
+    score: float
+    box: Tuple[int, int, int, int]   # x0, y0, x1, y1 of the mask crop
+    mask: Optional[np.ndarray]       # Binary mask of the box, None once released
+    suppressed: bool = False
+
+    def mask_in(self, window: Tuple[int, int, int, int]) -> np.ndarray:
+        """The instance mask rendered in a window of the image."""
+        wx0, wy0, wx1, wy1 = window
+        x0, y0, x1, y1 = self.box
+        out = np.zeros((wy1 - wy0, wx1 - wx0), dtype=bool)
+        ix0, iy0, ix1, iy1 = max(x0, wx0), max(y0, wy0), min(x1, wx1), min(y1, wy1)
+        if ix0 < ix1 and iy0 < iy1:
+            out[iy0 - wy0:iy1 - wy0, ix0 - wx0:ix1 - wx0] = self.mask[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+        return out
+
+
+@dataclass
+class TiledResult:
+    mask: np.ndarray                 # (H, W) uint8 mask, possibly a np.memmap
+    instances: List[TileInstance]    # Detections kept by the cross-tile NMS
+    num_tiles: int
+    num_suppressed: int
+    batch_size: int                  # Tiles per batch after applying the memory cap
+
+
+def _tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    """Evenly spaced tile starts covering [0, length) with at least ``overlap`` pixels of overlap."""
+    if length <= tile_size:
+        return [0]
+    count = math.ceil((length - overlap) / (tile_size - overlap))
+    return [int(round(s)) for s in np.linspace(0, length - tile_size, count)]
+
+
+def tile_grid(height: int, width: int, tile_size: int = 1008, overlap: int = 128) -> List[Tile]:
+    """
+    Cover an image with overlapping tiles, in row-major order.
+
+    Args:
+        height: Image height
+        width: Image width
+        tile_size: Tile side (the model input size avoids any resize)
+        overlap: Minimum overlap between neighbouring tiles
+
+    Returns:
+        Tiles, at most tile_size wide and high
+    """
+    if not 0 <= overlap < tile_size // 2:
+        raise ValueError(f"overlap must be in [0, {tile_size // 2}), got {overlap}")
+    tiles = []
+    for row, y0 in enumerate(_tile_starts(height, tile_size, overlap)):
+        for col, x0 in enumerate(_tile_starts(width, tile_size, overlap)):
+            tiles.append(Tile(
+                len(tiles), row, col, x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height)
+            ))
+    return tiles
+
+
+def read_tile(image: np.ndarray, tile: Tile) -> np.ndarray:
+    """Copy one tile out of a (possibly memory-mapped) image as contiguous RGB uint8."""
+    crop = np.asarray(image[tile.y0:tile.y1, tile.x0:tile.x1])
+    if crop.ndim == 2:
+        crop = crop[..., None]
+    if crop.shape[2] == 1:
+        crop = np.repeat(crop, 3, axis=2)
+    elif crop.shape[2] > 3:
+        crop = crop[..., :3]
+    if crop.dtype != np.uint8:
+        raise ValueError(f"Expected a uint8 image, got {crop.dtype}")
+    return np.ascontiguousarray(crop)
+
+
+def iter_tiles(image: np.ndarray, tile_size: int = 1008, overlap: int = 128) -> Iterator[Tuple[Tile, np.ndarray]]:
+    """Stream the tiles of an image, reading each one only when it is requested."""
+    for tile in tile_grid(image.shape[0], image.shape[1], tile_size, overlap):
+        yield tile, read_tile(image, tile)
+
+
+def tile_weights(tile: Tile, height: int, width: int, overlap: int) -> np.ndarray:
+    """
+    Blending weights of a tile: 1 inside, ramping down over ``overlap`` pixels
+    on each side that has a neighbour. Complementary ramps sum to 1.
+    """
+    def ramp(length, lead, trail):
+        weights = np.ones(length, dtype=np.float32)
+        n = min(overlap, length)
+        r = (np.arange(n, dtype=np.float32) + 1) / (n + 1)
+        if lead:
+            weights[:n] = np.minimum(weights[:n], r)
+        if trail:
+            weights[length - n:] = np.minimum(weights[length - n:], r[::-1])
+        return weights
+
+    wy = ramp(tile.height, tile.y0 > 0, tile.y1 < height)
+    wx = ramp(tile.width, tile.x0 > 0, tile.x1 < width)
+    return wy[:, None] * wx[None, :]
+
+
+class _BlendBand:
+    """Blending accumulators for the rows still covered by upcoming tiles."""
+
+    def __init__(self, out: np.ndarray):
+        self.out = out
+        self.y0 = 0
+        self.acc = np.zeros((0, out.shape[1]), dtype=np.float32)
+        self.weight = np.zeros((0, out.shape[1]), dtype=np.float32)
+
+    @property
+    def y1(self) -> int:
+        return self.y0 + self.acc.shape[0]
+
+    def add(self, tile: Tile, probs: np.ndarray, weights: np.ndarray):
+        # Tiles come in row-major order: rows above this tile are final
+        if tile.y0 > self.y0:
+            self._flush(min(tile.y0, self.y1))
+            self.y0 = max(self.y0, tile.y0)
+        if tile.y1 > self.y1:
+            extra = np.zeros((tile.y1 - self.y1, self.acc.shape[1]), dtype=np.float32)
+            self.acc = np.concatenate([self.acc, extra])
+            self.weight = np.concatenate([self.weight, extra])
+
+        rows = slice(tile.y0 - self.y0, tile.y1 - self.y0)
+        cols = slice(tile.x0, tile.x1)
+        self.acc[rows, cols] += weights * probs
+        self.weight[rows, cols] += weights
+
+    def _flush(self, y: int):
+        """Threshold the blended probabilities of rows [y0, y) into the output."""
+        n = y - self.y0
+        if n <= 0:
+            return
+        # acc / weight > 0.5 without dividing (weight > 0 wherever a tile was added)
+        self.out[self.y0:y] = self.acc[:n] > 0.5 * self.weight[:n]
+        self.acc = self.acc[n:].copy()
+        self.weight = self.weight[n:].copy()
+        self.y0 = y
+
+    def close(self):
+        self._flush(self.y1)
+
+
+class TiledSegmenter:
+    """Text-prompted segmentation of large images with overlapping tiles."""
+
+    def __init__(
+        self,
+        model,
+        tile_size: int = 1008,
+        overlap: int = 128,
+        batch_size: int = 4,
+        max_memory_mb: float = 2048,
+        iou_threshold: float = 0.5,
+        padding: int = 8,
+        instances_per_tile: Optional[int] = None,
+        keep_instance_masks: bool = False,
+    ):
+        """
+        Initialize the segmenter.
+
+        Args:
+            model: SAM3Model used to encode and ground the tiles
+            tile_size: Tile side in image pixels (1008 matches the model input)
+            overlap: Minimum overlap between neighbouring tiles
+            batch_size: Maximum number of tiles encoded together
+            max_memory_mb: Memory budget for the tile batches, blending band and
+                output mask. Larger outputs are written to a temporary memory map
+            iou_threshold: Mask IoU above which two detections are duplicates
+            padding: Pixels kept around each detection box when upsampling it
+            instances_per_tile: Keep only the best k detections of each tile
+            keep_instance_masks: Keep the mask crop of every returned instance
+                (memory grows with the image), otherwise only boxes and scores
+        """
+        self.model = model
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.iou_threshold = iou_threshold
+        self.padding = padding
+        self.instances_per_tile = instances_per_tile
+        self.keep_instance_masks = keep_instance_masks
+
+    def _allocate_output(self, height: int, width: int) -> np.ndarray:
+        if height * width <= self.max_memory_bytes // 4:
+            return np.zeros((height, width), dtype=np.uint8)
+        # Too large for the budget: back the mask by a temporary file
+        return np.memmap(tempfile.TemporaryFile(prefix="sam3-tiled-"), dtype=np.uint8, mode="w+", shape=(height, width))
+
+    def _capped_batch_size(self, state: dict, num_tiles: int, width: int) -> int:
+        """Largest batch whose embeddings fit the budget, measured on the first batch."""
+        per_tile = tensor_nbytes(state["backbone_out"]) / num_tiles
+        band_bytes = 2 * 4 * 2 * self.tile_size * width
+        budget = self.max_memory_bytes - band_bytes
+        # Activations of the backbone and grounding passes about double the embeddings
+        return int(max(1, min(self.batch_size, budget // max(2 * per_tile, 1))))
+
+    def _tile_instances(self, tile: Tile, state: dict) -> Tuple[np.ndarray, List[TileInstance]]:
+        """Upsample the detections of a tile inside their boxes only."""
+        lazy_masks = state["lazy_masks"]
+        probs = np.zeros((tile.height, tile.width), dtype=np.float32)
+        order = torch.argsort(lazy_masks.scores, descending=True).tolist()
+        if self.instances_per_tile is not None:
+            order = order[:self.instances_per_tile]
+
+        instances = []
+        for i in order:
+            (bx0, by0, bx1, by1), roi_probs = lazy_masks.roi(i, padding=self.padding)
+            roi_probs = roi_probs.float().cpu().numpy()
+            region = probs[by0:by1, bx0:bx1]
+            np.maximum(region, roi_probs, out=region)
+
+            mask = roi_probs > 0.5
+            if mask.any():
+                instances.append(TileInstance(
+                    tile=tile.index,
+                    score=float(lazy_masks.scores[i]),
+                    box=(tile.x0 + bx0, tile.y0 + by0, tile.x0 + bx1, tile.y0 + by1),
+                    mask=mask,
+                ))
+        return probs, instances
+
+    def _suppress_duplicates(self, tile: Tile, instances: List[TileInstance], neighbours) -> int:
+        """Cross-tile NMS between a tile and the already processed tiles it overlaps."""
+        from sam3.perflib.nms import nms_masks
+
+        suppressed = 0
+        for other, other_instances in neighbours:
+            window = tile.intersection(other)
+            if window is None:
+                continue
+            candidates = [
+                inst for inst in instances + other_instances
+                if not inst.suppressed and _boxes_intersect(inst.box, window)
+            ]
+            if not any(c.tile == tile.index for c in candidates) or all(c.tile == tile.index for c in candidates):
+                continue
+
+            masks = torch.from_numpy(np.stack([c.mask_in(window) for c in candidates])).float()
+            scores = torch.tensor([c.score for c in candidates])
+            keep = nms_masks(scores, masks, prob_threshold=0.0, iou_threshold=self.iou_threshold)
+            for candidate, kept in zip(candidates, keep.tolist()):
+                if not kept:
+                    candidate.suppressed = True
+                    suppressed += 1
+        return suppressed
+
+    def _release(self, instances: List[TileInstance]):
+        if not self.keep_instance_masks:
+            for inst in instances:
+                inst.mask = None
+
+    def segment_text(self, image: np.ndarray, prompt: str, out: Optional[np.ndarray] = None) -> TiledResult:
+        """
+        Segment an image tile by tile with a text prompt.
+
+        Args:
+            image: RGB (or grayscale) uint8 image (H, W[, C]), may be a np.memmap
+            prompt: Text prompt applied to every tile
+            out: Optional (H, W) uint8 array receiving the mask
+
+        Returns:
+            The stitched mask and the deduplicated detections
+        """
+        height, width = image.shape[:2]
+        tiles = tile_grid(height, width, self.tile_size, self.overlap)
+        if out is None:
+            out = self._allocate_output(height, width)
+        band = _BlendBand(out)
+
+        # Tiles whose detections can still overlap upcoming tiles
+        retained = []
+        instances = []
+        num_suppressed = 0
+
+        # The first batch has a single tile to measure the memory cost of one tile
+        batch_size = 1
+        position = 0
+        while position < len(tiles):
+            batch = tiles[position:position + batch_size]
+            crops = [read_tile(image, tile) for tile in batch]
+            batch_state = self.model.encode_images(crops)
+            if position == 0:
+                batch_size = self._capped_batch_size(batch_state, len(batch), width)
+            position += len(batch)
+            tile_states = self.model.ground_text_batch(batch_state, [prompt] * len(batch))
+            del batch_state, crops
+
+            for tile, tile_state in zip(batch, tile_states):
+                probs, tile_instances = self._tile_instances(tile, tile_state)
+
+                still_retained = []
+                for other, other_instances in retained:
+                    if other.y1 <= tile.y0:
+                        self._release(other_instances)
+                    else:
+                        still_retained.append((other, other_instances))
+                retained = still_retained
+
+                num_suppressed += self._suppress_duplicates(tile, tile_instances, retained)
+                retained.append((tile, tile_instances))
+                instances.extend(tile_instances)
+
+                band.add(tile, probs, tile_weights(tile, height, width, self.overlap))
+
+        band.close()
+        for _, other_instances in retained:
+            self._release(other_instances)
+
+        return TiledResult(
+            mask=out,
+            instances=[inst for inst in instances if not inst.suppressed],
+            num_tiles=len(tiles),
+            num_suppressed=num_suppressed,
+            batch_size=batch_size,
+        )
+
+
+def _boxes_intersect(box: Tuple[int, int, int, int], window: Tuple[int, int, int, int]) -> bool:
+    return box[0] < window[2] and window[0] < box[2] and box[1] < window[3] and window[1] < box[3]
@@ -0,0 +1,218 @@
+"""
+Volumetric segmentation of CT/MRI slice stacks with the SAM3 video predictor.
+
+The slices are treated as the frames of a video: key slices are prompted
+(a text prompt on one slice, and/or clicks on any slice) and the objects are
+propagated through the stack in both directions. The predictor's frame loader
+reads and windows the slices in a background thread, in slice order from the
+first one (a slice propagation reaches before the thread does is loaded on
+demand), and text features and tracker memories are shared by the whole
+stack, instead of one independent request per slice.
+
+Requires CUDA (``Sam3VideoPredictor`` runs on the GPU).
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+try:
+    from inference.dicom import DicomSeries
+except ModuleNotFoundError:
+    from dicom import DicomSeries
+
+
+class SliceFrames:
+    """
+    The slices of a volume as a sequence of (H, W, 3) uint8 frames, read on
+    demand by the video frame loader.
+
+    Args:
+        volume: DICOM series, or (N, H, W) / (N, H, W, 3) uint8 array
+        window: (center, width) for DICOM series, see ``DicomSeries.display``
+    """
+
+    def __init__(self, volume: Union[DicomSeries, np.ndarray], window: Optional[Tuple[float, float]] = None):
+        self.volume = volume
+        self.window = window
+
+    def __len__(self) -> int:
+        return len(self.volume)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if isinstance(self.volume, DicomSeries):
+            return self.volume.image(index, self.window)
+        frame = self.volume[index]
+        return np.repeat(frame[..., None], 3, axis=-1) if frame.ndim == 2 else frame
+
+
+@dataclass
+class Click:
+    """Clicks of one object on one slice, in pixels of the slice."""
+
+    slice_index: int
+    obj_id: int
+    points: Sequence[Tuple[float, float]]
+    labels: Sequence[int] = ()
+
+
+@dataclass
+class VolumeResult:
+    """
+    Segmentation of a volume.
+
+    Attributes:
+        labels: (N, H, W) object id per voxel, 0 for background
+        objects: Per object id: "voxels", "slices" (first, last), "score",
+            and "volume_ml" when the voxel spacing is known
+    """
+
+    labels: np.ndarray
+    objects: Dict[int, dict] = field(default_factory=dict)
+
+    def mask(self, obj_id: Optional[int] = None) -> np.ndarray:
+        """(N, H, W) boolean mask of an object, or of all objects if None."""
+        return self.labels > 0 if obj_id is None else self.labels == obj_id
+
+
+class VolumeSegmenter:
+    """
+    Prompt key slices of a volume and propagate through the others.
+
+    Args:
+        checkpoint_path: Medical-SAM3 checkpoint whose detector weights replace
+            the SAM3 ones (the tracker keeps the SAM3 weights); SAM3 if None
+        async_loading_frames: Load all slices in order in a background thread
+            instead of before the session starts
+        predictor: Existing ``Sam3VideoPredictor`` to use
+    """
+
+    def __init__(self, checkpoint_path: Optional[str] = None, async_loading_frames: bool = True, predictor=None):
+        self.checkpoint_path = checkpoint_path
+        self.async_loading_frames = async_loading_frames
+        self._predictor = predictor
+
+    @property
+    def predictor(self):
+        if self._predictor is None:
+            self._predictor = self._build_predictor()
+        return self._predictor
+
+    def _build_predictor(self):
+        if not torch.cuda.is_available():
+            raise RuntimeError("Volume segmentation needs a CUDA device")
+        from sam3.model.sam3_video_predictor import Sam3VideoPredictor
+        from sam3.model_builder import load_safetensors_state_dict, normalize_checkpoint_state_dict
+
+        predictor = Sam3VideoPredictor(async_loading_frames=self.async_loading_frames)
+        if self.checkpoint_path is not None:
+            if self.checkpoint_path.endswith(".safetensors"):
+                state_dict = load_safetensors_state_dict(self.checkpoint_path)
+            else:
+                state_dict = torch.load(self.checkpoint_path, map_location="cpu", weights_only=False)
+            state_dict = normalize_checkpoint_state_dict(state_dict, include_tracker=False)
+            missing, _ = predictor.model.detector.load_state_dict(state_dict, strict=False)
+            if missing:
+                print(f"Volume model: {len(missing)} detector weights not in the checkpoint")
+        return predictor
+
+    def segment(
+        self,
+        volume: Union[DicomSeries, np.ndarray],
+        text_prompt: Optional[str] = None,
+        key_slice: Optional[int] = None,
+        clicks: Sequence[Click] = (),
+        window: Optional[Tuple[float, float]] = None,
+        spacing: Optional[Tuple[float, float, float]] = None,
+    ) -> VolumeResult:
+        """
+        Segment a volume from prompts on key slices.
+
+        Args:
+            volume: DICOM series, or (N, H, W) / (N, H, W, 3) uint8 array
+            text_prompt: Text description of the targets, detected on ``key_slice``
+            key_slice: Slice the text prompt is run on (default: the middle one)
+            clicks: Point prompts adding (new obj_id) or refining objects
+            window: (center, width) for DICOM series
+            spacing: (slice, row, column) voxel size in mm, taken from the series
+                if None
+
+        Returns:
+            Label volume and per-object statistics
+        """
+        if text_prompt is None and not clicks:
+            raise ValueError("Provide a text prompt or clicks")
+        frames = SliceFrames(volume, window)
+        if spacing is None and isinstance(volume, DicomSeries) and volume.pixel_spacing and volume.slice_spacing:
+            spacing = (volume.slice_spacing, *volume.pixel_spacing)
+
+        predictor = self.predictor
+        session_id = predictor.start_session(resource_path=frames)["session_id"]
+        height, width = frames[0].shape[:2]
+        labels = np.zeros((len(frames), height, width), dtype=np.uint16)
+        scores = {}
+        try:
+            if text_prompt is not None:
+                # Full propagation: the prompt is grounded on the key slice, then
+                # detections and tracks are associated slice by slice
+                start = len(frames) // 2 if key_slice is None else key_slice
+                predictor.add_prompt(session_id, frame_idx=start, text=text_prompt)
+                self._propagate(session_id, start, labels, scores)
+            if clicks:
+                # Tracker propagation of the clicked objects only, merged with
+                # the outputs of the text prompt
+                for click in clicks:
+                    predictor.add_prompt(
+                        session_id,
+                        frame_idx=click.slice_index,
+                        points=[[x / width, y / height] for x, y in click.points],
+                        point_labels=list(click.labels) or [1] * len(click.points),
+                        obj_id=click.obj_id,
+                    )
+                self._propagate(session_id, min(click.slice_index for click in clicks), labels, scores)
+        finally:
+            predictor.close_session(session_id)
+
+        return VolumeResult(labels, self._object_stats(labels, scores, spacing))
+
+    def _propagate(self, session_id: str, start: int, labels: np.ndarray, scores: Dict[int, float]):
+        """Propagate from ``start`` in both directions, painting each slice's objects into ``labels``."""
+        for output in self.predictor.propagate_in_video(
+            session_id, propagation_direction="both", start_frame_idx=start, max_frame_num_to_track=None
+        ):
+            outputs = output["outputs"]
+            if outputs is None:
+                continue
+            frame = labels[output["frame_index"]]
+            # Outputs hold all objects of the slice, already non-overlapping
+            frame[:] = 0
+            for obj_id, mask, score in zip(outputs["out_obj_ids"], outputs["out_binary_masks"], outputs["out_probs"]):
+                frame[mask] = obj_id
+                scores[int(obj_id)] = float(score)
+
+    @staticmethod
+    def _object_stats(labels: np.ndarray, scores: Dict[int, float], spacing) -> Dict[int, dict]:
+        present = [np.unique(frame) for frame in labels]
+        ids, voxels = np.unique(labels, return_counts=True)
+        objects = {}
+        for obj_id, count in zip(ids.tolist(), voxels.tolist()):
+            if obj_id == 0:
+                continue
+            slices = [index for index, frame_ids in enumerate(present) if obj_id in frame_ids]
+            stats = {"voxels": count, "slices": [slices[0], slices[-1]], "score": scores.get(obj_id)}
+            if spacing is not None:
+                stats["volume_ml"] = round(count * float(np.prod(spacing)) / 1000, 3)
+            objects[obj_id] = stats
+        return objects
+
+
+def segment_volume(
+    volume: Union[DicomSeries, np.ndarray],
+    text_prompt: Optional[str] = None,
+    checkpoint_path: Optional[str] = None,
+    **kwargs
+) -> VolumeResult:
+    """Shortcut for ``VolumeSegmenter(checkpoint_path).segment(volume, text_prompt, **kwargs)``."""
+    return VolumeSegmenter(checkpoint_path).segment(volume, text_prompt, **kwargs)
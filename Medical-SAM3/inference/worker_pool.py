@@ -0,0 +1,430 @@
+"""
+Multi-process model serving.
+
+The HTTP process dispatches requests to N worker processes, each holding one
+model replica pinned to a slice of CPU cores or to one GPU. Images and masks
+travel through ``multiprocessing.shared_memory``; only small request tuples
+are pickled through the queues.
+
+Image sessions are sticky: the inference state stays in the worker that
+encoded the image and later prompts for it are routed there.
+"""
+
+import asyncio
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+# Methods of SAM3Model a worker can run against a stored session
+SESSION_METHODS = ("predict_text", "predict_texts", "predict_box", "predict_points", "rescore", "refine")
+
+
+class SessionNotFound(LookupError):
+    """A session method was called for an image the worker does not hold (anymore)."""
+
+
+def _to_shm(array: np.ndarray):
+    """Copy an array into a new shared memory block and return (block, ref)."""
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach(ref):
+    """Attach to a shared memory block, returning (block, array view)."""
+    name, shape, dtype = ref
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _take_shm(ref) -> np.ndarray:
+    """Copy an array out of a shared memory block created by the other side and free it."""
+    shm, view = _attach(ref)
+    try:
+        return view.copy()
+    finally:
+        del view
+        shm.close()
+        shm.unlink()
+
+
+def _pack_result(result):
+    """Move masks to shared memory; everything else is pickled as is."""
+    if isinstance(result, np.ndarray):
+        shm, ref = _to_shm(result)
+        shm.close()
+        return ("array", ref)
+    if isinstance(result, list):
+        return ("list", [_pack_result(r) for r in result])
+    return ("value", result)
+
+
+def _unpack_result(packed):
+    kind, payload = packed
+    if kind == "array":
+        return _take_shm(payload)
+    if kind == "list":
+        return [_unpack_result(p) for p in payload]
+    return payload
+
+
+def _free_result(packed):
+    """Free the shared memory of a result that will not be unpacked."""
+    kind, payload = packed
+    if kind == "array":
+        shm = shared_memory.SharedMemory(name=payload[0])
+        shm.close()
+        shm.unlink()
+    elif kind == "list":
+        for p in payload:
+            _free_result(p)
+
+
+def _worker_main(index, requests, results, model_kwargs, device, cores, max_sessions):
+    """Worker process: build one model replica and serve requests until None is received."""
+    if device.startswith("cuda:"):
+        # Must happen before torch initializes CUDA in this process
+        os.environ["CUDA_VISIBLE_DEVICES"] = device.split(":", 1)[1]
+        device = "cuda"
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+    import torch
+    if cores:
+        torch.set_num_threads(len(cores))
+
+    try:
+        from inference.sam3_inference import SAM3Model, TextEmbeddingCache
+        from inference.embedding_cache import ImageEmbeddingCache
+    except ModuleNotFoundError:
+        from sam3_inference import SAM3Model, TextEmbeddingCache
+        from embedding_cache import ImageEmbeddingCache
+
+    # Caches hold locks and tensors, so each worker builds its own
+    model_kwargs = dict(model_kwargs)
+    embedding_cache_bytes = model_kwargs.pop("embedding_cache_bytes", 0)
+    text_cache_size = model_kwargs.pop("text_cache_size", 0)
+    text_cache_path = model_kwargs.pop("text_cache_path", None)
+    warmup_prompts = model_kwargs.pop("warmup_prompts", None)
+    warmup_image_size = model_kwargs.pop("warmup_image_size", 0)
+    if embedding_cache_bytes > 0:
+        model_kwargs["embedding_cache"] = ImageEmbeddingCache(max_bytes=embedding_cache_bytes)
+    if text_cache_size > 0:
+        model_kwargs["text_cache"] = TextEmbeddingCache(max_entries=text_cache_size)
+
+    try:
+        model = SAM3Model(device=device, **model_kwargs)
+        model.load_model()
+        if text_cache_path and os.path.exists(text_cache_path):
+            model.load_text_cache(text_cache_path)
+        if warmup_prompts is not None:
+            model.warmup(warmup_prompts, image_size=warmup_image_size)
+    except Exception as e:
+        results.put((None, index, False, f"Worker {index} failed to load the model: {e}"))
+        return
+    results.put((None, index, True, model.load_timings))
+
+    sessions = OrderedDict()
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, method, image_ref, kwargs = request
+
+        shm, image = (None, None)
+        try:
+            if image_ref is not None:
+                shm, image = _attach(image_ref)
+
+            if method == "segment_text":
+                # [mask, resolution that produced it]
+                result = list(model.segment_text(image, kwargs.pop("prompt"), **kwargs))
+            elif method == "segment_tiled":
+                result = np.asarray(model.segment_tiled(image, kwargs.pop("prompt"), **kwargs))
+            elif method == "encode":
+                sessions[kwargs["image_id"]] = model.encode_image(image)
+                while len(sessions) > max_sessions:
+                    sessions.popitem(last=False)
+                result = None
+            elif method == "release":
+                sessions.pop(kwargs["image_id"], None)
+                result = None
+            elif method in SESSION_METHODS:
+                image_id = kwargs.pop("image_id")
+                if image_id not in sessions:
+                    raise SessionNotFound(f"Image {image_id} is no longer held by worker {index}")
+                sessions.move_to_end(image_id)
+                result = getattr(model, method)(sessions[image_id], **kwargs)
+            else:
+                raise ValueError(f"Unknown worker method: {method}")
+
+            results.put((request_id, index, True, _pack_result(result)))
+        except SessionNotFound as e:
+            # Sent as is so that the caller can tell it from a model failure
+            results.put((request_id, index, False, e))
+        except Exception as e:
+            results.put((request_id, index, False, f"{type(e).__name__}: {e}"))
+        finally:
+            if shm is not None:
+                del image
+                shm.close()
+
+
+def default_core_slices(num_workers: int) -> List[List[int]]:
+    """Split the cores available to this process evenly between workers."""
+    cores = sorted(os.sched_getaffinity(0))
+    if num_workers >= len(cores):
+        # More workers than cores: one (possibly shared) core each
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    per_worker = len(cores) // num_workers
+    return [cores[i * per_worker:(i + 1) * per_worker] for i in range(num_workers)]
+
+
+class ModelWorkerPool:
+    """Pool of model worker processes with least-loaded dispatch."""
+
+    def __init__(
+        self,
+        num_workers: int,
+        model_kwargs: Optional[dict] = None,
+        devices: Optional[Sequence[str]] = None,
+        pin_cores: bool = True,
+        max_sessions_per_worker: int = 64,
+    ):
+        """
+        Initialize the pool (processes are started by ``start``).
+
+        Args:
+            num_workers: Number of model replicas
+            model_kwargs: Keyword arguments for SAM3Model (besides device and caches),
+                plus optional embedding_cache_bytes, text_cache_size, text_cache_path,
+                and warmup_prompts and warmup_image_size to warm each replica up
+                (see ``SAM3Model.warmup``) before it reports ready
+            devices: Device per worker, e.g. ["cuda:0", "cuda:1"]; cycled if shorter
+            pin_cores: Pin CPU workers to disjoint slices of the available cores
+            max_sessions_per_worker: Encoded images kept per worker; the front
+                ``SessionStore`` must enforce the same cap (``max_sessions_per_worker``)
+                so that a worker never drops a session that is still live
+        """
+        self.num_workers = num_workers
+        self.model_kwargs = model_kwargs or {}
+        self.devices = [devices[i % len(devices)] for i in range(num_workers)] if devices else ["cpu"] * num_workers
+        self.pin_cores = pin_cores
+        self.max_sessions_per_worker = max_sessions_per_worker
+
+        self._ctx = mp.get_context("spawn")
+        self._processes = []
+        self._requests = []
+        self._results = None
+        self._pending = {}
+        self._outstanding = [0] * num_workers
+        self._ready = [False] * num_workers
+        self._load_timings = [None] * num_workers
+        self._errors = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._reader = None
+        self._closed = False
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        """Spawn the worker processes and the result reader thread."""
+        cores = default_core_slices(self.num_workers) if self.pin_cores else [None] * self.num_workers
+        self._results = self._ctx.Queue()
+        for i, device in enumerate(self.devices):
+            requests = self._ctx.Queue()
+            process = self._ctx.Process(
+                target=_worker_main,
+                args=(
+                    i, requests, self._results, self.model_kwargs, device,
+                    cores[i] if device == "cpu" else None, self.max_sessions_per_worker,
+                ),
+                name=f"model-worker-{i}",
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+            self._requests.append(requests)
+
+        self._reader = threading.Thread(target=self._read_results, name="model-pool-results", daemon=True)
+        self._reader.start()
+
+    @property
+    def ready(self) -> bool:
+        return all(self._ready)
+
+    def wait_ready(self, poll_interval: float = 0.5):
+        """
+        Block until every worker loaded its model.
+
+        Raises:
+            RuntimeError: If a worker failed to load or died during startup
+        """
+        while not self.ready:
+            if self._errors:
+                raise RuntimeError("; ".join(self._errors))
+            dead = [i for i, p in enumerate(self._processes) if not p.is_alive() and not self._ready[i]]
+            if dead:
+                time.sleep(poll_interval)  # Let the reader pick up the failure message
+                raise RuntimeError("; ".join(self._errors) or f"Model workers {dead} died during startup")
+            time.sleep(poll_interval)
+
+    def least_loaded(self) -> int:
+        """Index of the live worker with the fewest outstanding requests."""
+        with self._lock:
+            alive = [i for i, p in enumerate(self._processes) if p.is_alive()]
+            if not alive:
+                raise RuntimeError("No model worker is alive")
+            return min(alive, key=lambda i: self._outstanding[i])
+
+    def submit(self, method: str, image: Optional[np.ndarray] = None, worker: Optional[int] = None, **kwargs) -> Future:
+        """
+        Send a request to a worker.
+
+        Args:
+            method: "segment_text", "segment_tiled", "encode", "release" or one of SESSION_METHODS
+            image: Image to transfer through shared memory
+            worker: Target worker (sticky sessions), least loaded if None
+            **kwargs: Method arguments
+
+        Returns:
+            Future resolved with the method result
+
+        Raises (through the future):
+            SessionNotFound: If the worker does not hold the session
+            RuntimeError: If the method failed or the worker died
+        """
+        if self._closed:
+            raise RuntimeError("Model worker pool is shut down")
+        if worker is None:
+            worker = self.least_loaded()
+
+        future = Future()
+        shm, image_ref = (None, None)
+        if image is not None:
+            shm, image_ref = _to_shm(image)
+
+        request_id = next(self._ids)
+        with self._lock:
+            self._pending[request_id] = (future, worker, shm)
+            self._outstanding[worker] += 1
+        self._requests[worker].put((request_id, method, image_ref, kwargs))
+        return future
+
+    async def call(self, method: str, image: Optional[np.ndarray] = None, worker: Optional[int] = None, **kwargs):
+        """Awaitable version of ``submit``."""
+        return await asyncio.wrap_future(self.submit(method, image, worker, **kwargs))
+
+    def _read_results(self):
+        while not self._closed:
+            try:
+                request_id, worker, ok, payload = self._results.get(timeout=1.0)
+            except queue.Empty:
+                self._fail_dead_workers()
+                continue
+            except (EOFError, OSError):
+                break
+
+            if request_id is None:
+                # Startup notification
+                if ok:
+                    self._ready[worker] = True
+                    self._load_timings[worker] = payload
+                else:
+                    self._errors.append(payload)
+                    print(payload)
+                continue
+
+            with self._lock:
+                future, _, shm = self._pending.pop(request_id, (None, None, None))
+                self._outstanding[worker] -= 1
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            # The future is gone (worker declared dead) or was cancelled by
+            # its caller (asyncio.wrap_future forwards task cancellation)
+            if future is None or not future.set_running_or_notify_cancel():
+                if ok:
+                    _free_result(payload)
+                continue
+
+            if ok:
+                try:
+                    future.set_result(_unpack_result(payload))
+                    self.completed += 1
+                except Exception as e:
+                    future.set_exception(e)
+                    self.failed += 1
+            else:
+                future.set_exception(payload if isinstance(payload, SessionNotFound) else RuntimeError(payload))
+                self.failed += 1
+
+    def _fail_dead_workers(self):
+        dead = {i for i, p in enumerate(self._processes) if not p.is_alive()}
+        if not dead:
+            return
+        with self._lock:
+            lost = [rid for rid, (_, w, _) in self._pending.items() if w in dead]
+            entries = [self._pending.pop(rid) for rid in lost]
+            for _, worker, _ in entries:
+                self._outstanding[worker] -= 1
+        for future, worker, shm in entries:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError(f"Model worker {worker} died"))
+                self.failed += 1
+
+    def shutdown(self, timeout: float = 10.0):
+        """Stop the workers and release pending shared memory."""
+        if self._closed:
+            return
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._closed = True
+        with self._lock:
+            entries = list(self._pending.values())
+            self._pending.clear()
+        for future, _, shm in entries:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("Model worker pool shut down"))
+
+    def stats(self) -> dict:
+        """Per-worker state and request counters."""
+        with self._lock:
+            return {
+                "num_workers": self.num_workers,
+                "ready": self.ready,
+                "workers": [
+                    {
+                        "device": self.devices[i],
+                        "alive": p.is_alive(),
+                        "ready": self._ready[i],
+                        "outstanding": self._outstanding[i],
+                        "load_timings": self._load_timings[i],
+                    }
+                    for i, p in enumerate(self._processes)
+                ],
+                "completed": self.completed,
+                "failed": self.failed,
+                "errors": self._errors[-5:],
+            }
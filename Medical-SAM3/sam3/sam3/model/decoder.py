@@ -320,35 +320,50 @@ class TransformerDecoder(nn.Module):
         for layer_idx, layer in enumerate(self.layers):
             layer.layer_idx = layer_idx
 
+    def precompute_coords(self, feat_size, device=None):
+        """Fill the boxRPB coordinate cache for another feature map size."""
+        if self.boxRPB == "none":
+            return
+        feat_size = tuple(feat_size)
+        if feat_size != self.compilable_stored_size and feat_size not in self.coord_cache:
+            self.coord_cache[feat_size] = self._get_coords(*feat_size, device=device)
+
     @staticmethod
     def _get_coords(H, W, device):
         coords_h = torch.arange(0, H, device=device, dtype=torch.float32) / H
         coords_w = torch.arange(0, W, device=device, dtype=torch.float32) / W
         return coords_h, coords_w
 
+    def _cached_coords(self, H, W, device):
+        """
+        boxRPB coordinates of an H x W feature map, from the constructor's
+        entry or those filled by ``precompute_coords``. Under compilation the
+        entries are selected by comparing sizes (so the graph is guarded on
+        the size), and a missing size is computed in the graph, not cached.
+        """
+        if self.compilable_stored_size == (H, W):
+            return self.compilable_cord_cache
+        for size, coords in self.coord_cache.items():
+            if size == (H, W):
+                return coords
+        coords = self._get_coords(H, W, device)
+        if not torch.compiler.is_dynamo_compiling():
+            self.coord_cache[(H, W)] = coords
+        return coords
+
     def _get_rpb_matrix(self, reference_boxes, feat_size):
         H, W = feat_size
+        if not torch.compiler.is_dynamo_compiling():
+            # Sizes read from spatial_shapes are 0-d tensors
+            H, W = int(H), int(W)
         boxes_xyxy = box_cxcywh_to_xyxy(reference_boxes).transpose(0, 1)
         bs, num_queries, _ = boxes_xyxy.shape
         if self.compilable_cord_cache is None:
             self.compilable_cord_cache = self._get_coords(H, W, reference_boxes.device)
             self.compilable_stored_size = (H, W)
 
-        if torch.compiler.is_dynamo_compiling() or self.compilable_stored_size == (
-            H,
-            W,
-        ):
-            # good, hitting the cache, will be compilable
-            coords_h, coords_w = self.compilable_cord_cache
-        else:
-            # cache miss, will create compilation issue
-            # In case we're not compiling, we'll still rely on the dict-based cache
-            if feat_size not in self.coord_cache:
-                self.coord_cache[feat_size] = self._get_coords(
-                    H, W, reference_boxes.device
-                )
-            coords_h, coords_w = self.coord_cache[feat_size]
-
+        coords_h, coords_w = self._cached_coords(H, W, reference_boxes.device)
+        if not torch.compiler.is_dynamo_compiling():
             assert coords_h.shape == (H,)
             assert coords_w.shape == (W,)
 
@@ -430,6 +445,8 @@ class TransformerDecoder(nn.Module):
         obj_roi_memory_feat=None,
         obj_roi_memory_mask=None,
         box_head_trk=None,
+        # (H, W) of each level as ints, needed by boxRPB under compilation
+        feat_sizes: Optional[List] = None,
     ):
         """
         Input:
@@ -438,6 +455,7 @@ class TransformerDecoder(nn.Module):
             - pos: \\sum{hw}, bs, d_model
             - reference_boxes: nq, bs, 4 (after sigmoid)
             - valid_ratios/spatial_shapes: bs, nlevel, 2
+            - feat_sizes: nlevel (H, W) pairs, read from spatial_shapes if None
         """
         if memory_mask is not None:
             assert self.boxRPB == "none", (
@@ -517,7 +535,11 @@ class TransformerDecoder(nn.Module):
                 )
                 memory_mask = self._get_rpb_matrix(
                     reference_boxes,
-                    (spatial_shapes[0, 0], spatial_shapes[0, 1]),
+                    (
+                        tuple(feat_sizes[0])
+                        if feat_sizes is not None
+                        else (spatial_shapes[0, 0], spatial_shapes[0, 1])
+                    ),
                 )
                 memory_mask = memory_mask.flatten(0, 1)  # (bs*n_heads, nq, H*W)
             if self.training:
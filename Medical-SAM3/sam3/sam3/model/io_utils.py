@@ -37,8 +37,19 @@ def load_resource_as_video_frames(
 ):
     """
     Load video frames from either a video or an image (as a single-frame video).
-    Alternatively, if input is a list of PIL images, convert its format
+    Alternatively, if input is a list of PIL images, convert its format, and if
+    it is any other sequence, it holds (H, W, 3) uint8 frames (see
+    `load_video_frames_from_arrays`)
     """
+    if not isinstance(resource_path, (str, list)):
+        return load_video_frames_from_arrays(
+            frames=resource_path,
+            image_size=image_size,
+            offload_video_to_cpu=offload_video_to_cpu,
+            img_mean=img_mean,
+            img_std=img_std,
+            async_loading_frames=async_loading_frames,
+        )
     if isinstance(resource_path, list):
         img_mean = torch.tensor(img_mean, dtype=torch.float16)[:, None, None]
         img_std = torch.tensor(img_std, dtype=torch.float16)[:, None, None]
@@ -210,6 +221,45 @@ def load_video_frames_from_image_folder(
     return images, video_height, video_width
 
 
+def load_video_frames_from_arrays(
+    frames,
+    image_size,
+    offload_video_to_cpu,
+    img_mean,
+    img_std,
+    async_loading_frames,
+):
+    """
+    Load the video frames from a sequence of (H, W, 3) uint8 arrays, such as the
+    slices of a CT or MRI volume. `frames[n]` is only called when frame n is
+    loaded, so the sequence can read and window its frames lazily.
+    """
+    num_frames = len(frames)
+    if num_frames == 0:
+        raise RuntimeError("no frames in the frame sequence")
+    img_mean = torch.tensor(img_mean, dtype=torch.float16)[:, None, None]
+    img_std = torch.tensor(img_std, dtype=torch.float16)[:, None, None]
+
+    if async_loading_frames:
+        lazy_images = AsyncArrayFrameLoader(
+            frames, image_size, offload_video_to_cpu, img_mean, img_std
+        )
+        return lazy_images, lazy_images.video_height, lazy_images.video_width
+
+    images = torch.zeros(num_frames, 3, image_size, image_size, dtype=torch.float16)
+    video_height, video_width = None, None
+    for n in tqdm(range(num_frames), desc=f"frame loading (arrays) [rank={RANK}]"):
+        images[n], video_height, video_width = _array_to_tensor(frames[n], image_size)
+    if not offload_video_to_cpu:
+        images = images.cuda()
+        img_mean = img_mean.cuda()
+        img_std = img_std.cuda()
+    # normalize by mean and std
+    images -= img_mean
+    images /= img_std
+    return images, video_height, video_width
+
+
 def load_video_frames_from_video_file(
     video_path,
     image_size,
@@ -336,6 +386,20 @@ def _load_img_as_tensor(img_path, image_size):
     return img, orig_height, orig_width
 
 
+def _array_to_tensor(frame, image_size):
+    """Resize an (H, W, 3) uint8 array and convert it into a (3, S, S) tensor in [0, 1]."""
+    frame = torch.as_tensor(np.asarray(frame))
+    orig_height, orig_width = frame.shape[:2]
+    img = F.interpolate(
+        frame.permute(2, 0, 1)[None].float(),
+        size=(image_size, image_size),
+        mode="bilinear",
+        align_corners=False,
+        antialias=True,
+    )[0]
+    return img.div_(255).clamp_(0, 1), orig_height, orig_width
+
+
 class AsyncImageFrameLoader:
     """
     A list of video frames to be load asynchronously without blocking session start.
@@ -381,9 +445,7 @@ class AsyncImageFrameLoader:
         if img is not None:
             return img
 
-        img, video_height, video_width = _load_img_as_tensor(
-            self.img_paths[index], self.image_size
-        )
+        img, video_height, video_width = self._load_frame(index)
         self.video_height = video_height
         self.video_width = video_width
         # float16 precision should be sufficient for image tensor storage
@@ -396,10 +458,23 @@ class AsyncImageFrameLoader:
         self.images[index] = img
         return img
 
+    def _load_frame(self, index):
+        return _load_img_as_tensor(self.img_paths[index], self.image_size)
+
     def __len__(self):
         return len(self.images)
 
 
+class AsyncArrayFrameLoader(AsyncImageFrameLoader):
+    """
+    Like `AsyncImageFrameLoader`, for frames given as a sequence of (H, W, 3)
+    uint8 arrays instead of image files.
+    """
+
+    def _load_frame(self, index):
+        return _array_to_tensor(self.img_paths[index], self.image_size)
+
+
 class TorchCodecDecoder:
     """
     A wrapper to support GPU device and num_threads in TorchCodec decoder,
@@ -45,12 +45,19 @@ class PositionEmbeddingSine(nn.Module):
                 (precompute_resolution // 16, precompute_resolution // 16),
                 (precompute_resolution // 32, precompute_resolution // 32),
             ]
-            for size in precompute_sizes:
-                device = "cuda" if torch.cuda.is_available() else "cpu"
-                tensors = torch.zeros((1, 1) + size, device=device)
-                self.forward(tensors)
-                # further clone and detach it in the cache (just to be safe)
-                self.cache[size] = self.cache[size].clone().detach()
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            self.precompute(precompute_sizes, device=device)
+
+    def precompute(self, sizes, device=None):
+        """Fill the cache for the given (H, W) feature map sizes."""
+        for size in sizes:
+            size = tuple(size)
+            if size in self.cache:
+                continue
+            tensors = torch.zeros((1, 1) + size, device=device)
+            self.forward(tensors)
+            # further clone and detach it in the cache (just to be safe)
+            self.cache[size] = self.cache[size].clone().detach()
 
     def _encode_xy(self, x, y):
         # The positions are expected to be normalized
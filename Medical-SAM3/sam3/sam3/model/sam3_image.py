@@ -278,6 +278,7 @@ class Sam3Image(torch.nn.Module):
                 reference_boxes=None,
                 level_start_index=encoder_out["level_start_index"],
                 spatial_shapes=encoder_out["spatial_shapes"],
+                feat_sizes=encoder_out["vis_feat_sizes"],
                 valid_ratios=encoder_out["valid_ratios"],
                 tgt_mask=None,
                 memory_text=prompt,
@@ -1,32 +1,133 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates. All Rights Reserved
 
 # pyre-unsafe
-from typing import Dict, List
+import threading
+import warnings
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 import PIL
 import torch
+import torch.nn.functional as F
 from sam3.model import box_ops
 from sam3.model.data_misc import FindStage, interpolate
 from torchvision.transforms import v2
 
 
+class LazyMasks:
+    """Low-resolution mask logits of the kept predictions, upsampled on demand.
+
+    Upsampling matches the eager path of ``Sam3Processor`` (bilinear resize to the
+    original image size, then sigmoid), but only for the requested masks, or only
+    inside a box for ``roi``. Returned masks are probabilities, threshold at 0.5.
+    """
+
+    def __init__(
+        self,
+        low_res_logits: torch.Tensor,
+        boxes: torch.Tensor,
+        scores: torch.Tensor,
+        img_h: int,
+        img_w: int,
+    ):
+        """
+        :param low_res_logits: (N, h, w) mask logits at the decoder resolution
+        :param boxes: (N, 4) boxes in [x0, y0, x1, y1] pixel coordinates
+        :param scores: (N,) detection scores
+        :param img_h: Height of the original image
+        :param img_w: Width of the original image
+        """
+        self.low_res_logits = low_res_logits
+        self.boxes = boxes
+        self.scores = scores
+        self.img_h = img_h
+        self.img_w = img_w
+
+    def __len__(self):
+        return len(self.scores)
+
+    def upsample(self, indices: Optional[Sequence[int]] = None) -> torch.Tensor:
+        """Full-resolution probabilities (K, 1, H, W) of the given masks (all if None)."""
+        logits = self.low_res_logits
+        if indices is not None:
+            logits = logits[torch.as_tensor(indices, dtype=torch.long, device=logits.device)]
+        return interpolate(
+            logits.unsqueeze(1),
+            (self.img_h, self.img_w),
+            mode="bilinear",
+            align_corners=False,
+        ).sigmoid()
+
+    def topk(self, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Indices (by decreasing score) and full-resolution probabilities of the k best masks."""
+        k = min(k, len(self))
+        indices = torch.topk(self.scores, k).indices
+        return indices, self.upsample(indices)
+
+    def best(self) -> Optional[torch.Tensor]:
+        """Full-resolution probabilities (1, H, W) of the highest scoring mask, None if empty."""
+        if len(self) == 0:
+            return None
+        return self.upsample([int(torch.argmax(self.scores))])[0]
+
+    def roi(self, index: int, padding: int = 0) -> Tuple[Tuple[int, int, int, int], torch.Tensor]:
+        """Probabilities of one mask inside its box, upsampled for that region only.
+
+        :param index: Index of the mask
+        :param padding: Pixels added around the box
+        :return: The crop as (x0, y0, x1, y1) and the (y1 - y0, x1 - x0) probabilities
+        """
+        box = self.boxes[index].tolist()
+        x0 = max(int(np.floor(box[0])) - padding, 0)
+        y0 = max(int(np.floor(box[1])) - padding, 0)
+        x1 = min(int(np.ceil(box[2])) + padding, self.img_w)
+        y1 = min(int(np.ceil(box[3])) + padding, self.img_h)
+        x1, y1 = max(x1, x0 + 1), max(y1, y0 + 1)
+
+        logits = self.low_res_logits[index][None, None].float()
+        device = logits.device
+        # Normalized centers of the output pixels: with align_corners=False and
+        # border padding this samples exactly like the full bilinear resize
+        xs = (torch.arange(x0, x1, device=device) + 0.5) / self.img_w * 2 - 1
+        ys = (torch.arange(y0, y1, device=device) + 0.5) / self.img_h * 2 - 1
+        grid_y, grid_x = torch.meshgrid(ys, xs, indexing="ij")
+        grid = torch.stack([grid_x, grid_y], dim=-1)[None]
+        probs = F.grid_sample(
+            logits, grid, mode="bilinear", padding_mode="border", align_corners=False
+        ).sigmoid()
+        return (x0, y0, x1, y1), probs[0, 0]
+
+
 class Sam3Processor:
     """ """
 
-    def __init__(self, model, resolution=1008, device="cuda", confidence_threshold=0.5):
+    def __init__(
+        self,
+        model,
+        resolution=1008,
+        device="cuda",
+        confidence_threshold=0.5,
+        lazy_masks=False,
+        raw_score_floor=0.0,
+    ):
+        """
+        :param lazy_masks: If True, results hold a ``LazyMasks`` under "lazy_masks"
+            instead of full-resolution "masks" and "masks_logits"
+        :param raw_score_floor: Predictions scoring below this are dropped from the
+            unfiltered outputs kept for ``rescore`` (they can then never be shown,
+            whatever the threshold), which bounds the memory of the kept masks
+        """
         self.model = model
         self.resolution = resolution
         self.device = device
-        self.transform = v2.Compose(
-            [
-                v2.ToDtype(torch.uint8, scale=True),
-                v2.Resize(size=(resolution, resolution)),
-                v2.ToDtype(torch.float32, scale=True),
-                v2.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-            ]
-        )
+        self.lazy_masks = lazy_masks
+        self.transform = self._make_transform(resolution)
+        # Transforms of reduced input resolutions, see get_transform
+        self.transforms = {resolution: self.transform}
         self.confidence_threshold = confidence_threshold
+        self.raw_score_floor = raw_score_floor
+        # Per-thread pinned host buffer staging uint8 arrays for the device copy
+        self._staging = threading.local()
 
         self.find_stage = FindStage(
             img_ids=torch.tensor([0], device=device, dtype=torch.long),
@@ -38,24 +139,104 @@ class Sam3Processor:
             input_points_mask=None,
         )
 
+    @staticmethod
+    def _make_transform(resolution):
+        return v2.Compose(
+            [
+                v2.ToDtype(torch.uint8, scale=True),
+                v2.Resize(size=(resolution, resolution)),
+                v2.ToDtype(torch.float32, scale=True),
+                v2.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+            ]
+        )
+
+    def get_transform(self, resolution=None):
+        """Input transform for a resolution (the processor resolution if None).
+
+        The model caches for other resolutions are filled by
+        ``model_builder.precompute_image_resolution``.
+        """
+        if resolution is None:
+            return self.transform
+        if resolution not in self.transforms:
+            self.transforms[resolution] = self._make_transform(resolution)
+        return self.transforms[resolution]
+
+    def preprocess(self, image, resolution=None) -> torch.Tensor:
+        """Model input (1, 3, R, R) of an image, on the processor device.
+
+        HWC uint8 arrays (as given by ``inference.ingest.decode_image``) take a
+        single pass: the array is wrapped without a copy, moved to the device as
+        uint8 through a pinned staging buffer, resized once to the model
+        resolution and normalized in place. PIL images and CHW tensors go
+        through the torchvision transform.
+        """
+        if not (isinstance(image, np.ndarray) and image.dtype == np.uint8):
+            image = v2.functional.to_image(image).to(self.device)
+            return self.get_transform(resolution)(image).unsqueeze(0)
+
+        resolution = resolution or self.resolution
+        with warnings.catch_warnings():
+            # Decoded images are read-only arrays, the view is only read from
+            warnings.simplefilter("ignore", UserWarning)
+            pixels = torch.from_numpy(image)
+        if pixels.ndim == 2:
+            pixels = pixels.unsqueeze(-1)
+        # Views only: grayscale is broadcast to RGB, alpha is dropped
+        pixels = pixels[..., :3].expand(-1, -1, 3).permute(2, 0, 1).unsqueeze(0)
+        pixels = self._to_device(pixels)
+        pixels = F.interpolate(
+            pixels.float(),
+            size=(resolution, resolution),
+            mode="bilinear",
+            align_corners=False,
+            antialias=True,
+        )
+        # Same as ToDtype(scale=True) then Normalize(mean=0.5, std=0.5)
+        return pixels.mul_(2 / 255).sub_(1)
+
+    def _to_device(self, pixels: torch.Tensor) -> torch.Tensor:
+        """Copy uint8 pixels to the device, through a reused pinned buffer on CUDA."""
+        if torch.device(self.device).type != "cuda":
+            return pixels.to(self.device)
+        numel = pixels.numel()
+        staging = self._staging
+        if getattr(staging, "copied", None) is not None:
+            # The previous copy out of the buffer must be done before it is overwritten
+            staging.copied.synchronize()
+        if getattr(staging, "buffer", None) is None or staging.buffer.numel() < numel:
+            staging.buffer = torch.empty(numel, dtype=torch.uint8, pin_memory=True)
+            staging.copied = torch.cuda.Event()
+        staged = staging.buffer[:numel].view(pixels.shape)
+        staged.copy_(pixels)
+        out = staged.to(self.device, non_blocking=True)
+        staging.copied.record()
+        return out
+
     @torch.inference_mode()
-    def set_image(self, image, state=None):
-        """Sets the image on which we want to do predictions."""
+    def set_image(self, image, state=None, resolution=None):
+        """Sets the image on which we want to do predictions.
+
+        :param resolution: Model input size, defaults to the processor resolution.
+            Smaller sizes trade accuracy for a quadratically cheaper backbone
+        """
         if state is None:
             state = {}
 
         if isinstance(image, PIL.Image.Image):
             width, height = image.size
-        elif isinstance(image, (torch.Tensor, np.ndarray)):
+        elif isinstance(image, np.ndarray):
+            height, width = image.shape[:2]
+        elif isinstance(image, torch.Tensor):
             height, width = image.shape[-2:]
         else:
-            raise ValueError("Image must be a PIL image or a tensor")
+            raise ValueError("Image must be a PIL image, an array or a tensor")
 
-        image = v2.functional.to_image(image).to(self.device)
-        image = self.transform(image).unsqueeze(0)
+        image = self.preprocess(image, resolution)
 
         state["original_height"] = height
         state["original_width"] = width
+        state["resolution"] = resolution or self.resolution
         state["backbone_out"] = self.model.backbone.forward_image(image)
         inst_interactivity_en = self.model.inst_interactive_predictor is not None
         if inst_interactivity_en and "sam2_backbone_out" in state["backbone_out"]:
@@ -73,26 +254,29 @@ class Sam3Processor:
         return state
 
     @torch.inference_mode()
-    def set_image_batch(self, images: List[np.ndarray], state=None):
+    def set_image_batch(self, images: List[np.ndarray], state=None, resolution=None):
         """Sets the image batch on which we want to do predictions."""
         if state is None:
             state = {}
 
         if not isinstance(images, list):
-            raise ValueError("Images must be a list of PIL images or tensors")
+            raise ValueError("Images must be a list of PIL images, arrays or tensors")
         assert len(images) > 0, "Images list must not be empty"
-        assert isinstance(images[0], PIL.Image.Image), (
-            "Images must be a list of PIL images"
+        assert all(isinstance(image, (PIL.Image.Image, np.ndarray, torch.Tensor)) for image in images), (
+            "Images must be a list of PIL images, HWC uint8 arrays or CHW tensors"
         )
 
-        state["original_heights"] = [image.height for image in images]
-        state["original_widths"] = [image.width for image in images]
-
-        images = [
-            self.transform(v2.functional.to_image(image).to(self.device))
+        sizes = [
+            image.size if isinstance(image, PIL.Image.Image)
+            else image.shape[1::-1] if isinstance(image, np.ndarray)
+            else image.shape[:-3:-1]
             for image in images
         ]
-        images = torch.stack(images, dim=0)
+        state["original_heights"] = [height for _, height in sizes]
+        state["original_widths"] = [width for width, _ in sizes]
+        state["resolution"] = resolution or self.resolution
+
+        images = torch.cat([self.preprocess(image, resolution) for image in images], dim=0)
         state["backbone_out"] = self.model.backbone.forward_image(images)
         inst_interactivity_en = self.model.inst_interactive_predictor is not None
         if inst_interactivity_en and "sam2_backbone_out" in state["backbone_out"]:
@@ -124,6 +308,86 @@ class Sam3Processor:
 
         return self._forward_grounding(state)
 
+    @torch.inference_mode()
+    def set_text_prompt_batch(self, prompts: List[str], state: Dict):
+        """Sets one text prompt per image of a batch and run the inference in a single pass.
+        Prompt i is applied to image i of the batch given to set_image_batch.
+        Returns a list with the results (masks, boxes, scores) for each image.
+        """
+        if "backbone_out" not in state:
+            raise ValueError("You must call set_image_batch before set_text_prompt_batch")
+
+        num_images = len(state["original_heights"])
+        if len(prompts) != num_images:
+            raise ValueError(
+                f"Expected one prompt per image, got {len(prompts)} prompts for {num_images} images"
+            )
+
+        text_outputs = self.model.backbone.forward_text(prompts, device=self.device)
+        # will erase the previous text prompts if any
+        state["backbone_out"].update(text_outputs)
+
+        ids = torch.arange(num_images, device=self.device, dtype=torch.long)
+        find_stage = FindStage(
+            img_ids=ids,
+            text_ids=ids,
+            input_boxes=None,
+            input_boxes_mask=None,
+            input_boxes_label=None,
+            input_points=None,
+            input_points_mask=None,
+        )
+        outputs = self.model.forward_grounding(
+            backbone_out=state["backbone_out"],
+            find_input=find_stage,
+            geometric_prompt=self.model._get_dummy_prompt(num_prompts=num_images),
+            find_target=None,
+        )
+        return [
+            self._postprocess_outputs(outputs, img_h, img_w, batch_idx=i)
+            for i, (img_h, img_w) in enumerate(
+                zip(state["original_heights"], state["original_widths"])
+            )
+        ]
+
+    @torch.inference_mode()
+    def set_text_prompts(self, prompts: List[str], state: Dict):
+        """Runs several text prompts on the same image in a single pass.
+        All prompts are encoded together and the image features are shared across
+        the prompt batch. Returns a list with the results (masks, boxes, scores) for each prompt.
+        """
+        if "backbone_out" not in state:
+            raise ValueError("You must call set_image before set_text_prompts")
+        if len(prompts) == 0:
+            return []
+
+        num_prompts = len(prompts)
+        text_outputs = self.model.backbone.forward_text(prompts, device=self.device)
+        # will erase the previous text prompt if any
+        state["backbone_out"].update(text_outputs)
+
+        find_stage = FindStage(
+            img_ids=torch.zeros(num_prompts, device=self.device, dtype=torch.long),
+            text_ids=torch.arange(num_prompts, device=self.device, dtype=torch.long),
+            input_boxes=None,
+            input_boxes_mask=None,
+            input_boxes_label=None,
+            input_points=None,
+            input_points_mask=None,
+        )
+        outputs = self.model.forward_grounding(
+            backbone_out=state["backbone_out"],
+            find_input=find_stage,
+            geometric_prompt=self.model._get_dummy_prompt(num_prompts=num_prompts),
+            find_target=None,
+        )
+        return [
+            self._postprocess_outputs(
+                outputs, state["original_height"], state["original_width"], batch_idx=i
+            )
+            for i in range(num_prompts)
+        ]
+
     @torch.inference_mode()
     def add_geometric_prompt(self, box: List, label: bool, state: Dict):
         """Adds a box prompt and run the inference.
@@ -151,6 +415,35 @@ class Sam3Processor:
 
         return self._forward_grounding(state)
 
+    @torch.inference_mode()
+    def add_point_prompt(self, points: List, labels: List[bool], state: Dict):
+        """Adds point prompts and run the inference.
+        The image needs to be set, but not necessarily the text prompt.
+        The points are assumed to be in [x, y] format and normalized in [0, 1] range.
+        Each label is True for a positive point, False for a negative point.
+        """
+        if "backbone_out" not in state:
+            raise ValueError("You must call set_image before add_point_prompt")
+
+        if "language_features" not in state["backbone_out"]:
+            # Same as for boxes: rely only on the geometric prompt
+            dummy_text_outputs = self.model.backbone.forward_text(
+                ["visual"], device=self.device
+            )
+            state["backbone_out"].update(dummy_text_outputs)
+
+        if "geometric_prompt" not in state:
+            state["geometric_prompt"] = self.model._get_dummy_prompt()
+
+        # adding a batch dimension, points are sequence-first
+        points = torch.tensor(points, device=self.device, dtype=torch.float32).view(
+            -1, 1, 2
+        )
+        labels = torch.tensor(labels, device=self.device, dtype=torch.bool).view(-1, 1)
+        state["geometric_prompt"].append_points(points, labels)
+
+        return self._forward_grounding(state)
+
     def reset_all_prompts(self, state: Dict):
         """Removes all the prompts and results"""
         if "backbone_out" in state:
@@ -163,7 +456,15 @@ class Sam3Processor:
                 if key in state["backbone_out"]:
                     del state["backbone_out"][key]
 
-        keys_to_del = ["geometric_prompt", "boxes", "masks", "masks_logits", "scores"]
+        keys_to_del = [
+            "geometric_prompt",
+            "raw_outputs",
+            "boxes",
+            "masks",
+            "masks_logits",
+            "lazy_masks",
+            "scores",
+        ]
         for key in keys_to_del:
             if key in state:
                 del state[key]
@@ -172,13 +473,35 @@ class Sam3Processor:
     def set_confidence_threshold(self, threshold: float, state=None):
         """Sets the confidence threshold for the masks"""
         self.confidence_threshold = threshold
+        if state is not None and "raw_outputs" in state:
+            # Only the filtering changes, the heads do not need to run again
+            return self.rescore(state, threshold=threshold)
         if state is not None and "boxes" in state:
-            # we need to filter the boxes again
-            # In principle we could do this more efficiently since we would only need
-            # to rerun the heads. But this is simpler and not too inefficient
             return self._forward_grounding(state)
         return state
 
+    @torch.inference_mode()
+    def rescore(
+        self,
+        state: Dict,
+        threshold: Optional[float] = None,
+        topk: Optional[int] = None,
+        nms_iou_threshold: Optional[float] = None,
+    ):
+        """Filters the unfiltered outputs of the last prompt again, without running the model.
+
+        :param threshold: Score threshold, defaults to the processor threshold
+        :param topk: Keep at most the k highest scoring predictions
+        :param nms_iou_threshold: Remove predictions whose low-resolution mask overlaps
+            a higher scoring one by more than this IoU
+        """
+        if "raw_outputs" not in state:
+            raise ValueError("No prediction to rescore, run a prompt first")
+        state.update(
+            self._select(state["raw_outputs"], threshold, topk, nms_iou_threshold)
+        )
+        return state
+
     @torch.inference_mode()
     def _forward_grounding(self, state: Dict):
         outputs = self.model.forward_grounding(
@@ -187,27 +510,83 @@ class Sam3Processor:
             geometric_prompt=state["geometric_prompt"],
             find_target=None,
         )
+        state.update(
+            self._postprocess_outputs(
+                outputs, state["original_height"], state["original_width"]
+            )
+        )
+        return state
 
-        out_bbox = outputs["pred_boxes"]
-        out_logits = outputs["pred_logits"]
-        out_masks = outputs["pred_masks"]
+    def _postprocess_outputs(self, outputs: Dict, img_h: int, img_w: int, batch_idx=0):
+        """Filters the predictions of one batch element and rescales them to the image size.
+
+        The unfiltered scores, boxes and low-resolution masks are kept under
+        "raw_outputs" so that ``rescore`` can change the filtering later.
+        """
+        out_bbox = outputs["pred_boxes"][batch_idx]
+        out_logits = outputs["pred_logits"][batch_idx]
+        out_masks = outputs["pred_masks"][batch_idx]
         out_probs = out_logits.sigmoid()
-        presence_score = outputs["presence_logit_dec"].sigmoid().unsqueeze(1)
+        presence_score = outputs["presence_logit_dec"][batch_idx].sigmoid()
         out_probs = (out_probs * presence_score).squeeze(-1)
 
-        keep = out_probs > self.confidence_threshold
-        out_probs = out_probs[keep]
-        out_masks = out_masks[keep]
-        out_bbox = out_bbox[keep]
+        if self.raw_score_floor > 0:
+            candidates = out_probs >= self.raw_score_floor
+            out_probs = out_probs[candidates]
+            out_masks = out_masks[candidates]
+            out_bbox = out_bbox[candidates]
 
         # convert to [x0, y0, x1, y1] format
         boxes = box_ops.box_cxcywh_to_xyxy(out_bbox)
 
-        img_h = state["original_height"]
-        img_w = state["original_width"]
         scale_fct = torch.tensor([img_w, img_h, img_w, img_h]).to(self.device)
         boxes = boxes * scale_fct[None, :]
 
+        raw_outputs = {
+            "scores": out_probs,
+            "boxes": boxes,
+            "mask_logits": out_masks,
+            "img_h": img_h,
+            "img_w": img_w,
+        }
+        result = self._select(raw_outputs)
+        result["raw_outputs"] = raw_outputs
+        return result
+
+    def _select(
+        self,
+        raw_outputs: Dict,
+        threshold: Optional[float] = None,
+        topk: Optional[int] = None,
+        nms_iou_threshold: Optional[float] = None,
+    ):
+        """Thresholds (then optionally NMS and top-k) the unfiltered outputs of a prompt."""
+        if threshold is None:
+            threshold = self.confidence_threshold
+        out_probs = raw_outputs["scores"]
+        keep = out_probs > threshold
+        if nms_iou_threshold is not None:
+            from sam3.perflib.nms import nms_masks
+
+            keep = nms_masks(
+                out_probs, raw_outputs["mask_logits"], threshold, nms_iou_threshold
+            )
+        indices = torch.nonzero(keep).squeeze(1)
+        if topk is not None:
+            indices = indices[out_probs[indices].argsort(descending=True)[:topk]]
+
+        out_probs = out_probs[indices]
+        out_masks = raw_outputs["mask_logits"][indices]
+        boxes = raw_outputs["boxes"][indices]
+        img_h, img_w = raw_outputs["img_h"], raw_outputs["img_w"]
+
+        if self.lazy_masks:
+            return {
+                "lazy_masks": LazyMasks(out_masks, boxes, out_probs, img_h, img_w),
+                "boxes": boxes,
+                "scores": out_probs,
+            }
+
         out_masks = interpolate(
             out_masks.unsqueeze(1),
             (img_h, img_w),
@@ -215,8 +594,9 @@ class Sam3Processor:
             align_corners=False,
         ).sigmoid()
 
-        state["masks_logits"] = out_masks
-        state["masks"] = out_masks > 0.5
-        state["boxes"] = boxes
-        state["scores"] = out_probs
-        return state
+        return {
+            "masks_logits": out_masks,
+            "masks": out_masks > 0.5,
+            "boxes": boxes,
+            "scores": out_probs,
+        }
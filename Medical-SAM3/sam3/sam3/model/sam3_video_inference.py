@@ -1710,6 +1710,7 @@ class Sam3VideoInferenceWithInstanceInteractivity(Sam3VideoInference):
 
 
 def is_image_type(resource_path: str) -> bool:
-    if isinstance(resource_path, list):
+    if not isinstance(resource_path, str):
+        # list of PIL images or sequence of frame arrays
         return len(resource_path) == 1
     return resource_path.lower().endswith(tuple(IMAGE_EXTS))
@@ -0,0 +1,158 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates. All Rights Reserved
+
+# pyre-unsafe
+
+"""Memoization of text encoder outputs for repeated prompts."""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+_CACHED_KEYS = ("language_features", "language_mask", "language_embeds")
+
+
+class TextEmbeddingCache:
+    """LRU cache of the per-caption outputs of ``SAM3VLBackbone.forward_text``.
+
+    Entries are keyed by the canonicalized caption (as seen by the tokenizer), the
+    device and the dtype the features were computed in. Since the text encoder pads
+    every caption to a fixed context length, cached captions can be concatenated
+    with freshly encoded ones to build a batch.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        """
+        :param max_entries: Maximum number of cached captions per device/dtype
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(caption: str, device, dtype) -> tuple:
+        return (caption, str(torch.device(device)), str(dtype))
+
+    def encode(
+        self,
+        captions: List[str],
+        encode_fn: Callable[[List[str]], Dict[str, torch.Tensor]],
+        device,
+        dtype,
+        canonicalize: Optional[Callable[[str], str]] = None,
+    ) -> Dict[str, torch.Tensor]:
+        """Returns the text outputs for ``captions``, encoding only the missing ones.
+
+        :param captions: The captions to encode
+        :param encode_fn: Encodes a list of captions, returning language_features
+            (seq first), language_mask (batch first) and language_embeds (seq first)
+        :param device: The device the features live on
+        :param dtype: The dtype the features are computed in
+        :param canonicalize: Maps a caption to its canonical form (same tokens)
+        """
+        canonical = [canonicalize(c) if canonicalize else c for c in captions]
+        keys = [self._key(c, device, dtype) for c in canonical]
+
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = entry
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        # dict.fromkeys dedups while keeping order
+        missing = list(dict.fromkeys(k for k in keys if k not in found))
+
+        if missing:
+            outputs = encode_fn([key[0] for key in missing])
+            for i, key in enumerate(missing):
+                found[key] = self._split(outputs, i)
+            with self._lock:
+                for key in missing:
+                    self._entries[key] = found[key]
+                    self._entries.move_to_end(key)
+                self._evict()
+
+        entries = [found[key] for key in keys]
+        return {
+            "language_features": torch.cat([e["language_features"] for e in entries], dim=1),
+            "language_mask": torch.cat([e["language_mask"] for e in entries], dim=0),
+            "language_embeds": torch.cat([e["language_embeds"] for e in entries], dim=1),
+        }
+
+    @staticmethod
+    def _split(outputs: Dict[str, torch.Tensor], i: int) -> Dict[str, torch.Tensor]:
+        # Clone so that the entry does not keep the whole batch alive
+        return {
+            "language_features": outputs["language_features"][:, i : i + 1].clone(),
+            "language_mask": outputs["language_mask"][i : i + 1].clone(),
+            "language_embeds": outputs["language_embeds"][:, i : i + 1].clone(),
+        }
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def save(self, path: str, tag: Optional[str] = None):
+        """Saves the cached entries (on CPU) to ``path``.
+
+        :param tag: Identifies the weights the entries were computed with
+        """
+        with self._lock:
+            entries = [
+                (key, {k: v.detach().cpu() for k, v in entry.items()})
+                for key, entry in self._entries.items()
+            ]
+        torch.save({"version": 1, "tag": tag, "entries": entries}, path)
+
+    def load(self, path: str, device=None, tag: Optional[str] = None) -> int:
+        """Loads entries saved with ``save``, returns the number of loaded captions.
+
+        :param device: If given, entries are moved to this device and re-keyed to it
+        :param tag: Nothing is loaded if the file was saved with a different tag
+        """
+        data = torch.load(path, map_location="cpu", weights_only=True)
+        if data.get("tag") != tag:
+            return 0
+        loaded = 0
+        with self._lock:
+            for key, entry in data["entries"]:
+                caption, entry_device, dtype = key
+                if device is not None:
+                    entry = {k: v.to(device) for k, v in entry.items()}
+                    entry_device = str(torch.device(device))
+                elif entry_device != "cpu":
+                    entry = {k: v.to(entry_device) for k, v in entry.items()}
+                if set(entry) != set(_CACHED_KEYS):
+                    continue
+                self._entries[(caption, entry_device, dtype)] = entry
+                loaded += 1
+            self._evict()
+        return loaded
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._entries)
@@ -437,14 +437,19 @@ class Attention(nn.Module):
             theta=self.rope_theta,
         )
 
+        self.register_buffer("freqs_cis", self._compute_freqs_cis(self.input_size))
+        # freqs_cis of other token grids (reduced input resolutions), by (H, W)
+        self.freqs_cis_cache = {}
+
+    def _compute_freqs_cis(self, input_size: Tuple[int, int]) -> Tensor:
         # interpolate rope
         scale_pos = 1.0
         if self.rope_interp:
-            scale_pos = self.rope_pt_size[0] / self.input_size[0]
+            scale_pos = self.rope_pt_size[0] / input_size[0]
         # get scaled freqs_cis
         freqs_cis = self.compute_cis(
-            end_x=self.input_size[0],
-            end_y=self.input_size[1],
+            end_x=input_size[0],
+            end_y=input_size[1],
             scale_pos=scale_pos,
         )
         if self.cls_token:
@@ -455,15 +460,25 @@ class Attention(nn.Module):
             )
             cls_freqs_cis = torch.polar(torch.ones_like(t), t)[None, :]
             freqs_cis = torch.cat([cls_freqs_cis, freqs_cis], dim=0)
-
-        self.register_buffer("freqs_cis", freqs_cis)
-
-    def _apply_rope(self, q, k) -> Tuple[Tensor, Tensor]:
+        return freqs_cis
+
+    def get_freqs_cis(self, hw: Tuple[int, int]) -> Tensor:
+        """RoPE frequencies for a (H, W) token grid, computed once per grid size."""
+        if hw == tuple(self.input_size):
+            return self.freqs_cis
+        freqs_cis = self.freqs_cis_cache.get(hw)
+        if freqs_cis is None or freqs_cis.device != self.freqs_cis.device:
+            freqs_cis = self._compute_freqs_cis(hw).to(self.freqs_cis.device)
+            self.freqs_cis_cache[hw] = freqs_cis
+        return freqs_cis
+
+    def _apply_rope(self, q, k, hw=None) -> Tuple[Tensor, Tensor]:
         if not self.use_rope:
             return q, k
 
         assert self.freqs_cis is not None
-        return apply_rotary_enc(q, k, freqs_cis=self.freqs_cis)
+        freqs_cis = self.freqs_cis if hw is None else self.get_freqs_cis(hw)
+        return apply_rotary_enc(q, k, freqs_cis=freqs_cis)
 
     def forward(self, x: Tensor) -> Tensor:
         s = 1 if self.cls_token else 0  # used to exclude cls_token
@@ -484,7 +499,7 @@ class Attention(nn.Module):
         q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
 
         # handle rope and rel pos embeddings
-        q, k = self._apply_rope(q, k)
+        q, k = self._apply_rope(q, k, (H, W) if ndim == 4 else None)
         if self.use_rel_pos:
             q, k = concat_rel_pos(
                 q.flatten(0, 1),
@@ -695,6 +710,8 @@ class ViT(nn.Module):
         """
         super().__init__()
         self.pretrain_use_cls_token = pretrain_use_cls_token
+        self.img_size = img_size
+        self.patch_size = patch_size
 
         window_block_indexes = [i for i in range(depth) if i not in global_att_blocks]
         self.full_attn_ids = list(global_att_blocks)
@@ -812,6 +829,13 @@ class ViT(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def precompute_resolution(self, img_size: int) -> None:
+        """Fill the RoPE caches of the global attention blocks for another input size."""
+        grid = (img_size // self.patch_size, img_size // self.patch_size)
+        for blk in self.blocks:
+            if blk.window_size == 0 and blk.attn.use_rope:
+                blk.attn.get_freqs_cis(grid)
+
     def forward(self, x: torch.Tensor) -> List[torch.Tensor]:
         x = self.patch_embed(x)
         h, w = x.shape[1], x.shape[2]
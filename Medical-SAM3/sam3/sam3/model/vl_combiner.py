@@ -45,6 +45,8 @@ class SAM3VLBackbone(nn.Module):
         # allow running activation checkpointing on the entire vision and language backbones
         self.act_ckpt_whole_vision_backbone = act_ckpt_whole_vision_backbone
         self.act_ckpt_whole_language_backbone = act_ckpt_whole_language_backbone
+        # optional TextEmbeddingCache, see set_text_cache
+        self.text_cache = None
 
     def forward(
         self,
@@ -119,9 +121,41 @@ class SAM3VLBackbone(nn.Module):
 
         return output
 
+    def set_text_cache(self, text_cache):
+        """Memoize the text encoder outputs in ``text_cache`` (a TextEmbeddingCache) at inference.
+        Pass None to disable."""
+        self.text_cache = text_cache
+
+    def _text_dtype(self, device):
+        device_type = torch.device(device).type
+        if torch.is_autocast_enabled(device_type):
+            return torch.get_autocast_dtype(device_type)
+        return next(self.language_backbone.parameters()).dtype
+
+    def _text_canonicalize(self, caption):
+        tokenizer = getattr(self.language_backbone, "tokenizer", None)
+        clean_fn = getattr(tokenizer, "clean_fn", None)
+        return clean_fn(caption) if clean_fn is not None else caption
+
     def forward_text(
         self, captions, input_boxes=None, additional_text=None, device="cuda"
     ):
+        if (
+            self.text_cache is not None
+            and not self.training
+            and (input_boxes is None or len(input_boxes) == 0)
+            and additional_text is None
+            and all(isinstance(c, str) for c in captions)
+        ):
+            return self.text_cache.encode(
+                captions,
+                encode_fn=lambda to_encode: self._forward_text_no_ack_ckpt(
+                    captions=to_encode, device=device
+                ),
+                device=device,
+                dtype=self._text_dtype(device),
+                canonicalize=self._text_canonicalize,
+            )
         return activation_ckpt_wrapper(self._forward_text_no_ack_ckpt)(
             captions=captions,
             input_boxes=input_boxes,
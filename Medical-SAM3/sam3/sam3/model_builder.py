@@ -531,24 +531,84 @@ def _create_sam3_transformer(has_presence_token: bool = True) -> TransformerWrap
     return TransformerWrapper(encoder=encoder, decoder=decoder, d_model=256)
 
 
-def _load_checkpoint(model, checkpoint_path):
-    """Load model checkpoint from file."""
-    with g_pathmgr.open(checkpoint_path, "rb") as f:
-        ckpt = torch.load(f, map_location="cpu", weights_only=True)
+def normalize_checkpoint_state_dict(ckpt, include_tracker=True):
+    """Rewrite checkpoint keys to the parameter names of the SAM3 image model.
+
+    Checkpoints with a 'detector.' prefix (SAM3 format) keep only the detector
+    weights, with the prefix stripped, plus the tracker weights mapped to the
+    instance interactive predictor if ``include_tracker`` is set. Checkpoints
+    without the prefix (MedSAM3 format) are returned as is.
+    """
     if "model" in ckpt and isinstance(ckpt["model"], dict):
         ckpt = ckpt["model"]
-    sam3_image_ckpt = {
+    if not any("detector" in k for k in ckpt):
+        return ckpt
+    state_dict = {
         k.replace("detector.", ""): v for k, v in ckpt.items() if "detector" in k
     }
-    if model.inst_interactive_predictor is not None:
-        sam3_image_ckpt.update(
+    if include_tracker:
+        state_dict.update(
             {
                 k.replace("tracker.", "inst_interactive_predictor.model."): v
                 for k, v in ckpt.items()
                 if "tracker" in k
             }
         )
-    missing_keys, _ = model.load_state_dict(sam3_image_ckpt, strict=False)
+    return state_dict
+
+
+def load_safetensors_state_dict(checkpoint_path):
+    """Memory-map a safetensors checkpoint on CPU.
+
+    The returned tensors are backed by the file, so pages are only read when
+    touched and are shared through the page cache between processes loading
+    the same file.
+    """
+    try:
+        from safetensors.torch import load_file
+    except ImportError as e:
+        raise ImportError(
+            "Loading .safetensors checkpoints requires the safetensors package "
+            "(pip install safetensors)"
+        ) from e
+    return load_file(checkpoint_path, device="cpu")
+
+
+def load_state_dict_into_model(model, state_dict, assign=False):
+    """Load a normalized state dict, returning (missing_keys, unexpected_keys).
+
+    With ``assign`` the module parameters become the given tensors instead of
+    being copied into, which avoids holding two copies of the weights when the
+    tensors are memory-mapped.
+    """
+    if assign:
+        # Keep the device and dtype the model was built with: assign=True would
+        # otherwise adopt those of the checkpoint. No copy is made when they match.
+        expected = model.state_dict()
+        state_dict = {
+            k: v.to(device=expected[k].device, dtype=expected[k].dtype)
+            if k in expected
+            else v
+            for k, v in state_dict.items()
+        }
+    return model.load_state_dict(state_dict, strict=False, assign=assign)
+
+
+def _load_checkpoint(model, checkpoint_path):
+    """Load model checkpoint from file."""
+    if checkpoint_path.endswith(".safetensors"):
+        # Converted checkpoints are already normalized
+        sam3_image_ckpt = load_safetensors_state_dict(checkpoint_path)
+        missing_keys, _ = load_state_dict_into_model(
+            model, sam3_image_ckpt, assign=True
+        )
+    else:
+        with g_pathmgr.open(checkpoint_path, "rb") as f:
+            ckpt = torch.load(f, map_location="cpu", weights_only=True)
+        sam3_image_ckpt = normalize_checkpoint_state_dict(
+            ckpt, include_tracker=model.inst_interactive_predictor is not None
+        )
+        missing_keys, _ = model.load_state_dict(sam3_image_ckpt, strict=False)
     if len(missing_keys) > 0:
         print(
             f"loaded {checkpoint_path} and found "
@@ -565,6 +625,32 @@ def _setup_device_and_mode(model, device, eval_mode):
     return model
 
 
+def precompute_image_resolution(model, resolution):
+    """Fill the position caches of an image model for another input resolution.
+
+    The model is built for 1008 px inputs. Smaller inputs (a multiple of the
+    14 px patch size) work with the same weights, but the RoPE frequencies of
+    the global attention blocks, the sine position encodings of the neck
+    levels and the decoder box-RPB coordinates depend on the feature map size.
+    Computing them once per resolution keeps them off the request path.
+    """
+    vision_backbone = model.backbone.vision_backbone
+    trunk = vision_backbone.trunk
+    if resolution % trunk.patch_size != 0:
+        raise ValueError(
+            f"resolution must be a multiple of {trunk.patch_size}, got {resolution}"
+        )
+    device = next(model.parameters()).device
+    grid = resolution // trunk.patch_size
+
+    trunk.precompute_resolution(resolution)
+    vision_backbone.position_encoding.precompute(
+        [(int(grid * s), int(grid * s)) for s in vision_backbone.scale_factors],
+        device=device,
+    )
+    model.transformer.decoder.precompute_coords((grid, grid), device=device)
+
+
 def build_sam3_image_model(
     bpe_path=None,
     device="cuda" if torch.cuda.is_available() else "cpu",
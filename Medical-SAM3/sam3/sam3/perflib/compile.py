@@ -2,8 +2,19 @@
 
 # pyre-unsafe
 
+import hashlib
+import logging
+import os
+import platform
+import tempfile
+from typing import Optional
+
 import torch
 
+# torch.compile modes that replay CUDA graphs: their outputs live in static
+# buffers that are overwritten by the next call, so they must be cloned
+CUDAGRAPH_MODES = ("reduce-overhead", "max-autotune")
+
 
 def recursive_fn_factory(fn):
     def recursive_fn(b):
@@ -35,8 +46,21 @@ recursive_clone = recursive_fn_factory(torch.clone)
 
 
 def compile_wrapper(
-    fn, *, mode="max-autotune", fullgraph=True, dynamic=False, name=None
+    fn,
+    *,
+    mode="max-autotune",
+    fullgraph=True,
+    dynamic=False,
+    name=None,
+    clone_outputs=True,
 ):
+    """
+    Compiles ``fn``, making its inputs contiguous.
+
+    clone_outputs: Clone the outputs so that the caller owns them. Only needed
+    for modes that use CUDA graphs (``CUDAGRAPH_MODES``); other modes return
+    fresh tensors on every call.
+    """
     compiled_fn = torch.compile(fn, mode=mode, fullgraph=fullgraph, dynamic=dynamic)
 
     def compiled_fn_wrapper(*args, **kwargs):
@@ -46,12 +70,132 @@ def compile_wrapper(
             cont_args = recursive_contiguous(args)
             cont_kwargs = recursive_contiguous(kwargs)
             result = compiled_fn(*cont_args, **cont_kwargs)
-            cloned_result = recursive_clone(result)
-            return cloned_result
+            if clone_outputs:
+                result = recursive_clone(result)
+            return result
 
     return compiled_fn_wrapper
 
 
+def _device_descriptor(device) -> str:
+    device = torch.device(device)
+    if device.type == "cuda":
+        index = device.index if device.index is not None else torch.cuda.current_device()
+        major, minor = torch.cuda.get_device_capability(index)
+        return f"cuda:{torch.cuda.get_device_name(index)}:sm{major}{minor}"
+    capability = getattr(torch.backends.cpu, "get_cpu_capability", lambda: "")()
+    return f"{device.type}:{platform.machine()}:{capability}"
+
+
+def compile_cache_key(model: torch.nn.Module, device, extra: str = "") -> str:
+    """
+    Key of the compiled artifacts of ``model``: a hash of the module structure
+    and parameter shapes/dtypes (the weights themselves are graph inputs), the
+    torch version, the device and ``extra`` (e.g. the autocast mode).
+    """
+    h = hashlib.sha256()
+    h.update(torch.__version__.encode())
+    h.update(_device_descriptor(device).encode())
+    h.update(extra.encode())
+    h.update(repr(model).encode())
+    for name, tensor in model.state_dict().items():
+        h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+    return h.hexdigest()[:16]
+
+
+def enable_persistent_compile_cache(cache_dir: str):
+    """
+    Points the inductor FX graph cache, the autotuning results and the triton
+    kernels to ``cache_dir`` so that they survive restarts. Must be called
+    before the first compilation.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(cache_dir, "inductor")
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+    import torch._inductor.config as inductor_config
+
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, "autotune_local_cache"):
+        inductor_config.autotune_local_cache = True
+
+
+def load_compile_artifacts(path: str) -> bool:
+    """Preloads the compile caches from a file written by ``save_compile_artifacts``."""
+    if not os.path.exists(path) or not hasattr(torch.compiler, "load_cache_artifacts"):
+        return False
+    with open(path, "rb") as f:
+        torch.compiler.load_cache_artifacts(f.read())
+    return True
+
+
+def save_compile_artifacts(path: str) -> bool:
+    """
+    Saves the artifacts of the compilations done in this process (graphs,
+    kernels, autotuning results) to one file, which can be copied to other
+    replicas. Requires torch >= 2.7.
+    """
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return False
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return False
+    # Worker processes and replicas sharing the cache directory save after
+    # their warm-up: each writes its own temporary file, then the atomic
+    # rename makes one complete file win
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + "."
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(artifacts[0])
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def compile_image_model(
+    model,
+    device,
+    mode: str = "max-autotune-no-cudagraphs",
+    cache_dir: Optional[str] = None,
+    cache_extra: str = "",
+) -> Optional[str]:
+    """
+    Compiles the image grounding path of a Sam3Image model: the image backbone
+    and ``forward_grounding``. The text encoder is not compiled, its outputs
+    are cached per prompt.
+
+    With ``cache_dir``, compiled artifacts are persisted in a subdirectory keyed
+    by ``compile_cache_key`` and reused by later processes. Returns the path of
+    the artifacts file (see ``save_compile_artifacts``), or None.
+    """
+    artifacts_path = None
+    if cache_dir is not None:
+        key_dir = os.path.join(
+            cache_dir, compile_cache_key(model, device, extra=cache_extra)
+        )
+        enable_persistent_compile_cache(key_dir)
+        artifacts_path = os.path.join(key_dir, "artifacts.bin")
+        if load_compile_artifacts(artifacts_path):
+            logging.info(f"Loaded compile artifacts from {artifacts_path}")
+
+    model.backbone.forward_image = compile_wrapper(
+        model.backbone.forward_image,
+        mode=mode,
+        fullgraph=False,
+        name="compiled forward_image",
+        clone_outputs=mode in CUDAGRAPH_MODES,
+    )
+    # Prompts are dataclasses and the number of prompts varies: no
+    # contiguous/clone wrapping and dynamic shapes after the first recompile
+    model.forward_grounding = torch.compile(
+        model.forward_grounding, mode=mode, fullgraph=False, dynamic=None
+    )
+    return artifacts_path
+
+
 def shape_logging_wrapper(fn, keep_kwargs, enable_logging=False):
     """
     Wraps a function and prints the shapes of all tensor inputs.
@@ -8,6 +8,9 @@ import numpy as np
 import pytest
 import torch
 from PIL import Image
+from sam3.model.decoder import TransformerDecoder, TransformerDecoderLayer
+from sam3.model.model_misc import MultiheadAttentionWrapper
+from sam3.perflib.compile import compile_cache_key
 from sam3.perflib.masks_ops import masks_to_boxes
 
 
@@ -59,3 +62,87 @@ class TestMasksToBoxes:
             )
             masks = _create_masks(image, masks)
             masks_box_check(masks, expected)
+
+
+class TestCompileCacheKey:
+    def test_key_depends_on_structure_not_weights(self):
+        model = torch.nn.Linear(4, 4)
+        key = compile_cache_key(model, "cpu")
+        assert key == compile_cache_key(model, "cpu")
+
+        # The weights are graph inputs, new values reuse the compiled artifacts
+        with torch.no_grad():
+            model.weight.add_(1.0)
+        assert key == compile_cache_key(model, "cpu")
+
+        assert key != compile_cache_key(torch.nn.Linear(4, 8), "cpu")
+        assert key != compile_cache_key(model.to(torch.bfloat16), "cpu")
+        assert key != compile_cache_key(torch.nn.Linear(4, 4), "cpu", extra="bf16")
+
+
+class TestCompiledBoxRPB:
+    D_MODEL = 32
+
+    def _decoder(self):
+        # The box-RPB setup of the model builder (1008 px, stride 14), scaled down
+        layer = TransformerDecoderLayer(
+            activation="relu",
+            d_model=self.D_MODEL,
+            dim_feedforward=64,
+            dropout=0.0,
+            cross_attention=MultiheadAttentionWrapper(
+                num_heads=2, dropout=0.0, embed_dim=self.D_MODEL
+            ),
+            n_heads=2,
+            use_text_cross_attention=True,
+        )
+        return TransformerDecoder(
+            layer=layer,
+            num_layers=2,
+            num_queries=4,
+            return_intermediate=True,
+            box_refine=True,
+            boxRPB="log",
+            d_model=self.D_MODEL,
+            frozen=False,
+            interaction_layer=None,
+            resolution=1008,
+            stride=14,
+            presence_token=True,
+        ).eval()
+
+    def _grounding_pass(self, forward, decoder, feat, device):
+        generator = torch.Generator().manual_seed(feat)
+        memory = torch.randn(feat * feat, 1, self.D_MODEL, generator=generator)
+        text = torch.randn(3, 1, self.D_MODEL, generator=generator)
+        return forward(
+            tgt=decoder.query_embed.weight.unsqueeze(1),
+            memory=memory.to(device),
+            pos=torch.zeros_like(memory, device=device),
+            reference_boxes=None,
+            level_start_index=torch.zeros(1, dtype=torch.long, device=device),
+            spatial_shapes=torch.tensor([[feat, feat]], device=device),
+            feat_sizes=[(feat, feat)],
+            valid_ratios=torch.ones(1, 1, 2, device=device),
+            memory_text=text.to(device),
+            apply_dac=False,
+        )
+
+    def test_compiled_pass_at_full_and_preview_size(self):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        decoder = self._decoder().to(device)
+        # 1008 px and the 672 px preview tier
+        decoder.precompute_coords((48, 48), device=device)
+        cached = dict(decoder.coord_cache)
+
+        torch._dynamo.reset()
+        compiled = torch.compile(decoder.forward, backend="eager", fullgraph=False)
+        with torch.no_grad():
+            for feat in (72, 48, 72):
+                expected = self._grounding_pass(decoder.forward, decoder, feat, device)
+                out = self._grounding_pass(compiled, decoder, feat, device)
+                for e, o in zip(expected, out):
+                    torch.testing.assert_close(o, e)
+
+        # The compiled passes used the precomputed entries
+        assert decoder.coord_cache.keys() == cached.keys()
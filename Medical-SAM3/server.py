@@ -4,26 +4,48 @@ Based on sam3_api.py but adapted for production use with environment variables
 """
 import base64
 import io
+import json
 import os
+import threading
 import time
-from typing import Optional
+from typing import Optional, Tuple
 
 import numpy as np
 from fastapi import FastAPI, File, Form, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from PIL import Image
 import torch
 
 # Import SAM3 inference module
 try:
-    from inference.sam3_inference import SAM3Model, resize_mask
+    from inference.sam3_inference import RESOLUTION_TIERS, SAM3Model, TextEmbeddingCache, resize_mask
+    from inference.embedding_cache import ImageEmbeddingCache
+    from inference.session_store import SessionStore
+    from inference.batching import BatchingWorker
+    from inference.dataset_loaders import DATASET_PROMPTS
+    from inference.mask_codec import MASK_FORMATS, encode_mask, mask_to_bits, mask_to_png_data_url
+    from inference.executor import ExecutorOverloaded, InferenceExecutor
+    from inference.worker_pool import ModelWorkerPool, SessionNotFound
+    from inference.lifecycle import ModelLifecycle
+    from inference.ingest import ImageTooLarge, decode_image
+    from inference.dicom import DicomSeries, is_dicom, mask_stats, scaled_spacing
 except ModuleNotFoundError:
     # Fallback for Docker environment
     import sys
     from pathlib import Path
     sys.path.insert(0, str(Path(__file__).parent))
-    from inference.sam3_inference import SAM3Model, resize_mask
+    from inference.sam3_inference import RESOLUTION_TIERS, SAM3Model, TextEmbeddingCache, resize_mask
+    from inference.embedding_cache import ImageEmbeddingCache
+    from inference.session_store import SessionStore
+    from inference.batching import BatchingWorker
+    from inference.dataset_loaders import DATASET_PROMPTS
+    from inference.mask_codec import MASK_FORMATS, encode_mask, mask_to_bits, mask_to_png_data_url
+    from inference.executor import ExecutorOverloaded, InferenceExecutor
+    from inference.worker_pool import ModelWorkerPool, SessionNotFound
+    from inference.lifecycle import ModelLifecycle
+    from inference.ingest import ImageTooLarge, decode_image
+    from inference.dicom import DicomSeries, is_dicom, mask_stats, scaled_spacing
 
 app = FastAPI(title="Medical-SAM3 Server", version="1.0.0")
 
@@ -34,18 +56,114 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Needed by browser clients of the "binary" mask format
+    expose_headers=["X-Segmentation-Result", "X-Mask-Size"],
 )
 
 # Global model instance
 MODEL: Optional[SAM3Model] = None
 
-# MedSAM3 checkpoint: use env override or default checkpoint.pt in this directory
-DEFAULT_CHECKPOINT = os.path.join(os.path.dirname(__file__), "checkpoint.pt")
+# MedSAM3 checkpoint: use env override or default checkpoint in this directory.
+# A converted checkpoint.safetensors (inference/convert_checkpoint.py) is
+# memory-mapped and preferred over checkpoint.pt.
+DEFAULT_CHECKPOINTS = [
+    os.path.join(os.path.dirname(__file__), name)
+    for name in ("checkpoint.safetensors", "checkpoint.pt")
+]
 CHECKPOINT_PATH = os.environ.get("MEDSAM3_CHECKPOINT_PATH", None)
-if CHECKPOINT_PATH is None and os.path.exists(DEFAULT_CHECKPOINT):
-    CHECKPOINT_PATH = DEFAULT_CHECKPOINT
-    print(f"Using MedSAM3 checkpoint: {CHECKPOINT_PATH}")
+if CHECKPOINT_PATH is None:
+    CHECKPOINT_PATH = next((p for p in DEFAULT_CHECKPOINTS if os.path.exists(p)), None)
+    if CHECKPOINT_PATH:
+        print(f"Using MedSAM3 checkpoint: {CHECKPOINT_PATH}")
 DEVICE = os.environ.get("DEVICE", "cpu")  # Default to CPU for Railway
+# CPU precision mode: fp32, bf16 (autocast) or int8 (quantized Linear layers).
+# Measure the accuracy cost first with inference/compare_precision.py
+MODEL_PRECISION = os.environ.get("MODEL_PRECISION", "fp32")
+# Optional torch.compile of the image path, with artifacts persisted across restarts
+COMPILE_MODE = os.environ.get("COMPILE_MODE") or None
+COMPILE_CACHE_DIR = os.environ.get("COMPILE_CACHE_DIR") or None
+
+# Image embedding cache: re-prompting the same image skips the ViT backbone
+EMBEDDING_CACHE = ImageEmbeddingCache(
+    max_bytes=int(float(os.environ.get("EMBEDDING_CACHE_MB", "1024")) * 1024 * 1024),
+    offload_to_cpu=os.environ.get("EMBEDDING_CACHE_OFFLOAD", "0") == "1",
+)
+
+# Text prompt cache: repeated prompts skip the text transformer
+TEXT_CACHE_SIZE = int(os.environ.get("TEXT_CACHE_SIZE", "1024"))
+TEXT_CACHE_PATH = os.environ.get("TEXT_CACHE_PATH", None)
+TEXT_CACHE_WARMUP_PROMPTS = list(DATASET_PROMPTS.values()) + [
+    p.strip() for p in os.environ.get("TEXT_CACHE_WARMUP_PROMPTS", "").split(",") if p.strip()
+]
+
+# Startup: build, load and warm up the model before reporting ready on /ready.
+# With WARMUP_ON_STARTUP=0 the model is loaded by the first request instead.
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") == "1"
+WARMUP_IMAGE_SIZE = int(os.environ.get("WARMUP_IMAGE_SIZE", "1008"))
+LIFECYCLE = ModelLifecycle()
+MODEL_LOCK = threading.Lock()
+
+# Multi-process serving: with MODEL_WORKERS > 0 this process only handles HTTP
+# and dispatches inference to one model replica per worker process
+MODEL_WORKERS = int(os.environ.get("MODEL_WORKERS", "0"))
+POOL: Optional[ModelWorkerPool] = None
+
+
+def release_worker_session(session):
+    """Free the inference state a worker holds for an expired or deleted session."""
+    if POOL is not None and session.worker is not None:
+        try:
+            POOL.submit("release", worker=session.worker, image_id=session.image_id)
+        except RuntimeError:
+            pass  # Pool already shut down
+
+
+# Image sessions: upload and encode once, then prompt many times. With model
+# workers the states live in the workers, which hold at most
+# SESSION_MAX_PER_WORKER each: the store evicts to the same cap
+SESSION_MAX_PER_WORKER = int(os.environ.get("SESSION_MAX_PER_WORKER", "64"))
+SESSIONS = SessionStore(
+    ttl_seconds=float(os.environ.get("SESSION_TTL_SECONDS", "900")),
+    max_bytes=int(float(os.environ.get("SESSION_MAX_MB", "2048")) * 1024 * 1024),
+    max_sessions_per_worker=SESSION_MAX_PER_WORKER,
+    on_remove=release_worker_session,
+    # Embeddings the cache holds are shared with sessions, not charged twice
+    shared_tensors=EMBEDDING_CACHE.tensor_keys,
+)
+
+# Blocking work (decode, inference, mask encoding) runs off the event loop,
+# with bounded admission so that latency under load stays predictable
+EXECUTOR = InferenceExecutor(
+    max_workers=int(os.environ.get("INFERENCE_WORKERS", "1")),
+    max_queue=int(os.environ.get("INFERENCE_QUEUE_SIZE", "8")),
+)
+
+# Micro-batching: concurrent /segment requests share one backbone and grounding pass
+BATCHER = BatchingWorker(
+    max_batch_size=int(os.environ.get("BATCH_MAX_SIZE", "4")),
+    max_wait_ms=float(os.environ.get("BATCH_MAX_WAIT_MS", "10")),
+    executor=EXECUTOR.pool,
+)
+
+# Tiled mode (/segment with tiled=true): images larger than the model input are
+# segmented at native resolution with overlapping 1008 px tiles
+TILING = {
+    "overlap": int(os.environ.get("TILE_OVERLAP", "128")),
+    "batch_size": int(os.environ.get("TILE_BATCH_SIZE", "4")),
+    "max_memory_mb": float(os.environ.get("TILED_MAX_MEMORY_MB", "2048")),
+}
+# Resolution tiers (/segment resolution=preview|auto): reduced input sizes whose
+# position caches are built at load; "auto" re-runs at full resolution when the
+# preview finds nothing or scores below RESOLUTION_ESCALATE_BELOW
+PRECOMPUTE_RESOLUTIONS = [
+    int(r) for r in os.environ.get("PRECOMPUTE_RESOLUTIONS", str(RESOLUTION_TIERS["preview"])).split(",") if r.strip()
+]
+RESOLUTION_ESCALATE_BELOW = float(os.environ.get("RESOLUTION_ESCALATE_BELOW", "0.5"))
+# Click refinement (/images/{image_id}/refine) needs the interactive predictor
+ENABLE_REFINEMENT = os.environ.get("ENABLE_REFINEMENT", "0") == "1"
+TILED_MAX_PIXELS = int(float(os.environ.get("TILED_MAX_MEGAPIXELS", "256")) * 1_000_000)
+# Let PIL open such images, load_image enforces TILED_MAX_PIXELS instead
+Image.MAX_IMAGE_PIXELS = max(Image.MAX_IMAGE_PIXELS or 0, TILED_MAX_PIXELS)
 
 
 def get_model(checkpoint_path: Optional[str] = None, device: str = "cpu") -> SAM3Model:
@@ -53,23 +171,119 @@ def get_model(checkpoint_path: Optional[str] = None, device: str = "cpu") -> SAM
     global MODEL
     effective_checkpoint = checkpoint_path or CHECKPOINT_PATH
     effective_device = device if device != "cuda" or torch.cuda.is_available() else "cpu"
-    
-    if MODEL is None or MODEL.checkpoint_path != effective_checkpoint:
-        print(f"Loading Medical-SAM3 model (checkpoint: {effective_checkpoint}, device: {effective_device})")
-        MODEL = SAM3Model(
-            confidence_threshold=0.1,
-            device=effective_device,
-            checkpoint_path=effective_checkpoint
+
+    # Requests may arrive while the startup is still creating the model
+    with MODEL_LOCK:
+        if MODEL is None or MODEL.checkpoint_path != effective_checkpoint:
+            print(f"Loading Medical-SAM3 model (checkpoint: {effective_checkpoint}, device: {effective_device})")
+            if MODEL is not None and TEXT_CACHE_PATH:
+                MODEL.save_text_cache(TEXT_CACHE_PATH)
+            MODEL = SAM3Model(
+                confidence_threshold=0.1,
+                device=effective_device,
+                checkpoint_path=effective_checkpoint,
+                precision=MODEL_PRECISION,
+                compile_mode=COMPILE_MODE,
+                compile_cache_dir=COMPILE_CACHE_DIR,
+                resolutions=PRECOMPUTE_RESOLUTIONS,
+                interactive=ENABLE_REFINEMENT,
+                embedding_cache=EMBEDDING_CACHE,
+                # Text embeddings depend on the weights, so each model gets its own cache
+                text_cache=TextEmbeddingCache(max_entries=TEXT_CACHE_SIZE) if TEXT_CACHE_SIZE > 0 else None,
+            )
+            # Restore the text cache saved by a previous run (ignored if saved for another checkpoint)
+            if TEXT_CACHE_PATH and os.path.exists(TEXT_CACHE_PATH):
+                loaded = MODEL.load_text_cache(TEXT_CACHE_PATH)
+                print(f"Loaded {loaded} cached text prompts from {TEXT_CACHE_PATH}")
+        return MODEL
+
+
+def load_and_warm_up(lifecycle: ModelLifecycle):
+    """Startup of the in-process model: build, load weights, then warm up."""
+    with lifecycle.stage_timer("load"):
+        model = get_model(None, resolve_device(None))
+        model.load_model()
+    with lifecycle.stage_timer("warmup"):
+        model.warmup(TEXT_CACHE_WARMUP_PROMPTS, image_size=WARMUP_IMAGE_SIZE)
+    lifecycle.record(model.load_timings)
+
+
+def wait_for_workers(lifecycle: ModelLifecycle):
+    """Startup with MODEL_WORKERS > 0: the workers load and warm up their own replica."""
+    with lifecycle.stage_timer("workers"):
+        POOL.wait_ready()
+
+
+@app.on_event("startup")
+def start_model():
+    """Start loading the model in the background; /ready reports when it is done."""
+    global POOL
+    if MODEL_WORKERS > 0:
+        devices = [d.strip() for d in os.environ.get("MODEL_WORKER_DEVICES", "").split(",") if d.strip()]
+        model_kwargs = {
+            "confidence_threshold": 0.1,
+            "checkpoint_path": CHECKPOINT_PATH,
+            "precision": MODEL_PRECISION,
+            "compile_mode": COMPILE_MODE,
+            "compile_cache_dir": COMPILE_CACHE_DIR,
+            "resolutions": PRECOMPUTE_RESOLUTIONS,
+            "interactive": ENABLE_REFINEMENT,
+            "embedding_cache_bytes": EMBEDDING_CACHE.max_bytes // MODEL_WORKERS,
+            "text_cache_size": TEXT_CACHE_SIZE,
+            "text_cache_path": TEXT_CACHE_PATH,
+        }
+        if WARMUP_ON_STARTUP:
+            model_kwargs["warmup_prompts"] = TEXT_CACHE_WARMUP_PROMPTS
+            model_kwargs["warmup_image_size"] = WARMUP_IMAGE_SIZE
+        POOL = ModelWorkerPool(
+            MODEL_WORKERS,
+            model_kwargs=model_kwargs,
+            devices=devices or [resolve_device(None)],
+            pin_cores=os.environ.get("MODEL_WORKER_PIN", "1") == "1",
+            max_sessions_per_worker=SESSION_MAX_PER_WORKER,
         )
-    return MODEL
+        POOL.start()
+        print(f"Started {MODEL_WORKERS} model workers on {POOL.devices}")
+        LIFECYCLE.start(wait_for_workers)
+    elif WARMUP_ON_STARTUP:
+        LIFECYCLE.start(load_and_warm_up)
+    else:
+        LIFECYCLE.mark_ready()
 
 
-def mask_to_data_url(mask: np.ndarray) -> str:
-    """Convert mask to base64 data URL."""
-    mask_img = Image.fromarray((mask > 0).astype(np.uint8) * 255)
-    buf = io.BytesIO()
-    mask_img.save(buf, format="PNG")
-    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode("utf-8")
+@app.on_event("shutdown")
+def save_text_cache():
+    """Persist the text cache so that restarts start warm."""
+    if MODEL is not None and TEXT_CACHE_PATH:
+        MODEL.save_text_cache(TEXT_CACHE_PATH)
+
+
+@app.on_event("shutdown")
+def stop_model_workers():
+    if POOL is not None:
+        POOL.shutdown()
+
+
+def pool_checkpoint_error(checkpoint: Optional[str]) -> Optional[JSONResponse]:
+    """
+    400 response for a checkpoint override with model workers (they serve a
+    single checkpoint), or None if the request can be served.
+    """
+    if POOL is None or not checkpoint or checkpoint == CHECKPOINT_PATH:
+        return None
+    return JSONResponse({
+        "success": False,
+        "error": "Checkpoint overrides are not supported with MODEL_WORKERS > 0"
+    }, status_code=400)
+
+
+def session_lost_response(image_id: str) -> JSONResponse:
+    """404 for a session whose state its worker no longer holds; the session is dropped."""
+    SESSIONS.delete(image_id)
+    return JSONResponse({
+        "success": False,
+        "error": f"Unknown or expired image_id: {image_id}"
+    }, status_code=404)
 
 
 def overlay_to_data_url(image_np: np.ndarray, mask: np.ndarray) -> str:
@@ -103,18 +317,266 @@ async def root():
         "service": "Medical-SAM3 Server",
         "version": "1.0.0",
         "device": DEVICE,
+        "precision": MODEL_PRECISION,
         "checkpoint": checkpoint_status
     }
 
 
 @app.get("/health")
 async def health():
-    """Health check endpoint."""
+    """Liveness check: answers as soon as the server runs, even while the model loads."""
     return {
         "status": "ok",
         "service": "Medical-SAM3 Server",
-        "model_loaded": MODEL is not None
+        "model_loaded": MODEL is not None and MODEL.processor is not None,
+        "startup": LIFECYCLE.status(),
+        "embedding_cache": EMBEDDING_CACHE.stats(),
+        "text_cache": MODEL.text_cache.stats() if MODEL is not None and MODEL.text_cache is not None else None,
+        "sessions": SESSIONS.stats(),
+        "batching": BATCHER.stats(),
+        "workers": POOL.stats() if POOL is not None else None,
+    }
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness check: 200 once the model is loaded and warmed up, 503 before."""
+    status = LIFECYCLE.status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Inference queue depth and counters."""
+    return {
+        "executor": EXECUTOR.stats(),
+        "batching": BATCHER.stats(),
+        "embedding_cache": EMBEDDING_CACHE.stats(),
+        "sessions": SESSIONS.stats(),
+        "workers": POOL.stats() if POOL is not None else None,
+    }
+
+
+def resolve_device(device: Optional[str]) -> str:
+    """Requested device, falling back to CPU when CUDA is not available."""
+    effective_device = device or DEVICE
+    if effective_device == "cuda" and not torch.cuda.is_available():
+        effective_device = "cpu"
+        print("CUDA not available, using CPU")
+    return effective_device
+
+
+def load_image(content: bytes, max_size: Optional[int] = 1024) -> np.ndarray:
+    """
+    Decode an uploaded image to RGB, downscaling it if too large.
+
+    With max_size=None (tiled mode) the native resolution is kept. Images
+    above TILED_MAX_PIXELS are rejected in both cases.
+    """
+    return decode_image(content, max_size, TILED_MAX_PIXELS)
+
+
+def load_upload(
+    content: bytes, max_size: Optional[int] = 1024, frame: Optional[int] = None
+) -> Tuple[np.ndarray, Optional[Tuple[float, float]]]:
+    """
+    Decode an uploaded image or DICOM file to RGB, see load_image.
+
+    DICOM frames are windowed with the window stored in the file (or their
+    value range). The middle frame of multi-frame files is used unless
+    ``frame`` is given.
+
+    Returns:
+        The image and, for DICOM files, its (row, column) pixel spacing in mm
+    """
+    if not is_dicom(content):
+        return load_image(content, max_size), None
+
+    series = DicomSeries.open(content)
+    index = len(series) // 2 if frame is None else frame
+    if not 0 <= index < len(series):
+        raise ValueError(f"Frame {index} out of range, the file has {len(series)} frames")
+    image_np = series.image(index)
+    height, width = image_np.shape[:2]
+    if height * width > TILED_MAX_PIXELS:
+        raise ImageTooLarge(f"Image of {width}x{height} exceeds TILED_MAX_MEGAPIXELS")
+    if max_size is not None and max(height, width) > max_size:
+        ratio = max_size / max(height, width)
+        new_size = (int(width * ratio), int(height * ratio))
+        image_np = np.asarray(Image.fromarray(image_np).resize(new_size, Image.Resampling.LANCZOS))
+    return image_np, scaled_spacing(series.pixel_spacing, (height, width), image_np.shape[:2])
+
+
+def segmentation_result(
+    image_np: np.ndarray,
+    pred_mask: Optional[np.ndarray],
+    prompt: str,
+    inference_time: float,
+    device: str,
+    mask_format: str = "png",
+    overlay: Optional[bool] = None,
+    extra_stats: Optional[dict] = None,
+    pixel_spacing: Optional[Tuple[float, float]] = None,
+) -> dict:
+    """
+    Build the result payload expected by the frontend from a predicted mask.
+
+    With the default "png" format, mask_url holds the rendered overlay as before.
+    Other formats return the encoded mask under "mask" and only render the
+    overlay if explicitly requested. With a pixel spacing (DICOM uploads), the
+    stats also hold the physical area and diameter.
+    """
+    if overlay is None:
+        overlay = mask_format == "png"
+    if pred_mask is None:
+        return {
+            "success": False,
+            "mask_url": None,
+            "description": f"No regions detected for '{prompt}'. Try a different prompt.",
+            "confidence": 0.2,
+            "stats": {"mode": "medical-sam3", "prompt": prompt, "error": "No mask predicted"}
+        }
+
+    # Resize mask if needed
+    if pred_mask.shape != image_np.shape[:2]:
+        pred_mask = resize_mask(pred_mask, image_np.shape[:2])
+
+    # Calculate statistics
+    area_px = int(pred_mask.sum())
+    total_px = pred_mask.shape[0] * pred_mask.shape[1]
+    coverage = (area_px / total_px) * 100
+
+    ys, xs = np.where(pred_mask > 0)
+    if len(xs) == 0 or len(ys) == 0:
+        diameter_px = 0
+    else:
+        diameter_px = int(max(xs.max() - xs.min(), ys.max() - ys.min()))
+
+    # Calculate confidence based on area
+    confidence = 0.85 if area_px > 1000 else (0.7 if area_px > 100 else 0.5)
+
+    description = (
+        f"🔬 Medical-SAM3 detected '{prompt}'. "
+        f"Coverage: {coverage:.1f}% ({area_px} px). Diameter: {diameter_px} px. "
+        f"Inference: {inference_time:.2f}s. "
+        f"\n\n⚠️ This AI highlights visual features for reference only. "
+        f"ALWAYS consult a qualified physician for medical interpretation."
+    )
+
+    # Create overlay URL (frontend expects overlay, not just mask)
+    if overlay:
+        mask_url = overlay_to_data_url(image_np, pred_mask)
+    elif mask_format == "png":
+        mask_url = mask_to_png_data_url(pred_mask)
+    else:
+        mask_url = None
+
+    # Return in format expected by frontend
+    result = {
+        "success": True,
+        "mask_url": mask_url,
+        "description": description,
+        "confidence": confidence,
+        "stats": {
+            "mode": "medical-sam3",
+            "prompt": prompt,
+            "coverage_percent": round(coverage, 2),
+            "area_px": area_px,
+            "diameter_px": diameter_px,
+            "inference_time": round(inference_time, 3),
+            "device": device,
+            **mask_stats(pred_mask, pixel_spacing),
+            **(extra_stats or {}),
+        }
     }
+    if mask_format in ("rle", "bits"):
+        result["mask"] = encode_mask(pred_mask, mask_format)
+    return result
+
+
+def segmentation_response(
+    image_np: np.ndarray,
+    pred_mask: Optional[np.ndarray],
+    prompt: str,
+    inference_time: float,
+    device: str,
+    mask_format: str = "png",
+    overlay: Optional[bool] = None,
+    extra_stats: Optional[dict] = None,
+    pixel_spacing: Optional[Tuple[float, float]] = None,
+) -> Response:
+    """
+    Build the response for a predicted mask.
+
+    The "binary" format returns the bit-packed mask (row-major, MSB first) as
+    the body, with the mask size and the JSON result (without overlay) in headers.
+    """
+    if mask_format != "binary":
+        return JSONResponse(segmentation_result(
+            image_np, pred_mask, prompt, inference_time, device, mask_format, overlay, extra_stats, pixel_spacing
+        ))
+
+    if pred_mask is not None and pred_mask.shape != image_np.shape[:2]:
+        pred_mask = resize_mask(pred_mask, image_np.shape[:2])
+    result = segmentation_result(
+        image_np, pred_mask, prompt, inference_time, device, "binary", False, extra_stats, pixel_spacing
+    )
+    headers = {"X-Segmentation-Result": json.dumps(result, ensure_ascii=True)}
+    if pred_mask is None:
+        return Response(status_code=204, headers=headers)
+    headers["X-Mask-Size"] = f"{pred_mask.shape[0]},{pred_mask.shape[1]}"
+    return Response(content=mask_to_bits(pred_mask), media_type="application/octet-stream", headers=headers)
+
+
+def mask_format_error(mask_format: str) -> Optional[JSONResponse]:
+    """400 response for an unknown mask format, or None if it is supported."""
+    if mask_format in MASK_FORMATS:
+        return None
+    return JSONResponse({
+        "success": False,
+        "error": f"Unknown format '{mask_format}', expected one of {', '.join(MASK_FORMATS)}"
+    }, status_code=400)
+
+
+def resolution_error(resolution: str) -> Optional[JSONResponse]:
+    """400 response for an unknown resolution tier, or None if it is supported."""
+    if resolution in RESOLUTION_TIERS or resolution == "auto":
+        return None
+    return JSONResponse({
+        "success": False,
+        "error": f"Unknown resolution '{resolution}', expected one of {', '.join(list(RESOLUTION_TIERS) + ['auto'])}"
+    }, status_code=400)
+
+
+def error_response(prompt: str, e: Exception) -> JSONResponse:
+    """Log an inference error and wrap it in the frontend response format."""
+    print(f"Segmentation error: {e}")
+    import traceback
+    traceback.print_exc()
+
+    return JSONResponse({
+        "success": False,
+        "mask_url": None,
+        "description": f"Error analyzing '{prompt}': {str(e)[:100]}. Please consult a medical professional.",
+        "confidence": 0,
+        "stats": {"error": str(e)[:200], "mode": "medical-sam3"}
+    }, status_code=500)
+
+
+def image_too_large_response(e: ImageTooLarge) -> JSONResponse:
+    """413 for an upload above TILED_MAX_PIXELS."""
+    return JSONResponse({"success": False, "error": str(e)}, status_code=413)
+
+
+def overloaded_response(e: ExecutorOverloaded) -> JSONResponse:
+    """503 with Retry-After when the inference queue is full."""
+    return JSONResponse({
+        "success": False,
+        "mask_url": None,
+        "description": "Server is busy, please retry shortly.",
+        "confidence": 0,
+        "stats": {"error": str(e), "mode": "medical-sam3", "retry_after": e.retry_after}
+    }, status_code=503, headers={"Retry-After": str(e.retry_after)})
 
 
 @app.post("/segment")
@@ -123,6 +585,11 @@ async def segment(
     prompt: str = Form(...),
     checkpoint: Optional[str] = Form(None),
     device: Optional[str] = Form(None),
+    format: str = Form("png"),
+    overlay: Optional[bool] = Form(None),
+    tiled: bool = Form(False),
+    resolution: str = Form("full"),
+    frame: Optional[int] = Form(None),
 ):
     """
     Segment medical image using text prompt.
@@ -132,107 +599,524 @@ async def segment(
         prompt: Text description of what to segment (e.g., "fracture", "tumor")
         checkpoint: Optional checkpoint path (overrides env var)
         device: Optional device ("cpu" or "cuda")
+        format: Mask encoding: "png" (default), "rle", "bits" or "binary"
+        overlay: Render the overlay PNG into mask_url (default only for "png")
+        tiled: Segment at native resolution with overlapping tiles instead of
+            downscaling (large fundus or histology images)
+        resolution: Model input tier: "full" (default), "preview" (faster,
+            coarser) or "auto" (preview, re-run at full resolution when unsure)
+        frame: Frame of a multi-frame DICOM upload (default: the middle one)
     
     Returns:
         JSON with mask_url, description, confidence, and stats
     """
+    request_error = mask_format_error(format) or resolution_error(resolution) or pool_checkpoint_error(checkpoint)
+    if request_error is not None:
+        return request_error
+
     try:
-        # Determine device
-        effective_device = device or DEVICE
-        if effective_device == "cuda" and not torch.cuda.is_available():
-            effective_device = "cpu"
-            print("CUDA not available, using CPU")
-
-        # Read and process image
-        content = await image.read()
-        image_pil = Image.open(io.BytesIO(content)).convert("RGB")
-        image_np = np.array(image_pil)
-        
-        # Resize if too large (max 1024px for CPU performance)
-        max_size = 1024
-        if max(image_pil.size) > max_size:
-            ratio = max_size / max(image_pil.size)
-            new_size = (int(image_pil.size[0] * ratio), int(image_pil.size[1] * ratio))
-            image_pil = image_pil.resize(new_size, Image.Resampling.LANCZOS)
-            image_np = np.array(image_pil)
-
-        # Get model and run inference
-        model = get_model(checkpoint, effective_device)
-        start = time.perf_counter()
-        inference_state = model.encode_image(image_np)
-        pred_mask = model.predict_text(inference_state, prompt)
-        inference_time = time.perf_counter() - start
-
-        if pred_mask is None:
-            return JSONResponse({
-                "success": False,
-                "mask_url": None,
-                "description": f"No regions detected for '{prompt}'. Try a different prompt.",
-                "confidence": 0.2,
-                "stats": {"mode": "medical-sam3", "prompt": prompt, "error": "No mask predicted"}
-            })
-
-        # Resize mask if needed
-        if pred_mask.shape != image_np.shape[:2]:
-            pred_mask = resize_mask(pred_mask, image_np.shape[:2])
-
-        # Calculate statistics
-        area_px = int(pred_mask.sum())
-        total_px = pred_mask.shape[0] * pred_mask.shape[1]
-        coverage = (area_px / total_px) * 100
-        
-        ys, xs = np.where(pred_mask > 0)
-        if len(xs) == 0 or len(ys) == 0:
-            diameter_px = 0
-        else:
-            diameter_px = int(max(xs.max() - xs.min(), ys.max() - ys.min()))
+        with EXECUTOR.admit():
+            effective_device = resolve_device(device)
 
-        # Create mask and overlay URLs
-        mask_data_url = mask_to_data_url(pred_mask)
-        overlay_data_url = overlay_to_data_url(image_np, pred_mask)
+            # Read and process image
+            content = await image.read()
+            image_np, pixel_spacing = await EXECUTOR.run(load_upload, content, None if tiled else 1024, frame)
+            tier, escalate_below = ("preview", RESOLUTION_ESCALATE_BELOW) if resolution == "auto" else (resolution, None)
+            extra_stats = None
 
-        # Calculate confidence based on area
-        confidence = 0.85 if area_px > 1000 else (0.7 if area_px > 100 else 0.5)
+            if tiled:
+                start = time.perf_counter()
+                if POOL is not None:
+                    pred_mask = await POOL.call("segment_tiled", image_np, prompt=prompt, **TILING)
+                else:
+                    model = await EXECUTOR.run(get_model, checkpoint, effective_device)
+                    pred_mask = await EXECUTOR.run(model.segment_tiled, image_np, prompt, **TILING)
+                inference_time = time.perf_counter() - start
+                if not pred_mask.any():
+                    pred_mask = None
+            elif POOL is not None:
+                # Image goes to the least loaded worker through shared memory
+                start = time.perf_counter()
+                pred_mask, used_resolution = await POOL.call(
+                    "segment_text", image_np, prompt=prompt, resolution=tier, escalate_below=escalate_below
+                )
+                inference_time = time.perf_counter() - start
+                extra_stats = {"resolution": used_resolution}
+            elif tier != "full":
+                model = await EXECUTOR.run(get_model, checkpoint, effective_device)
+                start = time.perf_counter()
+                pred_mask, used_resolution = await EXECUTOR.run(
+                    model.segment_text, image_np, prompt, tier, escalate_below
+                )
+                inference_time = time.perf_counter() - start
+                extra_stats = {"resolution": used_resolution}
+            else:
+                # Get model and run inference, batched with concurrent requests
+                model = await EXECUTOR.run(get_model, checkpoint, effective_device)
+                start = time.perf_counter()
+                pred_mask = await BATCHER.submit(model, image_np, prompt)
+                inference_time = time.perf_counter() - start
+                extra_stats = {"resolution": RESOLUTION_TIERS["full"]}
 
-        description = (
-            f"🔬 Medical-SAM3 detected '{prompt}'. "
-            f"Coverage: {coverage:.1f}% ({area_px} px). Diameter: {diameter_px} px. "
-            f"Inference: {inference_time:.2f}s. "
-            f"\n\n⚠️ This AI highlights visual features for reference only. "
-            f"ALWAYS consult a qualified physician for medical interpretation."
-        )
+            return await EXECUTOR.run(
+                segmentation_response, image_np, pred_mask, prompt, inference_time, effective_device, format, overlay,
+                extra_stats, pixel_spacing
+            )
+
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except ImageTooLarge as e:
+        return image_too_large_response(e)
+    except Exception as e:
+        return error_response(prompt, e)
+
+
+@app.post("/images")
+async def create_image_session(
+    image: UploadFile = File(...),
+    checkpoint: Optional[str] = Form(None),
+    device: Optional[str] = Form(None),
+):
+    """
+    Upload and encode an image once for interactive prompting.
+
+    Args:
+        image: Medical image file
+        checkpoint: Optional checkpoint path (overrides env var)
+        device: Optional device ("cpu" or "cuda")
+
+    Returns:
+        JSON with the image_id to use with /images/{image_id}/segment
+    """
+    checkpoint_error = pool_checkpoint_error(checkpoint)
+    if checkpoint_error is not None:
+        return checkpoint_error
+
+    try:
+        with EXECUTOR.admit():
+            effective_device = resolve_device(device)
 
-        # Return in format expected by frontend
+            content = await image.read()
+            image_np = await EXECUTOR.run(load_image, content)
+
+            if POOL is not None:
+                # The encoded state stays in the worker, later prompts are routed there
+                worker = POOL.least_loaded()
+                effective_device = POOL.devices[worker]
+                session = SESSIONS.create(
+                    image_np, None, checkpoint_path=CHECKPOINT_PATH, device=effective_device, worker=worker
+                )
+                start = time.perf_counter()
+                try:
+                    await POOL.call("encode", image_np, worker=worker, image_id=session.image_id)
+                except Exception:
+                    SESSIONS.delete(session.image_id)
+                    raise
+                encode_time = time.perf_counter() - start
+            else:
+                model = await EXECUTOR.run(get_model, checkpoint, effective_device)
+                start = time.perf_counter()
+                inference_state = await EXECUTOR.run(model.encode_image, image_np)
+                encode_time = time.perf_counter() - start
+
+                session = SESSIONS.create(
+                    image_np,
+                    inference_state,
+                    checkpoint_path=model.checkpoint_path,
+                    device=effective_device,
+                )
         return JSONResponse({
             "success": True,
-            "mask_url": overlay_data_url,  # Frontend expects overlay, not just mask
-            "description": description,
-            "confidence": confidence,
+            "image_id": session.image_id,
+            "width": int(image_np.shape[1]),
+            "height": int(image_np.shape[0]),
+            "expires_in": SESSIONS.ttl_seconds,
             "stats": {
                 "mode": "medical-sam3",
-                "prompt": prompt,
-                "coverage_percent": round(coverage, 2),
-                "area_px": area_px,
-                "diameter_px": diameter_px,
-                "inference_time": round(inference_time, 3),
+                "encode_time": round(encode_time, 3),
                 "device": effective_device
             }
         })
 
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except ImageTooLarge as e:
+        return image_too_large_response(e)
     except Exception as e:
-        print(f"Segmentation error: {e}")
+        print(f"Image encoding error: {e}")
         import traceback
         traceback.print_exc()
-        
+
         return JSONResponse({
             "success": False,
-            "mask_url": None,
-            "description": f"Error analyzing '{prompt}': {str(e)[:100]}. Please consult a medical professional.",
-            "confidence": 0,
-            "stats": {"error": str(e)[:200], "mode": "medical-sam3"}
+            "image_id": None,
+            "error": str(e)[:200]
         }, status_code=500)
 
 
+def parse_geometry(box: Optional[str], points: Optional[str], point_labels: Optional[str]):
+    """Parse box and point form fields into (bbox, points, labels), None where absent."""
+    bbox, point_list, labels = None, None, None
+    if box is not None:
+        bbox = tuple(int(float(v)) for v in box.split(","))
+        if len(bbox) != 4:
+            raise ValueError("Box must be 'x_min,y_min,x_max,y_max'")
+    if points is not None:
+        point_list = [tuple(p) for p in json.loads(points)]
+        labels = json.loads(point_labels) if point_labels else [1] * len(point_list)
+        if len(labels) != len(point_list):
+            raise ValueError("point_labels must match the number of points")
+    return bbox, point_list, labels
+
+
+@app.post("/images/{image_id}/segment")
+async def segment_image_session(
+    image_id: str,
+    prompt: Optional[str] = Form(None),
+    box: Optional[str] = Form(None),
+    points: Optional[str] = Form(None),
+    point_labels: Optional[str] = Form(None),
+    format: str = Form("png"),
+    overlay: Optional[bool] = Form(None),
+):
+    """
+    Segment a previously uploaded image.
+
+    Exactly one kind of prompt must be given.
+
+    Args:
+        image_id: Id returned by POST /images
+        prompt: Text description of what to segment
+        box: Box prompt as "x_min,y_min,x_max,y_max" in pixels
+        points: Point prompts as JSON "[[x, y], ...]" in pixels
+        point_labels: Optional JSON list, 1 for positive and 0 for negative points
+        format: Mask encoding: "png" (default), "rle", "bits" or "binary"
+        overlay: Render the overlay PNG into mask_url (default only for "png")
+
+    Returns:
+        JSON with mask_url, description, confidence, and stats
+    """
+    session = SESSIONS.get(image_id)
+    if session is None:
+        return JSONResponse({
+            "success": False,
+            "error": f"Unknown or expired image_id: {image_id}"
+        }, status_code=404)
+
+    if sum(p is not None for p in (prompt, box, points)) != 1:
+        return JSONResponse({
+            "success": False,
+            "error": "Provide exactly one of prompt, box or points"
+        }, status_code=400)
+
+    format_error = mask_format_error(format)
+    if format_error is not None:
+        return format_error
+
+    try:
+        bbox, point_list, labels = parse_geometry(box, points, point_labels)
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+
+    prompt_label = prompt if prompt is not None else ("box prompt" if box is not None else "point prompt")
+    img_size = session.image.shape[:2]
+    if prompt is not None:
+        method, kwargs = "predict_text", {"text_prompt": prompt}
+    elif box is not None:
+        method, kwargs = "predict_box", {"bbox": bbox, "img_size": img_size}
+    else:
+        method, kwargs = "predict_points", {
+            "points": point_list, "labels": [bool(l) for l in labels], "img_size": img_size
+        }
+
+    def predict():
+        model = get_model(session.checkpoint_path, session.device)
+        with session.lock:
+            start = time.perf_counter()
+            pred_mask = getattr(model, method)(session.inference_state, **kwargs)
+            inference_time = time.perf_counter() - start
+            SESSIONS.remeasure(session)
+            return pred_mask, inference_time
+
+    try:
+        with EXECUTOR.admit():
+            if session.worker is not None:
+                start = time.perf_counter()
+                pred_mask = await POOL.call(method, worker=session.worker, image_id=image_id, **kwargs)
+                inference_time = time.perf_counter() - start
+            else:
+                pred_mask, inference_time = await EXECUTOR.run(predict)
+            return await EXECUTOR.run(
+                segmentation_response,
+                session.image, pred_mask, prompt_label, inference_time, session.device, format, overlay
+            )
+
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except SessionNotFound:
+        return session_lost_response(image_id)
+    except Exception as e:
+        return error_response(prompt_label, e)
+
+
+@app.post("/images/{image_id}/refine")
+async def refine_image_session(
+    image_id: str,
+    points: Optional[str] = Form(None),
+    point_labels: Optional[str] = Form(None),
+    box: Optional[str] = Form(None),
+    reset: bool = Form(False),
+    format: str = Form("png"),
+    overlay: Optional[bool] = Form(None),
+):
+    """
+    Refine a mask of an uploaded image with clicks (requires ENABLE_REFINEMENT=1).
+
+    Each call runs only the lightweight prompt encoder and mask decoder on
+    the cached image features, starting from the previous refined mask, so
+    a client can send one click at a time.
+
+    Args:
+        image_id: Id returned by POST /images
+        points: Clicks as JSON "[[x, y], ...]" in pixels
+        point_labels: Optional JSON list, 1 for positive and 0 for negative clicks
+        box: Optional box "x_min,y_min,x_max,y_max" in pixels
+        reset: Start from scratch instead of the previous refined mask
+        format: Mask encoding: "png" (default), "rle", "bits" or "binary"
+        overlay: Render the overlay PNG into mask_url (default only for "png")
+
+    Returns:
+        JSON with mask_url, description, confidence, and stats
+    """
+    if not ENABLE_REFINEMENT:
+        return JSONResponse({
+            "success": False,
+            "error": "Refinement is disabled, set ENABLE_REFINEMENT=1"
+        }, status_code=400)
+
+    session = SESSIONS.get(image_id)
+    if session is None:
+        return JSONResponse({
+            "success": False,
+            "error": f"Unknown or expired image_id: {image_id}"
+        }, status_code=404)
+
+    if points is None and box is None:
+        return JSONResponse({
+            "success": False,
+            "error": "Provide points and/or a box"
+        }, status_code=400)
+
+    format_error = mask_format_error(format)
+    if format_error is not None:
+        return format_error
+
+    try:
+        bbox, point_list, labels = parse_geometry(box, points, point_labels)
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+
+    kwargs = {
+        "points": point_list or [],
+        "labels": [bool(l) for l in labels or []],
+        "box": bbox,
+        "reset": reset,
+    }
+
+    def refine():
+        model = get_model(session.checkpoint_path, session.device)
+        with session.lock:
+            start = time.perf_counter()
+            pred_mask = model.refine(session.inference_state, **kwargs)
+            inference_time = time.perf_counter() - start
+            SESSIONS.remeasure(session)
+            return pred_mask, inference_time
+
+    try:
+        with EXECUTOR.admit():
+            if session.worker is not None:
+                start = time.perf_counter()
+                pred_mask = await POOL.call("refine", worker=session.worker, image_id=image_id, **kwargs)
+                inference_time = time.perf_counter() - start
+            else:
+                pred_mask, inference_time = await EXECUTOR.run(refine)
+            return await EXECUTOR.run(
+                segmentation_response,
+                session.image, pred_mask, "refinement", inference_time, session.device, format, overlay
+            )
+
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except SessionNotFound:
+        return session_lost_response(image_id)
+    except Exception as e:
+        return error_response("refinement", e)
+
+
+@app.post("/images/{image_id}/rescore")
+async def rescore_image_session(
+    image_id: str,
+    threshold: float = Form(...),
+    topk: int = Form(1),
+    format: str = Form("png"),
+    overlay: Optional[bool] = Form(None),
+):
+    """
+    Re-filter the last prediction of an uploaded image, without running the model.
+
+    Meant for interactive controls such as a confidence slider: the
+    unfiltered predictions of the last /images/{image_id}/segment call are
+    kept, so this only thresholds them and upsamples the result.
+
+    Args:
+        image_id: Id returned by POST /images
+        threshold: Score threshold
+        topk: Number of highest scoring predictions merged into the mask
+        format: Mask encoding: "png" (default), "rle", "bits" or "binary"
+        overlay: Render the overlay PNG into mask_url (default only for "png")
+
+    Returns:
+        JSON with mask_url, description, confidence, and stats
+    """
+    session = SESSIONS.get(image_id)
+    if session is None:
+        return JSONResponse({
+            "success": False,
+            "error": f"Unknown or expired image_id: {image_id}"
+        }, status_code=404)
+
+    format_error = mask_format_error(format)
+    if format_error is not None:
+        return format_error
+
+    kwargs = {"threshold": threshold, "topk": topk}
+
+    def rescore():
+        model = get_model(session.checkpoint_path, session.device)
+        with session.lock:
+            start = time.perf_counter()
+            pred_mask = model.rescore(session.inference_state, **kwargs)
+            inference_time = time.perf_counter() - start
+            SESSIONS.remeasure(session)
+            return pred_mask, inference_time
+
+    try:
+        with EXECUTOR.admit():
+            if session.worker is not None:
+                start = time.perf_counter()
+                pred_mask = await POOL.call("rescore", worker=session.worker, image_id=image_id, **kwargs)
+                inference_time = time.perf_counter() - start
+            else:
+                pred_mask, inference_time = await EXECUTOR.run(rescore)
+            return await EXECUTOR.run(
+                segmentation_response,
+                session.image, pred_mask, f"threshold {threshold}", inference_time, session.device, format, overlay
+            )
+
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except SessionNotFound:
+        return session_lost_response(image_id)
+    except Exception as e:
+        return error_response(f"threshold {threshold}", e)
+
+
+@app.post("/images/{image_id}/findings")
+async def segment_image_findings(
+    image_id: str,
+    prompts: str = Form(...),
+    format: str = Form("png"),
+    overlay: Optional[bool] = Form(None),
+):
+    """
+    Segment several findings on a previously uploaded image in one pass.
+
+    Args:
+        image_id: Id returned by POST /images
+        prompts: Text prompts as JSON '["polyp", "tumor", ...]'
+        format: Mask encoding: "png" (default), "rle" or "bits"
+        overlay: Render the overlay PNG into mask_url (default only for "png")
+
+    Returns:
+        JSON with one result (mask_url, description, confidence, stats) per prompt
+    """
+    session = SESSIONS.get(image_id)
+    if session is None:
+        return JSONResponse({
+            "success": False,
+            "error": f"Unknown or expired image_id: {image_id}"
+        }, status_code=404)
+
+    try:
+        prompt_list = json.loads(prompts)
+        if not isinstance(prompt_list, list) or not prompt_list or not all(isinstance(p, str) for p in prompt_list):
+            raise ValueError("prompts must be a non-empty JSON list of strings")
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+
+    if format == "binary":
+        return JSONResponse({"success": False, "error": "format 'binary' returns a single mask, use /segment"}, status_code=400)
+    format_error = mask_format_error(format)
+    if format_error is not None:
+        return format_error
+
+    def predict():
+        model = get_model(session.checkpoint_path, session.device)
+        with session.lock:
+            start = time.perf_counter()
+            pred_masks = model.predict_texts(session.inference_state, prompt_list)
+            inference_time = time.perf_counter() - start
+            SESSIONS.remeasure(session)
+            return pred_masks, inference_time
+
+    def build_response(pred_masks, inference_time):
+        return {
+            "success": True,
+            "results": [
+                segmentation_result(
+                    session.image, pred_mask, prompt, inference_time, session.device, format, overlay
+                )
+                for prompt, pred_mask in zip(prompt_list, pred_masks)
+            ],
+            "stats": {
+                "mode": "medical-sam3",
+                "num_prompts": len(prompt_list),
+                "inference_time": round(inference_time, 3),
+                "device": session.device
+            }
+        }
+
+    try:
+        with EXECUTOR.admit():
+            if session.worker is not None:
+                start = time.perf_counter()
+                pred_masks = await POOL.call(
+                    "predict_texts", worker=session.worker, image_id=image_id, text_prompts=prompt_list
+                )
+                inference_time = time.perf_counter() - start
+            else:
+                pred_masks, inference_time = await EXECUTOR.run(predict)
+            return JSONResponse(await EXECUTOR.run(build_response, pred_masks, inference_time))
+
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except SessionNotFound:
+        return session_lost_response(image_id)
+    except Exception as e:
+        return error_response(", ".join(prompt_list), e)
+
+
+@app.delete("/images/{image_id}")
+async def delete_image_session(image_id: str):
+    """Release a stored image before its TTL expires."""
+    if not SESSIONS.delete(image_id):
+        return JSONResponse({
+            "success": False,
+            "error": f"Unknown or expired image_id: {image_id}"
+        }, status_code=404)
+    return JSONResponse({"success": True, "image_id": image_id})
+
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
@@ -1,38 +1,119 @@
 """Medical-SAM3 Segmentation Server"""
-import io, base64, sys, time
+import io, base64, json, os, sys, threading, time
 import numpy as np
 from pathlib import Path
 from typing import Optional
 from PIL import Image
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 # Add Medical-SAM3 to path
 MEDSAM3_ROOT = Path(__file__).resolve().parents[1] / "Medical-SAM3"
 sys.path.insert(0, str(MEDSAM3_ROOT / "inference"))
+from session_store import SessionStore
+from batching import BatchingWorker
+from mask_codec import MASK_FORMATS, encode_mask, mask_to_bits, mask_to_png_data_url
+from executor import ExecutorOverloaded, InferenceExecutor
+from lifecycle import ModelLifecycle
+from ingest import ImageTooLarge, decode_image
 
 app = FastAPI(title="Medical-SAM3 Segmentation Server", version="2.0.0")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Segmentation-Result", "X-Mask-Size"])
 
 # Global model instance
 MODEL = None
 
+# Image embedding cache: re-prompting the same image skips the ViT backbone
+EMBEDDING_CACHE = None
+
+# Text prompt cache: repeated prompts skip the text transformer
+TEXT_CACHE_SIZE = int(os.environ.get("TEXT_CACHE_SIZE", "1024"))
+TEXT_CACHE_PATH = os.environ.get("TEXT_CACHE_PATH", None)
+
+# CPU precision mode: fp32, bf16 (autocast) or int8 (quantized Linear layers)
+MODEL_PRECISION = os.environ.get("MODEL_PRECISION", "fp32")
+
+# Optional torch.compile of the image path, with artifacts persisted across restarts
+COMPILE_MODE = os.environ.get("COMPILE_MODE") or None
+COMPILE_CACHE_DIR = os.environ.get("COMPILE_CACHE_DIR") or None
+
+# Image sessions: upload and encode once, then prompt many times
+SESSIONS = SessionStore(
+    ttl_seconds=float(os.environ.get("SESSION_TTL_SECONDS", "900")),
+    max_bytes=int(float(os.environ.get("SESSION_MAX_MB", "2048")) * 1024 * 1024),
+    # Embeddings the cache holds are shared with sessions, not charged twice
+    shared_tensors=lambda: EMBEDDING_CACHE.tensor_keys() if EMBEDDING_CACHE is not None else set(),
+)
+
+# Blocking work (decode, inference, mask encoding) runs off the event loop,
+# with bounded admission so that latency under load stays predictable
+EXECUTOR = InferenceExecutor(
+    max_workers=int(os.environ.get("INFERENCE_WORKERS", "1")),
+    max_queue=int(os.environ.get("INFERENCE_QUEUE_SIZE", "8")),
+)
+
+# Micro-batching: concurrent /segment requests share one backbone and grounding pass
+BATCHER = BatchingWorker(
+    max_batch_size=int(os.environ.get("BATCH_MAX_SIZE", "4")),
+    max_wait_ms=float(os.environ.get("BATCH_MAX_WAIT_MS", "10")),
+    executor=EXECUTOR.pool,
+)
+
+# Tiled mode (/segment with tiled=true): native resolution with overlapping 1008 px tiles
+TILING = {
+    "overlap": int(os.environ.get("TILE_OVERLAP", "128")),
+    "batch_size": int(os.environ.get("TILE_BATCH_SIZE", "4")),
+    "max_memory_mb": float(os.environ.get("TILED_MAX_MEMORY_MB", "2048")),
+}
+# Resolution tiers (/segment resolution=preview|auto), see RESOLUTION_TIERS in sam3_inference
+RESOLUTIONS = ("full", "preview", "auto")
+PRECOMPUTE_RESOLUTIONS = [int(r) for r in os.environ.get("PRECOMPUTE_RESOLUTIONS", "672").split(",") if r.strip()]
+RESOLUTION_ESCALATE_BELOW = float(os.environ.get("RESOLUTION_ESCALATE_BELOW", "0.5"))
+# Click refinement (/images/{image_id}/refine) needs the interactive predictor
+ENABLE_REFINEMENT = os.environ.get("ENABLE_REFINEMENT", "0") == "1"
+TILED_MAX_PIXELS = int(float(os.environ.get("TILED_MAX_MEGAPIXELS", "256")) * 1_000_000)
+# Let PIL open such images, load_image enforces TILED_MAX_PIXELS instead
+Image.MAX_IMAGE_PIXELS = max(Image.MAX_IMAGE_PIXELS or 0, TILED_MAX_PIXELS)
+
+# Startup: build, load and warm up the model before reporting ready on /ready.
+# With WARMUP_ON_STARTUP=0 the model is loaded by the first request instead.
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") == "1"
+WARMUP_IMAGE_SIZE = int(os.environ.get("WARMUP_IMAGE_SIZE", "1008"))
+LIFECYCLE = ModelLifecycle()
+MODEL_LOCK = threading.Lock()
+
 def get_model(device: str = "cuda"):
     """Lazy load Medical-SAM3 model."""
-    global MODEL
+    with MODEL_LOCK:
+        return _create_model(device)
+
+def _create_model(device: str):
+    global MODEL, EMBEDDING_CACHE
     if MODEL is None:
         try:
             import torch
-            from sam3_inference import SAM3Model
+            from sam3_inference import SAM3Model, TextEmbeddingCache
+            from embedding_cache import ImageEmbeddingCache
             
             # Use CPU if CUDA not available
             if device == "cuda" and not torch.cuda.is_available():
                 device = "cpu"
                 print("CUDA not available, using CPU")
             
-            MODEL = SAM3Model(confidence_threshold=0.1, device=device)
-            print(f"Medical-SAM3 model initialized (device: {device})")
+            EMBEDDING_CACHE = ImageEmbeddingCache(
+                max_bytes=int(float(os.environ.get("EMBEDDING_CACHE_MB", "1024")) * 1024 * 1024),
+                offload_to_cpu=os.environ.get("EMBEDDING_CACHE_OFFLOAD", "0") == "1",
+            )
+            text_cache = TextEmbeddingCache(max_entries=TEXT_CACHE_SIZE) if TEXT_CACHE_SIZE > 0 else None
+            MODEL = SAM3Model(confidence_threshold=0.1, device=device, embedding_cache=EMBEDDING_CACHE, text_cache=text_cache, precision=MODEL_PRECISION,
+                              compile_mode=COMPILE_MODE, compile_cache_dir=COMPILE_CACHE_DIR, resolutions=PRECOMPUTE_RESOLUTIONS,
+                              interactive=ENABLE_REFINEMENT)
+            print(f"Medical-SAM3 model initialized (device: {device}, precision: {MODEL.precision})")
+            
+            # Restore the text cache saved by a previous run
+            if TEXT_CACHE_PATH and os.path.exists(TEXT_CACHE_PATH):
+                print(f"Loaded {MODEL.load_text_cache(TEXT_CACHE_PATH)} cached text prompts")
         except Exception as e:
             print(f"Error loading Medical-SAM3: {e}")
             import traceback
@@ -40,6 +121,33 @@ def get_model(device: str = "cuda"):
             MODEL = "DEMO"
     return MODEL
 
+def load_and_warm_up(lifecycle: ModelLifecycle):
+    """Build, load weights, then warm up (nothing to do in DEMO mode)."""
+    with lifecycle.stage_timer("load"):
+        model = get_model()
+        if model == "DEMO":
+            return
+        model.load_model()
+    with lifecycle.stage_timer("warmup"):
+        from dataset_loaders import DATASET_PROMPTS
+        warmup_prompts = [p.strip() for p in os.environ.get("TEXT_CACHE_WARMUP_PROMPTS", "").split(",") if p.strip()]
+        model.warmup(list(DATASET_PROMPTS.values()) + warmup_prompts, image_size=WARMUP_IMAGE_SIZE)
+    lifecycle.record(model.load_timings)
+
+@app.on_event("startup")
+def start_model():
+    """Start loading the model in the background; /ready reports when it is done."""
+    if WARMUP_ON_STARTUP:
+        LIFECYCLE.start(load_and_warm_up)
+    else:
+        LIFECYCLE.mark_ready()
+
+@app.on_event("shutdown")
+def save_text_cache():
+    """Persist the text cache so that restarts start warm."""
+    if MODEL is not None and MODEL != "DEMO" and TEXT_CACHE_PATH:
+        MODEL.save_text_cache(TEXT_CACHE_PATH)
+
 def image_to_base64(image: Image.Image) -> str:
     buffer = io.BytesIO()
     image.save(buffer, format="PNG")
@@ -71,122 +179,442 @@ async def root():
 
 @app.get("/health")
 async def health():
-    model = get_model()
+    """Liveness check: answers as soon as the server runs, even while the model loads."""
+    model = MODEL
+    loaded = model is not None and model != "DEMO"
     return {
         "status": "ok", 
-        "predictor_loaded": model is not None and model != "DEMO",
-        "model_type": "Medical-SAM3" if model != "DEMO" else "DEMO"
+        "predictor_loaded": loaded and model.processor is not None,
+        "model_type": "DEMO" if model == "DEMO" else "Medical-SAM3" if model is not None else None,
+        "startup": LIFECYCLE.status(),
+        "embedding_cache": EMBEDDING_CACHE.stats() if EMBEDDING_CACHE is not None else None,
+        "text_cache": model.text_cache.stats() if loaded and model.text_cache is not None else None,
+        "sessions": SESSIONS.stats(),
+        "batching": BATCHER.stats()
     }
 
+@app.get("/ready")
+async def ready():
+    """Readiness check: 200 once the model is loaded and warmed up, 503 before."""
+    status = LIFECYCLE.status()
+    status["model_type"] = "DEMO" if MODEL == "DEMO" else "Medical-SAM3"
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+@app.get("/metrics")
+async def metrics():
+    """Inference queue depth and counters."""
+    return {
+        "executor": EXECUTOR.stats(),
+        "batching": BATCHER.stats(),
+        "embedding_cache": EMBEDDING_CACHE.stats() if EMBEDDING_CACHE is not None else None,
+        "sessions": SESSIONS.stats()
+    }
+
+def load_image(image_bytes: bytes, max_size: Optional[int] = 1024) -> np.ndarray:
+    return decode_image(image_bytes, max_size, TILED_MAX_PIXELS)
+
+def demo_result(image_np: np.ndarray, prompt: str) -> dict:
+    h, w = image_np.shape[:2]
+    y, x = np.ogrid[:h, :w]
+    center_x, center_y = w // 2, h // 2
+    mask = ((x - center_x) ** 2 / (w//4) ** 2 + (y - center_y) ** 2 / (h//4) ** 2) <= 1
+    mask = mask.astype(np.float32)
+    
+    mask_image = create_mask_visualization(mask)
+    mask_base64 = image_to_base64(mask_image)
+    mask_url = f"data:image/png;base64,{mask_base64}"
+    
+    return {
+        "success": True,
+        "mask_url": mask_url,
+        "description": f"⚠️ DEMO MODE: Highlighted region for '{prompt}'. Medical-SAM3 model not loaded.",
+        "confidence": 0.5,
+        "stats": {"mode": "demo"}
+    }
+
+def demo_response(image_np: np.ndarray, prompt: str) -> JSONResponse:
+    return JSONResponse(demo_result(image_np, prompt))
+
+def segmentation_result(image_np: np.ndarray, pred_mask, prompt: str, inference_time: float, mask_format: str = "png", overlay: Optional[bool] = None, extra_stats: Optional[dict] = None) -> dict:
+    # "png" keeps the rendered visualization in mask_url; other formats return
+    # the encoded mask under "mask" and leave rendering to the client
+    if overlay is None:
+        overlay = mask_format == "png"
+    if pred_mask is None:
+        return {
+            "success": True,
+            "mask_url": None,
+            "description": f"No regions detected for '{prompt}'. Please consult a medical professional.",
+            "confidence": 0.3,
+            "stats": {"mode": "medical-sam3", "prompt": prompt}
+        }
+    
+    # Resize mask if needed
+    if pred_mask.shape != (image_np.shape[0], image_np.shape[1]):
+        pred_mask = resize_mask(pred_mask, (image_np.shape[0], image_np.shape[1]))
+    
+    # Calculate stats
+    area_px = int(pred_mask.sum())
+    total_px = pred_mask.shape[0] * pred_mask.shape[1]
+    coverage = (area_px / total_px) * 100
+    
+    ys, xs = np.where(pred_mask > 0)
+    diameter_px = int(max(xs.max() - xs.min(), ys.max() - ys.min())) if len(xs) > 0 else 0
+    
+    # Create visualization
+    if overlay:
+        mask_image = create_mask_visualization(pred_mask)
+        mask_base64 = image_to_base64(mask_image)
+        mask_url = f"data:image/png;base64,{mask_base64}"
+    elif mask_format == "png":
+        mask_url = mask_to_png_data_url(pred_mask)
+    else:
+        mask_url = None
+    
+    description = (
+        f"🔬 Medical-SAM3 detected region for '{prompt}'. "
+        f"Coverage: {coverage:.1f}% ({area_px} px). Diameter: {diameter_px} px. "
+        f"Inference: {inference_time:.2f}s. "
+        f"\n\n⚠️ This AI highlights visual features for reference only. "
+        f"ALWAYS consult a qualified physician for medical interpretation."
+    )
+    
+    confidence = 0.85 if area_px > 1000 else (0.7 if area_px > 100 else 0.5)
+    
+    result = {
+        "success": True,
+        "mask_url": mask_url,
+        "description": description,
+        "confidence": confidence,
+        "stats": {
+            "mode": "medical-sam3",
+            "prompt": prompt,
+            "coverage_percent": round(coverage, 2),
+            "area_px": area_px,
+            "diameter_px": diameter_px,
+            "inference_time": round(inference_time, 3),
+            **(extra_stats or {})
+        }
+    }
+    if mask_format in ("rle", "bits"):
+        result["mask"] = encode_mask(pred_mask, mask_format)
+    return result
+
+def segmentation_response(image_np: np.ndarray, pred_mask, prompt: str, inference_time: float, mask_format: str = "png", overlay: Optional[bool] = None, extra_stats: Optional[dict] = None) -> Response:
+    if mask_format != "binary":
+        return JSONResponse(segmentation_result(image_np, pred_mask, prompt, inference_time, mask_format, overlay, extra_stats))
+    
+    # Bit-packed mask (row-major, MSB first) as the body, JSON result in a header
+    if pred_mask is not None and pred_mask.shape != (image_np.shape[0], image_np.shape[1]):
+        pred_mask = resize_mask(pred_mask, (image_np.shape[0], image_np.shape[1]))
+    result = segmentation_result(image_np, pred_mask, prompt, inference_time, "binary", False, extra_stats)
+    headers = {"X-Segmentation-Result": json.dumps(result, ensure_ascii=True)}
+    if pred_mask is None:
+        return Response(status_code=204, headers=headers)
+    headers["X-Mask-Size"] = f"{pred_mask.shape[0]},{pred_mask.shape[1]}"
+    return Response(content=mask_to_bits(pred_mask), media_type="application/octet-stream", headers=headers)
+
+def mask_format_error(mask_format: str) -> Optional[JSONResponse]:
+    if mask_format in MASK_FORMATS:
+        return None
+    return JSONResponse({"success": False, "error": f"Unknown format '{mask_format}', expected one of {', '.join(MASK_FORMATS)}"}, status_code=400)
+
+def error_response(prompt: str, e: Exception) -> JSONResponse:
+    print(f"Segmentation error: {e}")
+    import traceback
+    traceback.print_exc()
+    
+    return JSONResponse({
+        "success": False,
+        "mask_url": None,
+        "description": f"Error analyzing '{prompt}': {str(e)[:100]}. Please consult a medical professional.",
+        "confidence": 0.0,
+        "stats": {"error": str(e)[:100]}
+    })
+
+def image_too_large_response(e: ImageTooLarge) -> JSONResponse:
+    return JSONResponse({"success": False, "error": str(e)}, status_code=413)
+
+def overloaded_response(e: ExecutorOverloaded) -> JSONResponse:
+    return JSONResponse({
+        "success": False,
+        "mask_url": None,
+        "description": "Server is busy, please retry shortly.",
+        "confidence": 0.0,
+        "stats": {"error": str(e), "retry_after": e.retry_after}
+    }, status_code=503, headers={"Retry-After": str(e.retry_after)})
+
 @app.post("/segment")
-async def segment_image(image: UploadFile = File(...), prompt: str = Form(...)):
-    model = get_model()
+async def segment_image(image: UploadFile = File(...), prompt: str = Form(...), format: str = Form("png"), overlay: Optional[bool] = Form(None), tiled: bool = Form(False), resolution: str = Form("full")):
+    """Text-prompted segmentation. format is "png" (default), "rle", "bits" or "binary"; overlay renders mask_url; tiled segments large images at native resolution; resolution is "full", "preview" or "auto" (preview, escalated when unsure)."""
+    format_error = mask_format_error(format)
+    if format_error is not None:
+        return format_error
+    if resolution not in RESOLUTIONS:
+        return JSONResponse({"success": False, "error": f"Unknown resolution '{resolution}', expected one of {', '.join(RESOLUTIONS)}"}, status_code=400)
     
     try:
-        image_bytes = await image.read()
-        pil_image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        image_np = np.array(pil_image)
-        
-        # Resize if too large
-        max_size = 1024
-        if max(pil_image.size) > max_size:
-            ratio = max_size / max(pil_image.size)
-            new_size = (int(pil_image.size[0] * ratio), int(pil_image.size[1] * ratio))
-            pil_image = pil_image.resize(new_size, Image.Resampling.LANCZOS)
-            image_np = np.array(pil_image)
-        
-        # Demo mode fallback
-        if model == "DEMO" or model is None:
-            w, h = pil_image.size
-            y, x = np.ogrid[:h, :w]
-            center_x, center_y = w // 2, h // 2
-            mask = ((x - center_x) ** 2 / (w//4) ** 2 + (y - center_y) ** 2 / (h//4) ** 2) <= 1
-            mask = mask.astype(np.float32)
+        with EXECUTOR.admit():
+            model = await EXECUTOR.run(get_model)
+            image_bytes = await image.read()
+            image_np = await EXECUTOR.run(load_image, image_bytes, None if tiled else 1024)
             
-            mask_image = create_mask_visualization(mask)
-            mask_base64 = image_to_base64(mask_image)
-            mask_url = f"data:image/png;base64,{mask_base64}"
+            # Demo mode fallback
+            if model == "DEMO" or model is None:
+                return await EXECUTOR.run(demo_response, image_np, prompt)
             
-            return JSONResponse({
-                "success": True,
-                "mask_url": mask_url,
-                "description": f"⚠️ DEMO MODE: Highlighted region for '{prompt}'. Medical-SAM3 model not loaded.",
-                "confidence": 0.5,
-                "stats": {"mode": "demo"}
-            })
-        
-        # Medical-SAM3 inference
-        start_time = time.perf_counter()
-        
-        # Encode image and run text-prompted segmentation
-        inference_state = model.encode_image(image_np)
-        pred_mask = model.predict_text(inference_state, prompt)
-        
-        inference_time = time.perf_counter() - start_time
-        
-        if pred_mask is None:
-            return JSONResponse({
-                "success": True,
-                "mask_url": None,
-                "description": f"No regions detected for '{prompt}'. Please consult a medical professional.",
-                "confidence": 0.3,
-                "stats": {"mode": "medical-sam3", "prompt": prompt}
-            })
+            # Medical-SAM3 inference
+            start_time = time.perf_counter()
+            
+            extra_stats = None
+            if tiled:
+                pred_mask = await EXECUTOR.run(model.segment_tiled, image_np, prompt, **TILING)
+                if not pred_mask.any():
+                    pred_mask = None
+            elif resolution != "full":
+                tier, escalate_below = ("preview", RESOLUTION_ESCALATE_BELOW) if resolution == "auto" else (resolution, None)
+                pred_mask, used_resolution = await EXECUTOR.run(model.segment_text, image_np, prompt, tier, escalate_below)
+                extra_stats = {"resolution": used_resolution}
+            else:
+                # Encode image and run text-prompted segmentation, batched with concurrent requests
+                pred_mask = await BATCHER.submit(model, image_np, prompt)
+            
+            inference_time = time.perf_counter() - start_time
+            
+            return await EXECUTOR.run(segmentation_response, image_np, pred_mask, prompt, inference_time, format, overlay, extra_stats)
         
-        # Resize mask if needed
-        if pred_mask.shape != (image_np.shape[0], image_np.shape[1]):
-            pred_mask = resize_mask(pred_mask, (image_np.shape[0], image_np.shape[1]))
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except ImageTooLarge as e:
+        return image_too_large_response(e)
+    except Exception as e:
+        return error_response(prompt, e)
+
+@app.post("/images")
+async def create_image_session(image: UploadFile = File(...)):
+    """Upload and encode an image once; prompt it later via /images/{image_id}/segment."""
+    try:
+        with EXECUTOR.admit():
+            model = await EXECUTOR.run(get_model)
+            image_bytes = await image.read()
+            image_np = await EXECUTOR.run(load_image, image_bytes)
+            
+            start_time = time.perf_counter()
+            inference_state = None
+            if model != "DEMO" and model is not None:
+                inference_state = await EXECUTOR.run(model.encode_image, image_np)
+            encode_time = time.perf_counter() - start_time
         
-        # Calculate stats
-        area_px = int(pred_mask.sum())
-        total_px = pred_mask.shape[0] * pred_mask.shape[1]
-        coverage = (area_px / total_px) * 100
+        session = SESSIONS.create(image_np, inference_state)
+        return JSONResponse({
+            "success": True,
+            "image_id": session.image_id,
+            "width": int(image_np.shape[1]),
+            "height": int(image_np.shape[0]),
+            "expires_in": SESSIONS.ttl_seconds,
+            "stats": {
+                "mode": "demo" if inference_state is None else "medical-sam3",
+                "encode_time": round(encode_time, 3)
+            }
+        })
         
-        ys, xs = np.where(pred_mask > 0)
-        diameter_px = int(max(xs.max() - xs.min(), ys.max() - ys.min())) if len(xs) > 0 else 0
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except ImageTooLarge as e:
+        return image_too_large_response(e)
+    except Exception as e:
+        print(f"Image encoding error: {e}")
+        import traceback
+        traceback.print_exc()
         
-        # Create visualization
-        mask_image = create_mask_visualization(pred_mask)
-        mask_base64 = image_to_base64(mask_image)
-        mask_url = f"data:image/png;base64,{mask_base64}"
+        return JSONResponse({"success": False, "image_id": None, "error": str(e)[:100]}, status_code=500)
+
+@app.post("/images/{image_id}/segment")
+async def segment_image_session(
+    image_id: str,
+    prompt: Optional[str] = Form(None),
+    box: Optional[str] = Form(None),
+    points: Optional[str] = Form(None),
+    point_labels: Optional[str] = Form(None),
+    format: str = Form("png"),
+    overlay: Optional[bool] = Form(None),
+):
+    """
+    Segment a previously uploaded image with exactly one of: a text prompt,
+    a box "x_min,y_min,x_max,y_max", or JSON points "[[x, y], ...]" with
+    optional JSON point_labels (1 positive, 0 negative). Coordinates are in pixels.
+    format and overlay are the same as for /segment.
+    """
+    session = SESSIONS.get(image_id)
+    if session is None:
+        return JSONResponse({"success": False, "error": f"Unknown or expired image_id: {image_id}"}, status_code=404)
+    
+    if sum(p is not None for p in (prompt, box, points)) != 1:
+        return JSONResponse({"success": False, "error": "Provide exactly one of prompt, box or points"}, status_code=400)
+    
+    format_error = mask_format_error(format)
+    if format_error is not None:
+        return format_error
+    
+    try:
+        if box is not None:
+            bbox = tuple(int(float(v)) for v in box.split(","))
+            if len(bbox) != 4:
+                raise ValueError("Box must be 'x_min,y_min,x_max,y_max'")
+        if points is not None:
+            point_list = [tuple(p) for p in json.loads(points)]
+            labels = json.loads(point_labels) if point_labels else [1] * len(point_list)
+            if len(labels) != len(point_list):
+                raise ValueError("point_labels must match the number of points")
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+    
+    prompt_label = prompt if prompt is not None else ("box prompt" if box is not None else "point prompt")
+    if session.inference_state is None:
+        return demo_response(session.image, prompt_label)
+    
+    def predict():
+        model = get_model()
+        img_size = session.image.shape[:2]
+        with session.lock:
+            start_time = time.perf_counter()
+            if prompt is not None:
+                pred_mask = model.predict_text(session.inference_state, prompt)
+            elif box is not None:
+                pred_mask = model.predict_box(session.inference_state, bbox, img_size)
+            else:
+                pred_mask = model.predict_points(
+                    session.inference_state, point_list, [bool(l) for l in labels], img_size
+                )
+            inference_time = time.perf_counter() - start_time
+            SESSIONS.remeasure(session)
+        return segmentation_response(session.image, pred_mask, prompt_label, inference_time, format, overlay)
+    
+    try:
+        with EXECUTOR.admit():
+            return await EXECUTOR.run(predict)
         
-        description = (
-            f"🔬 Medical-SAM3 detected region for '{prompt}'. "
-            f"Coverage: {coverage:.1f}% ({area_px} px). Diameter: {diameter_px} px. "
-            f"Inference: {inference_time:.2f}s. "
-            f"\n\n⚠️ This AI highlights visual features for reference only. "
-            f"ALWAYS consult a qualified physician for medical interpretation."
-        )
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return error_response(prompt_label, e)
+
+@app.post("/images/{image_id}/refine")
+async def refine_image_session(image_id: str, points: Optional[str] = Form(None), point_labels: Optional[str] = Form(None), box: Optional[str] = Form(None),
+                               reset: bool = Form(False), format: str = Form("png"), overlay: Optional[bool] = Form(None)):
+    """
+    Refine a mask with JSON clicks "[[x, y], ...]" (point_labels 1 positive, 0 negative) and/or a box,
+    starting from the previous refined mask unless reset. Runs only the interactive prompt encoder and
+    mask decoder on the cached features; requires ENABLE_REFINEMENT=1.
+    """
+    if not ENABLE_REFINEMENT:
+        return JSONResponse({"success": False, "error": "Refinement is disabled, set ENABLE_REFINEMENT=1"}, status_code=400)
+    session = SESSIONS.get(image_id)
+    if session is None:
+        return JSONResponse({"success": False, "error": f"Unknown or expired image_id: {image_id}"}, status_code=404)
+    if points is None and box is None:
+        return JSONResponse({"success": False, "error": "Provide points and/or a box"}, status_code=400)
+    format_error = mask_format_error(format)
+    if format_error is not None:
+        return format_error
+    
+    try:
+        bbox = None
+        if box is not None:
+            bbox = tuple(int(float(v)) for v in box.split(","))
+            if len(bbox) != 4:
+                raise ValueError("Box must be 'x_min,y_min,x_max,y_max'")
+        point_list = [tuple(p) for p in json.loads(points)] if points is not None else []
+        labels = json.loads(point_labels) if point_labels else [1] * len(point_list)
+        if len(labels) != len(point_list):
+            raise ValueError("point_labels must match the number of points")
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+    
+    if session.inference_state is None:
+        return demo_response(session.image, "refinement")
+    
+    def refine():
+        model = get_model()
+        with session.lock:
+            start_time = time.perf_counter()
+            pred_mask = model.refine(session.inference_state, point_list, [bool(l) for l in labels], bbox, reset=reset)
+            inference_time = time.perf_counter() - start_time
+            SESSIONS.remeasure(session)
+        return segmentation_response(session.image, pred_mask, "refinement", inference_time, format, overlay)
+    
+    try:
+        with EXECUTOR.admit():
+            return await EXECUTOR.run(refine)
         
-        confidence = 0.85 if area_px > 1000 else (0.7 if area_px > 100 else 0.5)
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return error_response("refinement", e)
+
+@app.post("/images/{image_id}/findings")
+async def segment_image_findings(image_id: str, prompts: str = Form(...), format: str = Form("png"), overlay: Optional[bool] = Form(None)):
+    """Segment several findings, given as a JSON list of text prompts, on a previously uploaded image in one pass."""
+    session = SESSIONS.get(image_id)
+    if session is None:
+        return JSONResponse({"success": False, "error": f"Unknown or expired image_id: {image_id}"}, status_code=404)
+    
+    try:
+        prompt_list = json.loads(prompts)
+        if not isinstance(prompt_list, list) or not prompt_list or not all(isinstance(p, str) for p in prompt_list):
+            raise ValueError("prompts must be a non-empty JSON list of strings")
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+    
+    if format == "binary":
+        return JSONResponse({"success": False, "error": "format 'binary' returns a single mask, use /segment"}, status_code=400)
+    format_error = mask_format_error(format)
+    if format_error is not None:
+        return format_error
+    
+    if session.inference_state is None:
+        return JSONResponse({
+            "success": True,
+            "results": [demo_result(session.image, prompt) for prompt in prompt_list],
+            "stats": {"mode": "demo", "num_prompts": len(prompt_list)}
+        })
+    
+    def predict():
+        model = get_model()
+        with session.lock:
+            start_time = time.perf_counter()
+            pred_masks = model.predict_texts(session.inference_state, prompt_list)
+            inference_time = time.perf_counter() - start_time
+            SESSIONS.remeasure(session)
         
         return JSONResponse({
             "success": True,
-            "mask_url": mask_url,
-            "description": description,
-            "confidence": confidence,
+            "results": [
+                segmentation_result(session.image, pred_mask, prompt, inference_time, format, overlay)
+                for prompt, pred_mask in zip(prompt_list, pred_masks)
+            ],
             "stats": {
                 "mode": "medical-sam3",
-                "prompt": prompt,
-                "coverage_percent": round(coverage, 2),
-                "area_px": area_px,
-                "diameter_px": diameter_px,
+                "num_prompts": len(prompt_list),
                 "inference_time": round(inference_time, 3)
             }
         })
+    
+    try:
+        with EXECUTOR.admit():
+            return await EXECUTOR.run(predict)
         
+    except ExecutorOverloaded as e:
+        return overloaded_response(e)
     except Exception as e:
-        print(f"Segmentation error: {e}")
-        import traceback
-        traceback.print_exc()
-        
-        return JSONResponse({
-            "success": False,
-            "mask_url": None,
-            "description": f"Error analyzing '{prompt}': {str(e)[:100]}. Please consult a medical professional.",
-            "confidence": 0.0,
-            "stats": {"error": str(e)[:100]}
-        })
+        return error_response(", ".join(prompt_list), e)
+
+@app.delete("/images/{image_id}")
+async def delete_image_session(image_id: str):
+    """Release a stored image before its TTL expires."""
+    if not SESSIONS.delete(image_id):
+        return JSONResponse({"success": False, "error": f"Unknown or expired image_id: {image_id}"}, status_code=404)
+    return JSONResponse({"success": True, "image_id": image_id})
 
 if __name__ == "__main__":
     import uvicorn